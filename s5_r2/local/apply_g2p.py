@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2022 Language Technology, Universitaet Hamburg (author: Benjamin Milde)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import print_function
+
+import argparse
+import hashlib
+import io
+import os
+import persistent_cache
+import re
+import shlex
+import shutil
+import subprocess
+import sys
+import tempfile
+
+from multiprocessing import Pool
+
+#
+# Applies a G2P model to a list of OOV words (e.g. from find_oov.py) in parallel: the word list is split into shards, the G2P command
+# runs on each shard in a worker process and the results are merged in the order of the word list. Writes the raw G2P output
+# (oov_lexicon.txt) and the Kaldi lexiconp format with probability 1.0 (oov_lexiconp.txt). Words that G2P could not convert
+# are reported and written to a separate file.
+#
+# The G2P command is a template with {model} and {input} placeholders, it has to print "word<whitespace>phonemes" lines:
+#   python3 local/apply_g2p.py -i data/local/g2p/oov.txt -m data/local/g2p/de_g2p_model-6 -o data/local/dict/oov_lexicon.txt \
+#           -p data/local/dict/oov_lexiconp.txt -j 8 --g2p-cmd "$sequitur_g2p -e utf8 --model {model} --apply {input}"
+#
+# Predictions are kept in a persistent cache, keyed by word and checksum of the G2P model, so only words that were not predicted with
+# the same model before are sent to G2P. Predictions of other models are removed from the cache when it is opened.
+#
+
+default_g2p_cmd = os.environ.get('sequitur_g2p', 'g2p.py') + ' -e utf8 --model {model} --apply {input}'
+
+#Default location of the persistent G2P cache
+g2p_cache_default_file = 'data/local/g2p_cache.sqlite'
+
+def modelChecksum(model):
+    sha1 = hashlib.sha1()
+    with open(model, 'rb') as modelfile:
+        for block in iter(lambda: modelfile.read(1 << 20), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+def openG2PCache(filename, model, max_entries=0):
+    '''Opens the persistent cache for G2P predictions of model, returns None if filename is empty (no caching)'''
+    if filename == '':
+        return None
+    namespace = 'g2p:' + modelChecksum(model)
+    cache = persistent_cache.PersistentCache(filename, namespace=namespace, max_entries=max_entries)
+    purged = cache.purge(keep_namespace=namespace, namespace_prefix='g2p:')
+    if purged > 0:
+        print('G2P model has changed, removed', purged, 'cached predictions of other models from', filename)
+    return cache
+
+def splitFields(line):
+    '''Splits a line into fields like awk does by default (on spaces and tabs)'''
+    return [field for field in re.split('[ \t]+', line.strip(' \t\r\n')) if field != '']
+
+def lexiconpLine(line):
+    '''The lexiconp line for a line of G2P output, None if it has no phonemes (this used to be gawk '{$1=$1" 1.0"; print }' | gawk 'NF>=3')'''
+    fields = splitFields(line)
+    if len(fields) < 2:
+        return None
+    return ' '.join([fields[0], '1.0'] + fields[1:]) + '\n'
+
+def loadWords(filename):
+    with io.open(filename, 'r', encoding='utf-8') as infile:
+        return [line.strip() for line in infile if line.strip() != '']
+
+def writeShards(words, num_shards, shard_dir):
+    '''Splits the word list into num_shards contiguous shards, returns the shard file names'''
+    num_shards = max(1, min(num_shards, len(words)))
+    shard_size = (len(words) + num_shards - 1) // num_shards
+    shard_files = []
+    for i in range(0, len(words), shard_size):
+        shard_file = os.path.join(shard_dir, 'shard.' + str(len(shard_files)) + '.txt')
+        with io.open(shard_file, 'w', encoding='utf-8') as outfile:
+            outfile.write(''.join([word + '\n' for word in words[i:i+shard_size]]))
+        shard_files.append(shard_file)
+    return shard_files
+
+def runShard(task):
+    '''Runs the G2P command on one shard (in a worker process), its output is written next to the shard file'''
+    g2p_cmd, model, shard_file = task
+    cmd = [arg.replace('{model}', model).replace('{input}', shard_file) for arg in shlex.split(g2p_cmd)]
+    with open(shard_file + '.out', 'wb') as outfile, open(shard_file + '.err', 'wb') as errfile:
+        returncode = subprocess.call(cmd, stdout=outfile, stderr=errfile)
+    return shard_file, returncode
+
+def applyG2P(words, model, g2p_cmd=default_g2p_cmd, jobs=1, shard_dir=None):
+    '''Runs G2P for all words with jobs worker processes, returns the lines of the G2P output in the order of the word list'''
+    if len(words) == 0:
+        return []
+    tmp_dir = tempfile.mkdtemp(prefix='g2p_shards.', dir=shard_dir)
+    try:
+        shard_files = writeShards(words, jobs, tmp_dir)
+        print('Applying G2P to', len(words), 'words in', len(shard_files), 'shards with', jobs, 'processes')
+        with Pool(processes=min(jobs, len(shard_files))) as pool:
+            results = pool.map(runShard, [(g2p_cmd, model, shard_file) for shard_file in shard_files])
+
+        lines = []
+        for shard_file, returncode in results:
+            if returncode != 0:
+                with io.open(shard_file + '.err', 'r', encoding='utf-8', errors='replace') as errfile:
+                    print(errfile.read()[-2000:], file=sys.stderr)
+                raise RuntimeError('G2P failed on ' + shard_file + ' with exit code ' + str(returncode))
+            with io.open(shard_file + '.out', 'r', encoding='utf-8') as outfile:
+                lines += outfile.read().splitlines(True)
+        return lines
+    finally:
+        shutil.rmtree(tmp_dir)
+
+def groupLines(words, lines):
+    '''Assigns the lines of the G2P output to the words they belong to (G2P can output several variants per word). Lines that don't
+       start with a word of the input belong to the previous word.'''
+    groups = dict([(word, []) for word in words])
+    word = None
+    for line in lines:
+        fields = splitFields(line)
+        if len(fields) > 0 and fields[0] in groups:
+            word = fields[0]
+        if word is None:
+            print('Warning, ignoring G2P output line that does not belong to any word:', line.strip())
+            continue
+        groups[word].append(line if line.endswith('\n') else line + '\n')
+    return groups
+
+def cachedG2P(words, model, cache, g2p_cmd=default_g2p_cmd, jobs=1, shard_dir=None):
+    '''Like applyG2P, but only words that are not in the cache are sent to G2P and their predictions (also failed ones) are added to the cache'''
+    predictions = cache.get_many(words)
+    new_words = [word for word in words if word not in predictions]
+    print('Found', len(predictions), 'of', len(words), 'words in the G2P cache,', len(new_words), 'new words.')
+
+    new_predictions = groupLines(new_words, applyG2P(new_words, model, g2p_cmd, jobs, shard_dir))
+    cache.put_many(new_predictions.items())
+    predictions.update(new_predictions)
+    return [line for word in words for line in predictions[word]]
+
+def writeResults(words, lines, lexicon_file, lexiconp_file, failed_file=''):
+    '''Writes the G2P output and its lexiconp version, returns the words without a pronounciation'''
+    converted = set()
+    with io.open(lexicon_file, 'w', encoding='utf-8') as lexicon, io.open(lexiconp_file, 'w', encoding='utf-8') as lexiconp:
+        for line in lines:
+            lexicon.write(line if line.endswith('\n') else line + '\n')
+            lexiconp_line = lexiconpLine(line)
+            if lexiconp_line is not None:
+                lexiconp.write(lexiconp_line)
+                converted.add(splitFields(line)[0])
+
+    failed = [word for word in words if word not in converted]
+    if failed_file != '':
+        with io.open(failed_file, 'w', encoding='utf-8') as outfile:
+            outfile.write(''.join([word + '\n' for word in failed]))
+    return failed
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Applies a G2P model to a list of OOV words with several processes and writes Kaldi lexicon files.')
+    parser.add_argument('-i', '--input', dest='input', help='OOV word list, one word per line (e.g. from find_oov.py)', type=str, default='oov.txt')
+    parser.add_argument('-m', '--model', dest='model', help='G2P model', type=str, required=True)
+    parser.add_argument('-o', '--lexicon', dest='lexicon', help='Write the G2P output to this file', type=str, default='oov_lexicon.txt')
+    parser.add_argument('-p', '--lexiconp', dest='lexiconp', help='Write the lexicon with probabilities (lexiconp format) to this file', type=str, default='oov_lexiconp.txt')
+    parser.add_argument('-f', '--failed', dest='failed', help='Write words that G2P could not convert to this file', type=str, default='')
+    parser.add_argument('-j', '--jobs', dest='jobs', help='Number of G2P processes', type=int, default=1)
+    parser.add_argument('--g2p-cmd', dest='g2p_cmd', help='G2P command template with {model} and {input} placeholders', type=str, default=default_g2p_cmd)
+    parser.add_argument('-c', '--g2p-cache', dest='g2p_cache', help='Persistent cache file for G2P predictions, set to an empty string to disable it', type=str, default=g2p_cache_default_file)
+    parser.add_argument('--g2p-cache-size', dest='g2p_cache_size', help='Maximum number of words in the G2P cache, least recently used words are evicted first (0 = unbounded)', type=int, default=0)
+
+    args = parser.parse_args()
+
+    words = loadWords(args.input)
+    shard_dir = os.path.dirname(os.path.abspath(args.lexicon))
+    cache = openG2PCache(args.g2p_cache, args.model, args.g2p_cache_size)
+    if cache is not None:
+        lines = cachedG2P(words, args.model, cache, args.g2p_cmd, args.jobs, shard_dir)
+        cache.close()
+    else:
+        lines = applyG2P(words, args.model, args.g2p_cmd, args.jobs, shard_dir)
+    failed = writeResults(words, lines, args.lexicon, args.lexiconp, args.failed)
+
+    print('G2P converted', len(words) - len(failed), 'of', len(words), 'words.')
+    if len(failed) > 0:
+        print('Warning, no pronounciation for', len(failed), 'words' + (' (see ' + args.failed + ')' if args.failed != '' else '') + ':', ' '.join(failed[:20]) + (' ...' if len(failed) > 20 else ''))
@@ -0,0 +1,255 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2022 Language Technology, Universitaet Hamburg (author: Benjamin Milde)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import print_function
+
+import argparse
+import audio_utils
+import io
+import mmap
+import os
+import subprocess
+import sys
+
+from multiprocessing import Pool
+
+#
+# Audio archives in the format of Kaldi wave archives (like the ones "wav-copy ... ark:foo.ark" writes): every entry is the key, a
+# space and a complete wav file. A wav.scp entry "foo.ark:1234" makes Kaldi seek to byte 1234 of foo.ark and read the wav file that
+# starts there, so data dirs can reference the archives directly and feature extraction reads them sequentially.
+#
+# Packs the audio of a data dir (Common Voice clips, M-AILABS wavs, TUDA mic files, ...) into sharded archives in the order of its
+# wav.scp, so that feature extraction doesn't have to open millions of small files. The shards are written by a pool of worker
+# processes, commands in the wav.scp are decoded once. The wav.scp is rewritten to point at the archives (the old one is kept as
+# wav.scp.orig, a segments file still refers to the same recording ids) and an index "key shard offset size" is written next to
+# the shards:
+#
+#   python3 local/audio_archive.py -j 16 data/commonvoice_train data/wav_16k/commonvoice_train_archive
+#
+# A data dir whose wav.scp already points into the archives is not packed again (--force packs it again from the archives).
+#
+# ArchiveReader reads single entries through the index, every shard is memory mapped once:
+#
+#   reader = audio_archive.ArchiveReader('data/wav_16k/commonvoice_train_archive/index')
+#   fmt, samples = reader.read(utt_id)
+#
+
+index_name = 'index'
+
+# wav.scp entries per shard
+default_shard_entries = 20000
+
+class ArchiveWriter:
+    '''Writes wav files into a Kaldi wave archive, add returns the wav.scp entry of each of them'''
+
+    def __init__(self, filename, rxfilename=None):
+        self.filename = filename
+        # name of the archive in the wav.scp entries, if it is renamed after writing
+        self.rxfilename = rxfilename if rxfilename is not None else filename
+        self.file = open(filename, 'wb')
+        # (key, offset, size) of the wav files
+        self.entries = []
+
+    def add(self, key, fmt, data):
+        '''Adds the samples data (in the format of the fmt chunk fmt) as key'''
+        self.file.write(key.encode('utf-8', 'surrogateescape') + b' ')
+        offset = self.file.tell()
+        header = audio_utils.wavHeader(fmt, len(data))
+        self.file.write(header)
+        self.file.write(data)
+        self.entries.append((key, offset, len(header) + len(data)))
+        return offsetRxfilename(self.rxfilename, offset)
+
+    def close(self):
+        self.file.close()
+
+def offsetRxfilename(filename, offset):
+    return filename + ':' + str(offset)
+
+def readArchiveWav(archive, offset):
+    '''(fmt chunk, samples) of the wav file at offset of an open archive file'''
+    archive.seek(offset)
+    header = audio_utils.readWavHeader(archive)
+    if header is None:
+        raise IOError('No wav file at offset ' + str(offset) + ' of ' + getattr(archive, 'name', 'archive'))
+    fmt, data_size = header
+    data = archive.read(data_size)
+    if len(data) != data_size:
+        raise IOError('Truncated wav file at offset ' + str(offset) + ' of ' + getattr(archive, 'name', 'archive'))
+    return fmt, data
+
+def readWav(rxfilename):
+    '''(fmt chunk, samples) of an "archive:offset" wav.scp entry'''
+    archive_file, offset = audio_utils.parseOffsetRxfilename(rxfilename)
+    with io.open(archive_file, 'rb') as archive:
+        return readArchiveWav(archive, offset)
+
+def readAudio(rxfilename):
+    '''(fmt chunk, samples) of a wav.scp entry: a command ending with |, an "archive:offset" entry or a wav file'''
+    rxfilename = rxfilename.strip()
+    if rxfilename.endswith('|'):
+        proc = subprocess.Popen(rxfilename[:-1], shell=True, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        header = audio_utils.readWavHeader(proc.stdout)
+        # the size in the header of a pipe is not reliable, all of the output is read
+        data = proc.stdout.read()
+        proc.stdout.close()
+        if proc.wait() != 0 or header is None:
+            raise IOError('Could not decode ' + rxfilename)
+        fmt = header[0]
+    elif audio_utils.parseOffsetRxfilename(rxfilename) is not None and not os.path.exists(rxfilename):
+        fmt, data = readWav(rxfilename)
+    else:
+        with open(rxfilename, 'rb') as infile:
+            header = audio_utils.readWavHeader(infile)
+            if header is None:
+                raise IOError('Not a wav file: ' + rxfilename)
+            fmt, data = header[0], infile.read(header[1])
+    block_align = audio_utils.wavFormat(fmt)[3]
+    if not block_align:
+        raise IOError('Invalid wav header in ' + rxfilename)
+    return fmt, data[:len(data) - len(data) % block_align]
+
+def writeIndex(index_file, entries):
+    '''Writes the (key, archive, offset, size) entries to an index file'''
+    with io.open(index_file + '.tmp', 'w', encoding='utf-8', errors='surrogateescape') as outfile:
+        for key, archive, offset, size in entries:
+            outfile.write(key + ' ' + archive + ' ' + str(offset) + ' ' + str(size) + '\n')
+    os.replace(index_file + '.tmp', index_file)
+
+def readIndex(index_file):
+    '''{key: (archive, offset, size)} of an index file'''
+    index = {}
+    with io.open(index_file, 'r', encoding='utf-8', errors='surrogateescape') as infile:
+        for line in infile:
+            split = line.split()
+            if len(split) == 4:
+                index[split[0]] = (split[1], int(split[2]), int(split[3]))
+    return index
+
+class ArchiveReader:
+    '''Reads entries of sharded archives by key through their index, every shard is opened and memory mapped once'''
+
+    def __init__(self, index_file):
+        self.index = readIndex(index_file)
+        self.shards = {}
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def keys(self):
+        return self.index.keys()
+
+    def shard(self, archive):
+        if archive not in self.shards:
+            with open(archive, 'rb') as archive_file:
+                self.shards[archive] = mmap.mmap(archive_file.fileno(), 0, access=mmap.ACCESS_READ)
+        return self.shards[archive]
+
+    def readBytes(self, key):
+        '''The wav file of key, as bytes'''
+        archive, offset, size = self.index[key]
+        return self.shard(archive)[offset:offset + size]
+
+    def read(self, key):
+        '''(fmt chunk, samples) of key'''
+        return readArchiveWav(io.BytesIO(self.readBytes(key)), 0)
+
+    def close(self):
+        for shard in self.shards.values():
+            shard.close()
+        self.shards = {}
+
+def packShard(task):
+    '''Writes the (key, rxfilename) entries of one shard into its archive (in a worker process), returns [(key, offset, size)] and
+       the (key, reason) of the entries that failed'''
+    archive_file, entries = task
+    writer = ArchiveWriter(archive_file + '.tmp', archive_file)
+    failed = []
+    try:
+        for key, rxfilename in entries:
+            try:
+                fmt, data = readAudio(rxfilename)
+            except (IOError, OSError) as err:
+                failed.append((key, str(err)))
+                continue
+            writer.add(key, fmt, data)
+    finally:
+        writer.close()
+    return writer.entries, failed
+
+def isPacked(entries, archive_dir):
+    '''True if the index of archive_dir exists and the (key, rxfilename) entries of a wav.scp point into its shards'''
+    if not os.path.exists(os.path.join(archive_dir, index_name)):
+        return False
+    archive_files = set([archive for archive, offset, size in readIndex(os.path.join(archive_dir, index_name)).values()])
+    return any([(audio_utils.parseOffsetRxfilename(rxfilename) or ('', 0))[0] in archive_files for key, rxfilename in entries])
+
+def packDataDir(data_dir, archive_dir, jobs=1, shard_entries=default_shard_entries, force=False):
+    '''Packs the audio of the wav.scp of data_dir into shards in archive_dir, rewrites the wav.scp and writes the index. Returns the
+       number of entries that failed, they keep their old wav.scp entries. A wav.scp that already points into archive_dir is not
+       packed again, unless force is set.'''
+    wav_scp = os.path.join(data_dir, 'wav.scp')
+    entries = audio_utils.readScp(wav_scp)
+    if not force and isPacked(entries, archive_dir):
+        print(wav_scp, 'already points into the archives in', archive_dir + ', not packing it again.')
+        return 0
+    os.makedirs(archive_dir, exist_ok=True)
+    name = os.path.basename(os.path.normpath(data_dir))
+    shards = [entries[i:i + shard_entries] for i in range(0, len(entries), shard_entries)]
+    tasks = [(os.path.join(archive_dir, name + '.' + str(i + 1) + '.ark'), shard) for i, shard in enumerate(shards)]
+    print('Packing', len(entries), 'entries of', wav_scp, 'into', len(tasks), 'shards in', archive_dir, 'with', jobs, 'processes')
+    with Pool(processes=max(1, jobs)) as pool:
+        results = pool.map(packShard, tasks, chunksize=1)
+
+    # the shards are written to temporary files, so that a wav.scp that already points at them can be packed again
+    index, failed = [], []
+    for (archive_file, shard), (written, shard_failed) in zip(tasks, results):
+        os.replace(archive_file + '.tmp', archive_file)
+        index += [(key, archive_file, offset, size) for key, offset, size in written]
+        failed += shard_failed
+    for key, reason in failed[:20]:
+        print('Warning, could not pack', key + ':', reason)
+    writeIndex(os.path.join(archive_dir, index_name), index)
+
+    archive_files = set([archive_file for archive_file, shard in tasks])
+    # shards of an earlier run with more entries
+    for filename in os.listdir(archive_dir):
+        if filename.startswith(name + '.') and filename.endswith('.ark') and os.path.join(archive_dir, filename) not in archive_files:
+            os.remove(os.path.join(archive_dir, filename))
+    if not any([(audio_utils.parseOffsetRxfilename(rxfilename) or ('', 0))[0] in archive_files for key, rxfilename in entries]):
+        with io.open(wav_scp + '.orig', 'w', encoding='utf-8', errors='surrogateescape') as outfile:
+            for key, rxfilename in entries:
+                outfile.write(key + ' ' + rxfilename + '\n')
+    offsets = dict([(key, offsetRxfilename(archive_file, offset)) for key, archive_file, offset, size in index])
+    with io.open(wav_scp + '.tmp', 'w', encoding='utf-8', errors='surrogateescape') as outfile:
+        for key, rxfilename in entries:
+            outfile.write(key + ' ' + offsets.get(key, rxfilename) + '\n')
+    os.replace(wav_scp + '.tmp', wav_scp)
+    return len(failed)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Packs the audio of a data dir into sharded audio archives (Kaldi wave archives) with an index and rewrites its wav.scp to point at them.')
+    parser.add_argument('data_dir', help='Kaldi data dir', type=str)
+    parser.add_argument('archive_dir', help='Directory for the shards and the index', type=str)
+    parser.add_argument('-j', '--jobs', dest='jobs', help='Number of processes', type=int, default=4)
+    parser.add_argument('--force', dest='force', help='Pack the data dir again, also if its wav.scp already points into archive_dir', action='store_true', default=False)
+    parser.add_argument('--shard-entries', dest='shard_entries', help='Number of wav.scp entries per shard', type=int, default=default_shard_entries)
+
+    args = parser.parse_args()
+
+    failed = packDataDir(args.data_dir, args.archive_dir, args.jobs, args.shard_entries, args.force)
+    if failed > 0:
+        print('Warning,', failed, 'entries could not be packed, they keep their old wav.scp entries.', file=sys.stderr)
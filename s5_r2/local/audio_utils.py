@@ -0,0 +1,483 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2022 Language Technology, Universitaet Hamburg (author: Benjamin Milde)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import print_function
+
+import argparse
+import io
+import os
+import shlex
+import struct
+import subprocess
+import sys
+
+from concurrent.futures import ThreadPoolExecutor
+
+#
+# Audio helpers for Kaldi data dirs. The duration of a wav.scp entry is read from the file headers (RIFF/WAV, FLAC, Ogg Vorbis/Opus/FLAC,
+# MP3 and NIST SPHERE) without decoding the audio. For "sox ... - |" and "sph2pipe ... |" commands the input files are taken from the
+# command line (sox concatenates several input files), for "archive:offset" entries (see audio_archive.py) the wav header at the
+# offset is read. Entries that can't be resolved from the headers (other commands, sox effects that change the duration like speed,
+# unknown formats) are decoded like wav-to-duration --read-entire-file does.
+#
+# Writes utt2dur/reco2dur for a wav.scp, in the order of the wav.scp (see local/get_utt2dur.sh):
+#   python3 local/audio_utils.py -j 16 data/swc_train/wav.scp data/swc_train/utt2dur
+#
+
+# sox options that take an argument
+sox_options_with_argument = set(['-t', '--type', '-r', '--rate', '-b', '--bits', '-e', '--encoding', '-c', '--channels', '-C', '--compression',
+                                 '-v', '--volume', '--comment', '--add-comment', '--comment-file', '--buffer', '--input-buffer', '--plot',
+                                 '--replay-gain', '--effects-file', '--temp', '--clobber-mode', '--endian'])
+
+# sox options that mix or merge the input files instead of concatenating them
+sox_combine_options = set(['-m', '-M', '-T', '--combine'])
+
+# sox effects that don't change the duration
+sox_duration_preserving_effects = set(['remix', 'channels', 'rate', 'gain', 'vol', 'norm', 'dither', 'highpass', 'lowpass', 'sinc', 'dcshift'])
+
+# exclusion list of scan_audio.py, the prepare scripts skip the files and utterances in it (option --exclude)
+audio_exclude_default_file = 'data/local/audio_exclude.txt'
+
+mp3_bitrates = {(1, 1): [0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448],
+                (1, 2): [0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384],
+                (1, 3): [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320],
+                (2, 1): [0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256],
+                (2, 2): [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+                (2, 3): [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160]}
+mp3_sample_rates = {1: [44100, 48000, 32000], 2: [22050, 24000, 16000], 25: [11025, 12000, 8000]}
+
+def wavInfo(f, file_size):
+    '''(sample rate, number of frames) of a RIFF/WAV file, None if it can't be read from the header'''
+    header = f.read(12)
+    if len(header) < 12 or header[0:4] != b'RIFF' or header[8:12] != b'WAVE':
+        return None
+    sample_rate, block_align = None, None
+    pos = 12
+    while pos + 8 <= file_size:
+        f.seek(pos)
+        chunk_id, chunk_size = struct.unpack('<4sI', f.read(8))
+        if chunk_id == b'fmt ':
+            fmt = f.read(16)
+            if len(fmt) < 16:
+                return None
+            channels, sample_rate, byte_rate, block_align = struct.unpack('<HIIH', fmt[2:14])
+        elif chunk_id == b'data':
+            if sample_rate is None or block_align == 0 or sample_rate == 0:
+                return None
+            # streamed wav files (e.g. written by sox to a pipe) don't have the correct size in the header
+            if chunk_size == 0 or chunk_size > file_size - pos - 8:
+                chunk_size = file_size - pos - 8
+            return sample_rate, chunk_size // block_align
+        # chunks are padded to an even size
+        pos += 8 + chunk_size + (chunk_size & 1)
+    return None
+
+def flacStreamInfo(data):
+    '''(sample rate, total samples) from the 34 byte FLAC STREAMINFO block, None if the number of samples is unknown'''
+    bits = struct.unpack('>Q', data[10:18])[0]
+    sample_rate = bits >> 44
+    total_samples = bits & 0xFFFFFFFFF
+    if sample_rate == 0 or total_samples == 0:
+        return None
+    return sample_rate, total_samples
+
+def skipID3v2(f):
+    '''Skips an ID3v2 tag at the start of the file (MP3 and FLAC files can have one), returns the position after it'''
+    f.seek(0)
+    header = f.read(10)
+    if len(header) == 10 and header[0:3] == b'ID3':
+        size = (header[6] & 0x7F) << 21 | (header[7] & 0x7F) << 14 | (header[8] & 0x7F) << 7 | (header[9] & 0x7F)
+        return 10 + size + (10 if header[5] & 0x10 else 0)
+    return 0
+
+def flacInfo(f, file_size):
+    f.seek(skipID3v2(f))
+    header = f.read(8)
+    # STREAMINFO is always the first metadata block
+    if len(header) < 8 or header[0:4] != b'fLaC' or header[4] & 0x7F != 0:
+        return None
+    data = f.read(34)
+    if len(data) < 34:
+        return None
+    return flacStreamInfo(data)
+
+def oggPage(data, pos):
+    '''(granule position, serial, offset of the page data, segment table) of the Ogg page at pos, None if there is no valid page'''
+    if len(data) < pos + 27 or data[pos:pos+4] != b'OggS' or data[pos+4] != 0:
+        return None
+    granule, serial = struct.unpack('<qI', data[pos+6:pos+18])
+    num_segments = data[pos+26]
+    if len(data) < pos + 27 + num_segments:
+        return None
+    return granule, serial, pos + 27 + num_segments, data[pos+27:pos+27+num_segments]
+
+def oggInfo(f, file_size):
+    '''(sample rate, number of samples) of an Ogg Vorbis, Opus or FLAC stream: the granule position of the last page'''
+    data = f.read(4096)
+    page = oggPage(data, 0)
+    if page is None:
+        return None
+    granule, serial, start, segments = page
+    packet = data[start:]
+    pre_skip = 0
+    if packet[0:7] == b'\x01vorbis' and len(packet) >= 16:
+        sample_rate = struct.unpack('<I', packet[12:16])[0]
+    elif packet[0:8] == b'OpusHead' and len(packet) >= 12:
+        # opus granule positions are always in 48 kHz samples
+        sample_rate = 48000
+        pre_skip = struct.unpack('<H', packet[10:12])[0]
+    elif packet[0:5] == b'\x7fFLAC' and len(packet) >= 51 and packet[9:13] == b'fLaC':
+        stream_info = flacStreamInfo(packet[17:51])
+        if stream_info is None:
+            return None
+        return stream_info
+    else:
+        return None
+    if sample_rate == 0:
+        return None
+
+    # the last page of the stream (a page is at most 65307 bytes long)
+    tail_size = min(file_size, 65536 + 65307)
+    f.seek(file_size - tail_size)
+    tail = f.read(tail_size)
+    pos = tail.rfind(b'OggS')
+    while pos != -1:
+        page = oggPage(tail, pos)
+        if page is not None and page[1] == serial and page[0] >= 0:
+            return sample_rate, max(0, page[0] - pre_skip)
+        pos = tail.rfind(b'OggS', 0, pos)
+    return None
+
+def mp3FrameHeader(header):
+    '''(version, layer, bitrate in kbit/s, sample rate, padding, mono) of an MPEG audio frame header, None if it is not valid'''
+    if len(header) < 4 or header[0] != 0xFF or header[1] & 0xE0 != 0xE0:
+        return None
+    version = {3: 1, 2: 2, 0: 25}.get((header[1] >> 3) & 3)
+    layer = {3: 1, 2: 2, 1: 3}.get((header[1] >> 1) & 3)
+    bitrate_index = header[2] >> 4
+    sample_rate_index = (header[2] >> 2) & 3
+    if version is None or layer is None or bitrate_index in [0, 15] or sample_rate_index == 3:
+        return None
+    bitrate = mp3_bitrates[(min(version, 2), layer)][bitrate_index]
+    return version, layer, bitrate, mp3_sample_rates[version][sample_rate_index], (header[2] >> 1) & 1, (header[3] >> 6) == 3
+
+def mp3SamplesPerFrame(version, layer):
+    if layer == 1:
+        return 384
+    if layer == 3 and version != 1:
+        return 576
+    return 1152
+
+def mp3FrameLength(version, layer, bitrate, sample_rate, padding):
+    if layer == 1:
+        return (12 * bitrate * 1000 // sample_rate + padding) * 4
+    return mp3SamplesPerFrame(version, layer) // 8 * bitrate * 1000 // sample_rate + padding
+
+def mp3Info(f, file_size):
+    '''(sample rate, number of samples) of an MP3 file: from the Xing/Info or VBRI header, or estimated from the bitrate for CBR files'''
+    start = skipID3v2(f)
+    f.seek(start)
+    data = f.read(65536)
+    # look for two consecutive frame headers, to avoid false syncs
+    pos = 0
+    while pos + 4 <= len(data):
+        pos = data.find(b'\xff', pos)
+        if pos == -1:
+            return None
+        frame = mp3FrameHeader(data[pos:pos+4])
+        if frame is not None:
+            version, layer, bitrate, sample_rate, padding, mono = frame
+            length = mp3FrameLength(version, layer, bitrate, sample_rate, padding)
+            if mp3FrameHeader(data[pos+length:pos+length+4]) is not None or start + pos + length == file_size:
+                break
+        pos += 1
+    else:
+        return None
+
+    samples_per_frame = mp3SamplesPerFrame(version, layer)
+    side_info = (17 if mono else 32) if version == 1 else (9 if mono else 17)
+    xing = data[pos+4+side_info:pos+4+side_info+12]
+    if xing[0:4] in [b'Xing', b'Info'] and len(xing) == 12 and struct.unpack('>I', xing[4:8])[0] & 1:
+        return sample_rate, struct.unpack('>I', xing[8:12])[0] * samples_per_frame
+    vbri = data[pos+36:pos+36+18]
+    if vbri[0:4] == b'VBRI' and len(vbri) == 18:
+        return sample_rate, struct.unpack('>I', vbri[14:18])[0] * samples_per_frame
+
+    # CBR: audio bytes / frame length
+    audio_bytes = file_size - start - pos
+    f.seek(file_size - 128)
+    if file_size - start - pos >= 128 and f.read(3) == b'TAG':
+        audio_bytes -= 128
+    return sample_rate, int(audio_bytes * 8 * sample_rate // (bitrate * 1000))
+
+def sphereInfo(f, file_size):
+    '''(sample rate, sample count) from a NIST SPHERE header'''
+    header = f.read(1024)
+    if not header.startswith(b'NIST_1A'):
+        return None
+    sample_rate, sample_count = None, None
+    for line in header.split(b'\n')[:32]:
+        fields = line.split()
+        if len(fields) == 3 and fields[1] == b'-i':
+            if fields[0] == b'sample_rate':
+                sample_rate = int(fields[2])
+            elif fields[0] == b'sample_count':
+                sample_count = int(fields[2])
+        if line.startswith(b'end_head'):
+            break
+    if not sample_rate or sample_count is None:
+        return None
+    return sample_rate, sample_count
+
+def audioInfo(filename):
+    '''(sample rate, number of samples) of an audio file from its headers, None if the format is not supported'''
+    try:
+        with open(filename, 'rb') as f:
+            file_size = os.fstat(f.fileno()).st_size
+            magic = f.read(4)
+            f.seek(0)
+            if magic == b'RIFF':
+                return wavInfo(f, file_size)
+            elif magic == b'OggS':
+                return oggInfo(f, file_size)
+            elif magic == b'NIST':
+                return sphereInfo(f, file_size)
+            elif magic == b'fLaC':
+                return flacInfo(f, file_size)
+            elif magic[0:3] == b'ID3':
+                # MP3, or FLAC with an ID3 tag
+                return flacInfo(f, file_size) or mp3Info(f, file_size)
+            return mp3Info(f, file_size)
+    except (IOError, OSError, struct.error):
+        return None
+
+def audioDuration(filename):
+    '''Duration in seconds of an audio file from its headers, None if the format is not supported'''
+    info = audioInfo(filename)
+    if info is None:
+        return None
+    return float(info[1]) / info[0]
+
+def soxInputFiles(args):
+    '''Input files of a sox command line (without "sox"), None if the output is not just a conversion of the concatenated inputs'''
+    files = []
+    i = 0
+    while i < len(args):
+        arg = args[i]
+        i += 1
+        if arg in sox_combine_options or arg.startswith('--combine='):
+            return None
+        if arg in sox_options_with_argument:
+            i += 1
+        elif arg == '-':
+            # the output file, it has to be stdout for Kaldi pipes. Effects and their parameters follow.
+            for effect in args[i:]:
+                if effect not in sox_duration_preserving_effects and not effect[0].isdigit() and not effect.startswith('-'):
+                    return None
+            if len(files) == 0 or '-n' in files:
+                return None
+            return files
+        elif not arg.startswith('-'):
+            files.append(arg)
+        elif arg == '-n':
+            files.append(arg)
+    return None
+
+def parseOffsetRxfilename(rxfilename):
+    '''(file name, offset) of an "archive:offset" wav.scp entry (see audio_archive.py), None if it is something else'''
+    split = rxfilename.strip().rsplit(':', 1)
+    if len(split) != 2 or not split[1].isdigit() or split[0].endswith('|'):
+        return None
+    return split[0], int(split[1])
+
+def offsetDuration(rxfilename):
+    '''Duration of an "archive:offset" entry from the wav header at the offset, None if it is something else'''
+    offset_rxfilename = parseOffsetRxfilename(rxfilename)
+    if offset_rxfilename is None or os.path.exists(rxfilename.strip()) or not os.path.isfile(offset_rxfilename[0]):
+        return None
+    try:
+        with open(offset_rxfilename[0], 'rb') as archive:
+            archive.seek(offset_rxfilename[1])
+            header = readWavHeader(archive)
+    except (IOError, OSError):
+        return None
+    if header is None:
+        return None
+    sample_rate, channels, bits, block_align = wavFormat(header[0])
+    if not sample_rate or not block_align:
+        return None
+    return float(header[1] // block_align) / sample_rate
+
+def inputFiles(rxfilename):
+    '''Audio files that a wav.scp entry (file name or command ending with |) reads, None if they can't be determined'''
+    rxfilename = rxfilename.strip()
+    if not rxfilename.endswith('|'):
+        return [rxfilename]
+    try:
+        args = shlex.split(rxfilename[:-1])
+    except ValueError:
+        return None
+    if len(args) == 0:
+        return None
+    program = os.path.basename(args[0])
+    if program == 'sox':
+        return soxInputFiles(args[1:])
+    if program == 'sph2pipe' and len(args) >= 2:
+        # sph2pipe [-f wav] [-p] [-c 1] file
+        if not any([arg in ['-t', '-s'] for arg in args[1:]]):
+            return [args[-1]]
+    return None
+
+def headerDuration(rxfilename):
+    '''Duration of a wav.scp entry from the headers of its input files, None if that is not possible'''
+    files = inputFiles(rxfilename)
+    if files is None:
+        return None
+    duration = 0.0
+    for filename in files:
+        file_duration = audioDuration(filename)
+        if file_duration is None:
+            return None
+        duration += file_duration
+    return duration
+
+def readWavHeader(stream):
+    '''Reads the RIFF/WAV header of a stream up to the start of the data chunk, returns (fmt chunk, size of the data chunk in the
+       header), None if it is not a wav stream. The size is not reliable for streams that were written to a pipe.'''
+    header = stream.read(12)
+    if len(header) < 12 or header[0:4] != b'RIFF' or header[8:12] != b'WAVE':
+        return None
+    fmt = None
+    while True:
+        chunk_header = stream.read(8)
+        if len(chunk_header) < 8:
+            return None
+        chunk_id, chunk_size = struct.unpack('<4sI', chunk_header)
+        if chunk_id == b'data':
+            return (fmt, chunk_size) if fmt is not None else None
+        chunk = stream.read(chunk_size + (chunk_size & 1))
+        if chunk_id == b'fmt ' and len(chunk) >= 16:
+            fmt = chunk[:chunk_size]
+
+def wavFormat(fmt):
+    '''(sample rate, channels, bits per sample, block align) of a fmt chunk'''
+    channels, sample_rate = struct.unpack('<HI', fmt[2:8])
+    block_align, bits = struct.unpack('<HH', fmt[12:16])
+    return sample_rate, channels, bits, block_align
+
+def wavHeader(fmt, data_size):
+    '''RIFF/WAV header with the fmt chunk fmt for data_size bytes of samples'''
+    fmt_chunk = b'fmt ' + struct.pack('<I', len(fmt)) + fmt + (b'\x00' if len(fmt) & 1 else b'')
+    return (b'RIFF' + struct.pack('<I', 4 + len(fmt_chunk) + 8 + data_size + (data_size & 1)) + b'WAVE' + fmt_chunk
+            + b'data' + struct.pack('<I', data_size))
+
+def readWavStream(stream):
+    '''Duration of a wav stream, counting all samples until the end of the stream (the size in the header is ignored)'''
+    header = readWavHeader(stream)
+    if header is None:
+        return None
+    sample_rate, channels, bits, block_align = wavFormat(header[0])
+    if not sample_rate or not block_align:
+        return None
+    data_size = 0
+    for block in iter(lambda: stream.read(1 << 20), b''):
+        data_size += len(block)
+    return float(data_size // block_align) / sample_rate
+
+def decodeDuration(rxfilename):
+    '''Duration of a wav.scp entry by reading the entire wav stream (like wav-to-duration --read-entire-file), None on errors'''
+    rxfilename = rxfilename.strip()
+    if not rxfilename.endswith('|'):
+        try:
+            with open(rxfilename, 'rb') as stream:
+                return readWavStream(stream)
+        except (IOError, OSError):
+            return None
+    proc = subprocess.Popen(rxfilename[:-1], shell=True, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    duration = readWavStream(proc.stdout)
+    # read the rest of the output, so that the command doesn't block
+    for block in iter(lambda: proc.stdout.read(1 << 20), b''):
+        pass
+    proc.stdout.close()
+    if proc.wait() != 0:
+        return None
+    return duration
+
+def probeDuration(rxfilename):
+    '''(duration, True if it was read from the headers) of a wav.scp entry, duration is None if it could not be determined'''
+    duration = offsetDuration(rxfilename)
+    if duration is None:
+        duration = headerDuration(rxfilename)
+    if duration is not None:
+        return duration, True
+    return decodeDuration(rxfilename), False
+
+def readScp(filename):
+    '''(key, value) pairs of a Kaldi scp file, in file order'''
+    entries = []
+    with io.open(filename, 'r', encoding='utf-8', errors='surrogateescape') as infile:
+        for line in infile:
+            split = line.strip().split(None, 1)
+            if len(split) == 2:
+                entries.append((split[0], split[1]))
+            elif len(split) == 1:
+                print('Warning, empty entry for', split[0], 'in', filename, file=sys.stderr)
+    return entries
+
+def readExclusionList(filename):
+    '''{kind: set of ids} of an exclusion list written by local/scan_audio.py (kinds: file, recording, utterance). Lines are
+       "kind id reasons data_dir", a list that doesn't exist is empty.'''
+    exclusions = {'file': set(), 'recording': set(), 'utterance': set()}
+    if filename == '' or not os.path.exists(filename):
+        return exclusions
+    with io.open(filename, 'r', encoding='utf-8', errors='surrogateescape') as infile:
+        for line in infile:
+            split = line.split()
+            if len(split) >= 2 and not split[0].startswith('#'):
+                exclusions.setdefault(split[0], set()).add(split[1])
+    return exclusions
+
+def isExcluded(exclusions, key, files=[]):
+    '''True if the utterance or recording key or one of its audio files is in the exclusion list'''
+    return (key in exclusions['utterance'] or key in exclusions['recording']
+            or any([os.path.normpath(filename) in exclusions['file'] for filename in files]))
+
+def probeDurations(entries, jobs=16):
+    '''Probes the durations of (key, rxfilename) pairs with a pool of threads, returns (key, duration, from header) in the same order'''
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+        results = list(executor.map(probeDuration, [rxfilename for key, rxfilename in entries]))
+    return [(key, duration, from_header) for (key, rxfilename), (duration, from_header) in zip(entries, results)]
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Writes the durations of the entries of a wav.scp (utt2dur/reco2dur), reading only the audio file headers where possible.')
+    parser.add_argument('wav_scp', help='wav.scp of a Kaldi data dir', type=str)
+    parser.add_argument('output', help='Output file (utt2dur or reco2dur)', type=str)
+    parser.add_argument('-j', '--jobs', dest='jobs', help='Number of threads', type=int, default=16)
+
+    args = parser.parse_args()
+
+    results = probeDurations(readScp(args.wav_scp), args.jobs)
+    failed = [key for key, duration, from_header in results if duration is None]
+    with io.open(args.output, 'w', encoding='utf-8', errors='surrogateescape') as outfile:
+        for key, duration, from_header in results:
+            if duration is not None:
+                outfile.write(key + ' ' + repr(round(duration, 6)) + '\n')
+
+    decoded = len([key for key, duration, from_header in results if duration is not None and not from_header])
+    print('Durations of', len(results) - len(failed), 'of', len(results), 'entries,', decoded, 'of them by decoding the audio.')
+    if len(failed) > 0:
+        print('Warning, could not get the duration of', len(failed), 'entries:', ' '.join(failed[:20]) + (' ...' if len(failed) > 20 else ''), file=sys.stderr)
+        sys.exit(1)
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2022 Language Technology, Universitaet Hamburg (author: Benjamin Milde)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import print_function
+
+import argparse
+import build_big_lexicon
+import io
+import os
+import sys
+import time
+
+from contextlib import redirect_stdout
+
+#
+# Micro benchmark for build_big_lexicon.BASpron_to_list: compares the compiled tokenizer with the old implementation (kept here as
+# legacyBASpron_to_list) on the pron strings of one or more lexicon files. Both have to produce identical pron lists and warnings.
+#
+# python3 local/benchmark_bas_pron.py -f local/de_extra_lexicon.txt data/lexicon/LEXICON.TBL
+#
+
+BAS_German_set = build_big_lexicon.BAS_German_set
+BAS_German_trans = build_big_lexicon.BAS_German_trans
+
+def legacyBASpron_to_list(pron,word=''):
+    '''takes a BAS pron string and turns it into a list of phoneme tokens'''
+    orig_pron = pron
+
+    for orig,rep in BAS_German_trans.items():
+        pron = pron.replace(orig,rep)
+
+    def consume(symbols, string):
+        for symbol in symbols:
+            if string.startswith(symbol):
+                #could consume symbol
+                return True,symbol,string[len(symbol):]
+        #no symbol matches start of string
+        return False,'',string
+
+    symbol_sets = [BAS_German_set['silence'],BAS_German_set['primary'],BAS_German_set['items']]
+
+    pron_list = []
+
+    while len(pron) > 0:
+        consumed_any = False
+        for symbols in symbol_sets:
+            consumed,symbol,pron = consume(symbols, pron)
+            if consumed:
+                consumed_any = True
+                pron_list.append(symbol)
+                break
+        if not consumed_any:
+            #try ignore list
+            consumed,symbol,pron = consume(BAS_German_set['ignore'], pron)
+            if not consumed:
+                print('Warning, omitting unkown symbol',pron[0],' in pronounciation list:',orig_pron,'word:',word)
+                pron = pron[1:]
+    return pron_list
+
+def loadProns(filename):
+    '''(word, pron string) pairs of a lexicon file, either word<tab>freq<tab>pron or word followed by (possibly segmented) phonemes'''
+    prons = []
+    with io.open(filename,'r',encoding='utf-8') as lexicon:
+        for line in lexicon:
+            line = line.rstrip('\r\n')
+            if line.startswith('#') or line == '':
+                continue
+            split = line.split('\t')
+            if len(split) == 3:
+                prons.append((split[0],split[2]))
+            else:
+                split = line.split()
+                if len(split) >= 2:
+                    prons.append((split[0],''.join(split[1:])))
+    return prons
+
+def timeParser(parser,prons,repeat):
+    '''Returns the best run time, the parsed prons and the printed warnings'''
+    best = None
+    for i in range(repeat):
+        build_big_lexicon.bas_pron_cache.clear()
+        warnings = io.StringIO()
+        start = time.time()
+        with redirect_stdout(warnings):
+            parsed = [parser(pron,word) for word,pron in prons]
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best,parsed,warnings.getvalue()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks the BAS pron parser of build_big_lexicon.py against the old implementation.')
+    parser.add_argument('-f', '--files', dest='files', help='Lexicon files to take the pron strings from', nargs='+', default=[os.path.join(os.path.dirname(os.path.abspath(__file__)),'de_extra_lexicon.txt')])
+    parser.add_argument('-r', '--repeat', dest='repeat', help='Report the best of n runs', type=int, default=3)
+
+    args = parser.parse_args()
+
+    prons = []
+    for filename in args.files:
+        prons += loadProns(filename)
+    print('Loaded',len(prons),'pron strings,',len(set([pron for word,pron in prons])),'distinct.')
+
+    legacy_time,legacy_parsed,legacy_warnings = timeParser(legacyBASpron_to_list,prons,args.repeat)
+    new_time,new_parsed,new_warnings = timeParser(build_big_lexicon.BASpron_to_list,prons,args.repeat)
+
+    if legacy_parsed != new_parsed or legacy_warnings != new_warnings:
+        for (word,pron),legacy,new in zip(prons,legacy_parsed,new_parsed):
+            if legacy != new:
+                print('Mismatch for',word,pron,':',legacy,'!=',new)
+        if legacy_warnings != new_warnings:
+            print('Warnings differ.')
+        sys.exit(1)
+
+    # second pass with warm cache, prons repeat a lot between lexicons
+    warm_start = time.time()
+    with redirect_stdout(io.StringIO()):
+        for word,pron in prons:
+            build_big_lexicon.BASpron_to_list(pron,word)
+    warm_time = time.time() - warm_start
+
+    print('Outputs are identical (%d prons, %d warning lines).' % (len(prons), legacy_warnings.count('\n')))
+    print('legacy:           %8.3fs %10.0f prons/s' % (legacy_time, len(prons)/max(legacy_time,1e-9)))
+    print('compiled:         %8.3fs %10.0f prons/s, speedup %.1fx' % (new_time, len(prons)/max(new_time,1e-9), legacy_time/max(new_time,1e-9)))
+    print('compiled, cached: %8.3fs %10.0f prons/s, speedup %.1fx' % (warm_time, len(prons)/max(warm_time,1e-9), legacy_time/max(warm_time,1e-9)))
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2022 Language Technology, Universitaet Hamburg (author: Benjamin Milde)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import print_function
+
+import argparse
+import common_utils
+import fake_maryserver
+import io
+import json
+import os
+import sys
+import time
+
+#
+# Checks the MARY PHONEMES parser of common_utils (parseMaryPhonemes) against a golden set of MARY responses (mary_phonemes_golden.json,
+# the expected output is written by make_mary_phonemes_golden.py with the old BeautifulSoup parser)
+# and measures its throughput. If BeautifulSoup is installed, the old parser is checked and timed as well. Additional documents can be
+# generated from a corpus file (one sentence per line) with the fake MARY server:
+#
+# python3 local/benchmark_mary_parser.py -c data/local/lm/sentences.txt -n 20000
+#
+
+def timeParser(parser, documents):
+    start = time.time()
+    for maryxml in documents:
+        parser(maryxml)
+    return time.time() - start
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Checks and benchmarks the MARY PHONEMES xml parser of common_utils.py.')
+    parser.add_argument('-g', '--golden', dest='golden', help='Golden set of MARY responses with expected tokens and phonemes', type=str, default=os.path.join(os.path.dirname(os.path.abspath(__file__)),'mary_phonemes_golden.json'))
+    parser.add_argument('-c', '--corpus', dest='corpus', help='Also benchmark with fake MARY responses for the sentences of this corpus file', type=str, default='')
+    parser.add_argument('-n', '--num-docs', dest='num_docs', help='Number of documents to parse in the benchmark', type=int, default=20000)
+
+    args = parser.parse_args()
+
+    try:
+        import bs4
+        have_bs4 = bs4.BeautifulSoup is not None
+    except ImportError:
+        have_bs4 = False
+
+    with io.open(args.golden, 'r', encoding='utf-8') as golden_file:
+        golden = json.load(golden_file)
+
+    parsers = [('expat', common_utils.parseMaryPhonemes)]
+    if have_bs4:
+        parsers.append(('BeautifulSoup', common_utils.legacyParseMaryPhonemes))
+    else:
+        print('BeautifulSoup is not installed, only checking the new parser against the golden set.')
+
+    failed = 0
+    for name, parse in parsers:
+        for case in golden:
+            tokens, phonemes = parse(case['maryxml'])
+            if list(tokens) != case['tokens'] or list(phonemes) != case['phonemes']:
+                print(name, 'mismatch for', case['sentence'], ':', tokens, phonemes, 'expected:', case['tokens'], case['phonemes'])
+                failed += 1
+    if failed > 0:
+        sys.exit(1)
+    print('All', len(golden), 'golden set documents parsed correctly.')
+
+    documents = [case['maryxml'] for case in golden]
+    if args.corpus != '':
+        with io.open(args.corpus, 'r', encoding='utf-8') as corpus:
+            for line in corpus:
+                documents.append(fake_maryserver.phonemes_xml(line.strip(), 'de'))
+                if len(documents) >= args.num_docs:
+                    break
+    documents = (documents * (args.num_docs // len(documents) + 1))[:args.num_docs]
+    size = sum([len(maryxml) for maryxml in documents])
+
+    print('Parsing', len(documents), 'documents (%.1f MB):' % (size / 1024.0 / 1024.0))
+    times = {}
+    for name, parse in parsers:
+        times[name] = timeParser(parse, documents)
+        print('%-14s %8.3fs %10.0f docs/s' % (name, times[name], len(documents) / max(times[name], 1e-9)))
+    if have_bs4:
+        print('speedup %.1fx' % (times['BeautifulSoup'] / max(times['expat'], 1e-9)))
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2022 Language Technology, Universitaet Hamburg (author: Benjamin Milde)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import print_function
+
+import argparse
+import io
+import sys
+import text_normalizer
+import time
+
+#
+# Checks the batched normalization of text_normalizer.BatchNormalizer (preprocess, nlp.pipe, postprocess) against
+# normalize_sentences.normalize with the full spaCy pipeline on a sample of a corpus and measures the throughput of both. The corpus
+# is a file with one sentence per line, or a Kaldi text file with -k:
+#
+# python3 local/benchmark_text_normalizer.py -k data/tuda_train/text -n 5000
+#
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Checks and benchmarks the batched text normalization of text_normalizer.py.')
+    parser.add_argument('corpus', help='Corpus file with one sentence per line', type=str)
+    parser.add_argument('-k', '--kaldi-text', dest='kaldi_text', help='The corpus is a Kaldi text file (the first field is the utterance id)', action='store_true', default=False)
+    parser.add_argument('-n', '--num-texts', dest='num_texts', help='Number of texts to normalize', type=int, default=5000)
+    parser.add_argument('-b', '--batch-size', dest='batch_size', help='Batch size for the spaCy pipeline (nlp.pipe)', type=int, default=256)
+    parser.add_argument('--n-process', dest='n_process', help='Number of processes for the spaCy pipeline', type=int, default=1)
+    parser.add_argument('--disable', dest='disable', help='Comma separated spaCy pipeline components to disable', type=str, default=','.join(text_normalizer.default_disable))
+
+    args = parser.parse_args()
+
+    texts = []
+    with io.open(args.corpus, 'r', encoding='utf-8') as corpus:
+        for line in corpus:
+            text = line.split(None, 1)[1] if args.kaldi_text and len(line.split(None, 1)) > 1 else line
+            if text.strip() != '':
+                texts.append(text.strip())
+            if len(texts) >= args.num_texts:
+                break
+
+    nlp = text_normalizer.loadSpacy()
+    # check_texts=0: the results are compared with normalize() here, not by the normalizer itself
+    normalizer = text_normalizer.BatchNormalizer(nlp, args.batch_size, args.n_process, [name for name in args.disable.split(',') if name != ''], check_texts=0)
+
+    print('Normalizing', len(texts), 'texts:')
+    start = time.time()
+    batched = normalizer.normalize_many(texts)
+    batched_time = time.time() - start
+
+    start = time.time()
+    expected = []
+    for text in texts:
+        try:
+            expected.append(text_normalizer.normalizeText(nlp, text))
+        except Exception:
+            expected.append(None)
+    single_time = time.time() - start
+
+    for name, seconds in [('batched', batched_time), ('normalize()', single_time)]:
+        print('%-12s %8.3fs %10.0f texts/s' % (name, seconds, len(texts) / max(seconds, 1e-9)))
+    print('speedup %.1fx' % (single_time / max(batched_time, 1e-9)))
+
+    failed = 0
+    for text, result, expected_result in zip(texts, batched, expected):
+        if result != expected_result:
+            print('mismatch for', text, ':', result, 'expected:', expected_result)
+            failed += 1
+    if failed > 0:
+        print(failed, 'of', len(texts), 'texts are normalized differently.')
+        sys.exit(1)
+    print('All', len(texts), 'texts are normalized like normalize() does.')
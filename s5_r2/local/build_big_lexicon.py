@@ -18,18 +18,21 @@ from __future__ import print_function
 
 import argparse
 import common_utils
+import lexicon_store
 import io
+import os
 import traceback
 import datetime
 import sys
 import pickle
-from itertools import groupby
+import re
 
 from bs4 import BeautifulSoup
 
 import collections
 
 from functools import partial
+from multiprocessing import Pool
 
 # See http://www.bas.uni-muenchen.de/Bas/BasSAMPA for more infos on German pronounciation format. However not all files adhere 100% to this specification. Parsing is made a bit more challenging since there are units that have 2 or 3 characters, but the ponounciation string is not segmented. 
 
@@ -85,138 +88,170 @@ manual_freq = 100
 #UW0 AO0 AY0 EY0 OY0 UH0 ER0 AA0 IH0 AH0 OW0 AW0 AE0 IY0 EH0 
 #UW2 AO2 AY2 EY2 OY2 UH2 ER2 AA2 IH2 AH2 OW2 AW2 AE2 IY2 EH2 
 
-def BASpron_to_list(pron,word=''):
-    '''takes a BAS pron string and turns it into a list of phoneme tokens'''
-    orig_pron = pron
-
-    for orig,rep in BAS_German_trans.items():
-        pron = pron.replace(orig,rep)
-
-    def consume(symbols, string):
-        for symbol in symbols:
-            if string.startswith(symbol):
-                #could consume symbol
-                return True,symbol,string[len(symbol):]
-        #no symbol matches start of string
-        return False,'',string
-
+def buildBASTokenizer():
+    '''Compiles the pron parser into a single regex. The alternatives are tried in the same order as the symbol lists, so this is exactly the first match rule of the symbol lists (silence, primary, items, ignore). Any other character is an unknown symbol.'''
     #order in which symbols are consumed
     #symbol_sets = [BAS_German_set['silence'],BAS_German_set['primary'],BAS_German_set['secondary'],BAS_German_set['items']]
     symbol_sets = [BAS_German_set['silence'],BAS_German_set['primary'],BAS_German_set['items']]
+    symbols = [symbol for symbols in symbol_sets for symbol in symbols]
 
-    pron_list = []
+    # matched strings are mapped back to the symbol objects of the lists, the parsed prons share their phoneme strings
+    canonical = {}
+    for symbol in symbols:
+        canonical.setdefault(symbol, symbol)
 
-    while len(pron) > 0:
-        consumed_any = False
-        for symbols in symbol_sets:
-            consumed,symbol,pron = consume(symbols, pron)
-            if consumed:
-                consumed_any = True
-                pron_list.append(symbol)
-                break
-        if not consumed_any:
-            #try ignore list
-            consumed,symbol,pron = consume(BAS_German_set['ignore'], pron)
-            if not consumed:
-                print('Warning, omitting unkown symbol',pron[0],' in pronounciation list:',orig_pron,'word:',word)
-                pron = pron[1:]
-    return pron_list
+    tokenizer = re.compile('(' + '|'.join([re.escape(symbol) for symbol in symbols]) + ')|(' + '|'.join([re.escape(symbol) for symbol in BAS_German_set['ignore']]) + ')|(.)', re.DOTALL)
 
-def importSampa(myid, word_substitution_dict={}, withFreq=True, manual=False, delimiter='\t', presegmented=False):
-    '''Import sampa dictionary fileformat, each line has word and its main pronounciation. A variant of this format also includes frequencies'''
-    with io.open(myid,'r',encoding='utf-8') as inputFile:
-        myinput = inputFile.read().split('\n')
-        phoneme_dict = collections.defaultdict(list)
+    #applying the replacements one after another is the same as a single pass here, since no replacement creates a match for another one
+    trans = re.compile('|'.join([re.escape(orig) for orig in sorted(BAS_German_trans, key=len, reverse=True)]))
 
-        lineerror = False
-        no_lineerrors = 0
+    return tokenizer,trans,canonical
 
-        #file format is simple and we can process it line by line
-        for line in myinput:
-            #ignore comments and empty lines
-            if line.startswith('#') or len(line) == 0:
-                continue
-            if line[0].isdigit():
-                print('Info: Ignoring this line that starts with a number:',line)
-                continue
+bas_tokenizer,bas_trans,bas_canonical = buildBASTokenizer()
 
-            #remove carriage return, if it slipped into the line
-            line = line.replace('\r','')
-            split = line.split(delimiter)
+#Parsed prons (without warnings) of pron strings that we have already seen, the same pron strings occur over and over again in the lexicons
+bas_pron_cache = {}
+bas_pron_cache_max_size = 2000000
 
-            #parse word and frequency (if used) and pronounciation
-            word = ''
-            if withFreq: 
-                if (len(split)==3):
-                    if lineerror:
-                        print('Last',no_lineerrors,'lines had wrong format')
+def BASpron_to_list(pron,word=''):
+    '''takes a BAS pron string and turns it into a list of phoneme tokens'''
+    if pron in bas_pron_cache:
+        return list(bas_pron_cache[pron])
 
-                    no_lineerrors,lineerror = 0,False
-                    word,freq = split[0],split[1]
-                    
-                    pron_list = BASpron_to_list(split[2],word)
-                else:
-                    print('Encountered line with wrong format (doesnt have 3 elements)',line)
+    orig_pron = pron
+    pron = bas_trans.sub(lambda match: BAS_German_trans[match.group(0)], pron)
+
+    pron_list = []
+    has_unknown = False
+    for match in bas_tokenizer.finditer(pron):
+        symbol,ignored,unknown = match.groups()
+        if symbol is not None:
+            pron_list.append(bas_canonical[symbol])
+        elif unknown is not None:
+            print('Warning, omitting unkown symbol',unknown,' in pronounciation list:',orig_pron,'word:',word)
+            has_unknown = True
+
+    # prons with unknown symbols are not cached, so that every occurrence is reported with its word
+    if not has_unknown:
+        if len(bas_pron_cache) >= bas_pron_cache_max_size:
+            bas_pron_cache.clear()
+        bas_pron_cache[orig_pron] = pron_list
+        return list(pron_list)
+    return pron_list
+
+def readShard(myid, byte_range):
+    '''Lines of a file that start within byte_range=(start,end). Only this part of the file is read: both offsets are moved to the
+       start of the next line (the line that is cut at an offset belongs to the shard before), the lines are split like a full read.'''
+    offsets = []
+    with io.open(myid,'rb') as inputFile:
+        for offset in byte_range:
+            inputFile.seek(max(offset-1, 0))
+            if offset > 0:
+                inputFile.readline()
+            offsets.append(inputFile.tell())
+        inputFile.seek(offsets[0])
+        shard = inputFile.read(max(offsets[1]-offsets[0], 0))
+    return io.TextIOWrapper(io.BytesIO(shard), encoding='utf-8').read().split('\n')
+
+def importSampa(myid, word_substitution_dict={}, withFreq=True, manual=False, delimiter='\t', presegmented=False, byte_range=None):
+    '''Import sampa dictionary fileformat, each line has word and its main pronounciation. A variant of this format also includes frequencies.
+       If byte_range=(start,end) is set, only the lines that start in this part of the file are imported (as a shard of a large file).'''
+    if byte_range is not None:
+        myinput = readShard(myid, byte_range)
+    else:
+        with io.open(myid,'r',encoding='utf-8') as inputFile:
+            myinput = inputFile.read().split('\n')
+    phoneme_dict = collections.defaultdict(list)
+
+    lineerror = False
+    no_lineerrors = 0
+
+    #file format is simple and we can process it line by line
+    for line in myinput:
+        #ignore comments and empty lines
+        if line.startswith('#') or len(line) == 0:
+            continue
+        if line[0].isdigit():
+            print('Info: Ignoring this line that starts with a number:',line)
+            continue
+
+        #remove carriage return, if it slipped into the line
+        line = line.replace('\r','')
+        split = line.split(delimiter)
+
+        #parse word and frequency (if used) and pronounciation
+        word = ''
+        if withFreq: 
+            if (len(split)==3):
+                if lineerror:
+                    print('Last',no_lineerrors,'lines had wrong format')
+
+                no_lineerrors,lineerror = 0,False
+                word,freq = split[0],split[1]
+                
+                pron_list = BASpron_to_list(split[2],word)
             else:
-                if presegmented:
-                    if len(split) < 2:
-                        lineerror=True
-                        no_lineerrors+=1
-                    else:
-                        if lineerror:
-                            print('Last',no_lineerrors,'lines had wrong format')
-
-                        no_lineerrors,lineerror = 0,False                    
-                        word=split[0]
-                        freq=1
-                        if manual==True:
-                            freq = manual_freq
-
-                        # filter empty phones from presegmented list
-                        pron_list_manuel = [elem for elem in split[1:] if elem!='']
-
-                        # use parser to parse joined phoneme list, warn if there are differences
-                        pron_list_auto = BASpron_to_list(''.join(split[1:]),word)
-
-                        if pron_list_auto != pron_list_manuel:
-                            print("Warning: pron_list_auto != pron_list_manuel:", pron_list_auto, pron_list_manuel)
-                            print("pron_list_auto takes precedence:", word, pron_list_auto)
-
-                        pron_list = pron_list_auto
-                elif (len(split)==2):
+                print('Encountered line with wrong format (doesnt have 3 elements)',line)
+        else:
+            if presegmented:
+                if len(split) < 2:
+                    lineerror=True
+                    no_lineerrors+=1
+                else:
                     if lineerror:
                         print('Last',no_lineerrors,'lines had wrong format')
 
-                    no_lineerrors,lineerror = 0,False
-                    word = split[0]
-                    freq = 1
-
+                    no_lineerrors,lineerror = 0,False                    
+                    word=split[0]
+                    freq=1
                     if manual==True:
                         freq = manual_freq
 
-                    pron_list = BASpron_to_list(split[1],word)
-                else:
-                    if not lineerror:
-                        print('Encountered line with wrong format (doesnt have 2 elements)',line)
-                    lineerror = True
-                    no_lineerrors += 1
+                    # filter empty phones from presegmented list
+                    pron_list_manuel = [elem for elem in split[1:] if elem!='']
 
-            #some (older) dialects of this fileformat use e.g. a latex format for special characters. Word_substitution_dict (parameter of this function) can be used to take care of such translations.
-            for orig,replace in word_substitution_dict.items():
-                word = word.replace(orig,replace)
+                    # use parser to parse joined phoneme list, warn if there are differences
+                    pron_list_auto = BASpron_to_list(''.join(split[1:]),word)
 
-            #check if we still have non-german characters
-            for ch in word:
-                if ch not in alphabet_de:
-                    print('Warning, encountered non-german character',ch,'in word: ',line)
+                    if pron_list_auto != pron_list_manuel:
+                        print("Warning: pron_list_auto != pron_list_manuel:", pron_list_auto, pron_list_manuel)
+                        print("pron_list_auto takes precedence:", word, pron_list_auto)
 
-            if word != '':
-                phoneme_dict[word] += [{'pron':pron_list,'freq':int(freq),'manual':manual}]
+                    pron_list = pron_list_auto
+            elif (len(split)==2):
+                if lineerror:
+                    print('Last',no_lineerrors,'lines had wrong format')
 
-        if lineerror:
-            print('Last',no_lineerrors,'lines do not look like regular phoneme entries. Ignoring them.')
+                no_lineerrors,lineerror = 0,False
+                word = split[0]
+                freq = 1
 
-        return phoneme_dict
+                if manual==True:
+                    freq = manual_freq
+
+                pron_list = BASpron_to_list(split[1],word)
+            else:
+                if not lineerror:
+                    print('Encountered line with wrong format (doesnt have 2 elements)',line)
+                lineerror = True
+                no_lineerrors += 1
+
+        #some (older) dialects of this fileformat use e.g. a latex format for special characters. Word_substitution_dict (parameter of this function) can be used to take care of such translations.
+        for orig,replace in word_substitution_dict.items():
+            word = word.replace(orig,replace)
+
+        #check if we still have non-german characters
+        for ch in word:
+            if ch not in alphabet_de:
+                print('Warning, encountered non-german character',ch,'in word: ',line)
+
+        if word != '':
+            phoneme_dict[word] += [{'pron':pron_list,'freq':int(freq),'manual':manual}]
+
+    if lineerror:
+        print('Last',no_lineerrors,'lines do not look like regular phoneme entries. Ignoring them.')
+
+    return phoneme_dict
 
 def importBASWordforms(myid,latexCodes=True):
     '''Importer for BAS Wordforms, a dictionary fileformat which includes pronounciation variants.'''
@@ -228,7 +263,7 @@ def importBASWordforms(myid,latexCodes=True):
             #only global to parent function
             global phoneme_dict,meta,last_word
             #convert german latex characters to unicode
-            for latex,uni in latex_to_unicode.iteritems():
+            for latex,uni in latex_to_unicode.items():
                 line = line.replace(latex,uni)
 
             #check if we got all strange characters
@@ -324,37 +359,143 @@ def guessImportFunc(filename):
     else:
         return missingImporter
 
+#Same pronounciations of a word are merged. Pron accumulators do this in a single pass over all sources: they map each word to a dict
+#joined pron string -> runs, where a run [pron tuple, freq, manual, pron] holds consecutive variants with the same pron. This is exactly what
+#sorting the variants by their joined pron (stable) and grouping consecutive identical prons gives, but adding a variant only touches the
+#last run of its bucket. Accumulators can be merged, merging the accumulators of several sources is the same as accumulating all of them.
+
+def addPronEntries(accumulator, word, entries):
+    '''Adds pronounciation entries ({'pron','freq','manual'} dicts) of a word to the accumulator'''
+    buckets = accumulator.get(word)
+    if buckets is None:
+        buckets = accumulator[word] = {}
+    for entry in entries:
+        pron = entry['pron']
+        pron_tuple = tuple(pron)
+        runs = buckets.get(''.join(pron))
+        if runs is None:
+            buckets[''.join(pron)] = [[pron_tuple, entry['freq'], bool(entry['manual']), pron]]
+        elif runs[-1][0] == pron_tuple:
+            runs[-1][1] += entry['freq']
+            runs[-1][2] = runs[-1][2] or bool(entry['manual'])
+        else:
+            runs.append([pron_tuple, entry['freq'], bool(entry['manual']), pron])
+
+def accumulatePronDict(accumulator, phoneme_dict):
+    for word,entries in phoneme_dict.items():
+        addPronEntries(accumulator, word, entries)
+    return accumulator
+
+def mergePronAccumulators(acc1, acc2):
+    '''Merges acc2 (the later source) into acc1, the runs of acc2 are taken over'''
+    for word,buckets2 in acc2.items():
+        buckets1 = acc1.get(word)
+        if buckets1 is None:
+            acc1[word] = buckets2
+            continue
+        for joined_pron,runs2 in buckets2.items():
+            runs1 = buckets1.get(joined_pron)
+            if runs1 is None:
+                buckets1[joined_pron] = runs2
+                continue
+            if runs1[-1][0] == runs2[0][0]:
+                runs1[-1][1] += runs2[0][1]
+                runs1[-1][2] = runs1[-1][2] or runs2[0][2]
+                runs1.extend(runs2[1:])
+            else:
+                runs1.extend(runs2)
+    return acc1
+
+def collapsedPronDict(accumulator):
+    '''Returns the pronounciation dictionary of an accumulator, each variant sorted by its joined pron and with summed frequencies'''
+    phoneme_dict = {}
+    for word,buckets in accumulator.items():
+        pron_list = []
+        for joined_pron in sorted(buckets):
+            runs = buckets[joined_pron]
+            if len(runs) > 1:
+                seen = set()
+                for run in runs:
+                    if run[0] in seen:
+                        print('WARNING, duplicate pronounciation entry:',run[3],'word:',word,'variants:',[other[3] for other in runs])
+                    seen.add(run[0])
+            for pron_tuple,freq,manual,pron in runs:
+                pron_list.append({'pron':pron,'freq':freq,'manual':manual})
+        phoneme_dict[word] = pron_list
+    return phoneme_dict
+
 #find same pronouciations in the list and merge them
 def collapsePronList(pron_list):
-    #sort by pronounciation
-    pron_list.sort(key=lambda elem: ''.join(elem['pron']))
-    pron_list_collpased = []
-    #see http://stackoverflow.com/questions/773/how-do-i-use-pythons-itertools-groupby
-    for key, group in groupby(pron_list, lambda x: ' '.join(x['pron'])):
-        same_prons = list(pron for pron in group)
-        freq = sum([pron['freq'] for pron in same_prons])
-        manual = any([pron['manual'] for pron in same_prons])
-        pron_list_collpased.append({'pron':same_prons[0]['pron'],'freq':freq,'manual':manual})
-    return pron_list_collpased 
+    accumulator = {}
+    addPronEntries(accumulator, '', pron_list)
+    return collapsedPronDict(accumulator)['']
 
 def merge_dicts(d1, d2):
     '''Merge two pronounciation dictionaries'''
+    accumulator = {}
     for word in d2.keys():
-        merged_pron_list = []
-        pron_list1 = d1[word] if word in d1 else []
-        pron_list2 = d2[word]
-
-        merged_pron_list = collapsePronList(pron_list1 + pron_list2)
-
-        #check merged list:
-        for entry1 in merged_pron_list:
-            if len([entry2 for entry2 in merged_pron_list if entry1['pron']==entry2['pron']])>1:
-                print('WARNING, duplicate pronounciation entry:',entry1['pron'])
-                print(pron_list1)
-                print(pron_list2)
-
-        d1[word] = merged_pron_list
-    return d1 
+        if word in d1:
+            addPronEntries(accumulator, word, d1[word])
+        addPronEntries(accumulator, word, d2[word])
+    d1.update(collapsedPronDict(accumulator))
+    return d1
+
+def isShardable(importer):
+    '''Line based file formats can be split into shards at line boundaries, other formats (VM.German.Wordforms) have to be imported in one go'''
+    return isinstance(importer, partial) and importer.func is importSampa
+
+def importTasks(ids, shard_size):
+    '''Splits the lexicon files into import tasks (filename, byte range), large line based files are split into shards of about
+       shard_size bytes. Only the file size is needed here, the workers find the line boundaries themselves (see readShard).'''
+    tasks = []
+    for myid in ids:
+        if shard_size > 0 and isShardable(guessImportFunc(myid)):
+            file_size = os.path.getsize(myid)
+            for start in range(0, max(file_size, 1), shard_size):
+                tasks.append((myid, (start, start+shard_size)))
+        else:
+            tasks.append((myid, None))
+    return tasks
+
+def importTask(task):
+    '''Imports one file (or shard of a file) into a pron accumulator, runs in a worker process'''
+    myid,byte_range = task
+    importer = guessImportFunc(myid)
+    if byte_range is None:
+        print("I'm now opening ", myid)
+        d = importer(myid)
+    else:
+        print("I'm now opening ", myid, 'bytes', byte_range[0], 'to', byte_range[1])
+        d = importer(myid, byte_range=byte_range)
+    sys.stdout.flush()
+    return accumulatePronDict({}, d)
+
+def internPhonemes(accumulator):
+    '''Results from worker processes have their own copies of all phoneme strings, we map them back to the symbols in BAS_German_set,
+       so that the exported pickle is the same as the one of a serial import.'''
+    for buckets in accumulator.values():
+        for runs in buckets.values():
+            for run in runs:
+                run[3] = [bas_canonical[phoneme] for phoneme in run[3]]
+                run[0] = tuple(run[3])
+    return accumulator
+
+def parallelImport(ids, jobs, shard_size):
+    '''Imports all lexicon files with a pool of worker processes and merges their pron accumulators with a pairwise reduce tree, in the
+       order of the file list. This is identical to the serial import.'''
+    tasks = importTasks(ids, shard_size)
+    print('Importing', len(ids), 'lexicon files as', len(tasks), 'tasks with', jobs, 'processes')
+    with Pool(processes=jobs) as pool:
+        accumulators = [internPhonemes(accumulator) for accumulator in pool.imap(importTask, tasks)]
+
+    if len(accumulators) == 0:
+        return {}
+    while len(accumulators) > 1:
+        merged = [mergePronAccumulators(accumulators[i], accumulators[i+1]) for i in range(0, len(accumulators)-1, 2)]
+        if len(accumulators) % 2 == 1:
+            merged.append(accumulators[-1])
+        accumulators = merged
+    return collapsedPronDict(accumulators[0])
 
 if __name__ == '__main__':
 
@@ -362,7 +503,10 @@ if __name__ == '__main__':
     parser.add_argument('-f', '--filelist', dest='filelist', help='Process this file list of lexicons', type=str, default = '')
     parser.add_argument('-s', '--single-file', dest='singlefile', help='Process this single lexicon file', type=str, default = '')
     parser.add_argument('-e', '--export-pickle', dest='export', help='Export pickle file of combined phoneme dictionary', type=str, default = '')
+    parser.add_argument('-l', '--export-store', dest='export_store', help='Export combined phoneme dictionary as (memory mappable) lexicon store, see lexicon_store.py', type=str, default = '')
     parser.add_argument('-d', '--export-dir', dest='export_dir', help='Export dir for nonsilence_phones.txt, silence_phones.txt and extra_questions.txt' , type=str, default='data/local/dict/')
+    parser.add_argument('-j', '--jobs', dest='jobs', help='Import the lexicon files with this many processes', type=int, default=1)
+    parser.add_argument('--shard-size', dest='shard_size', help='Split large line based lexicon files (e.g. LEXICON.TBL, de.txt) into shards of about this many MB for the parallel import (0 = no sharding)', type=float, default=4.0)
 
     args = parser.parse_args()
 
@@ -374,13 +518,16 @@ if __name__ == '__main__':
             sys.exit()
         ids = common_utils.loadIdFile(args.filelist)
 
-    combinedDict = {}
-    
-    for myid in ids:
-        print("I'm now opening ", myid)
-        importer = guessImportFunc(myid)
-        d = importer(myid)
-        combinedDict = merge_dicts(combinedDict, d)
+    if args.jobs > 1:
+        combinedDict = parallelImport(ids, args.jobs, int(args.shard_size*1024*1024))
+    else:
+        accumulator = {}
+        for myid in ids:
+            print("I'm now opening ", myid)
+            importer = guessImportFunc(myid)
+            d = importer(myid)
+            accumulatePronDict(accumulator, d)
+        combinedDict = collapsedPronDict(accumulator)
 
     variants = 0
     for key in sorted(combinedDict.keys()):
@@ -390,7 +537,11 @@ if __name__ == '__main__':
     print('Dictionary size is ', len(combinedDict), ' pronounciation variants ', variants)
 
     #export dictionary to intermediate format
-    pickle.dump( combinedDict, open( args.export, 'wb' ) )
+    if args.export != '':
+        pickle.dump( combinedDict, open( args.export, 'wb' ) )
+    if args.export_store != '':
+        print('writing lexicon store', args.export_store)
+        lexicon_store.writeLexiconStore(args.export_store, combinedDict)
 
     #export auxillary files
     print('writing to', args.export_dir + 'nonsilence_phones.txt')     
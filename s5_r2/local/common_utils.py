@@ -17,10 +17,10 @@
 import os
 import errno
 import maryclient
-
-from bs4 import BeautifulSoup
+import persistent_cache
 
 import itertools
+import xml.parsers.expat
 
 def loadIdFile(idfile,remove_extension='.wav',use_no_files=-1):
     ids = []
@@ -41,12 +41,29 @@ pre_mary_transcription_replace_rules = {(u'º',u'°'),(u'“',u'"'), (u'„',u'"
 #Rules for cleaning transcriptions, after using DFKI's TTS frontend MARY
 post_mary_transcription_replace_rules = {(u' x ', u' mal '),(u' k m ',u' kilometer '),(u' E U R ',u' Euro '),('O K ','okay '),(u'D i e ',u'Die '),(u'D a s ',u'Das '),(u'D e r ',u'Der '),(u'Philipp V ',u'Philipp den fünften ')}
 
-def maryfySentence(sentence,mary,conn_num=0):
-    ''' Use DFKI's MARY software to get a XML file which tokenizes and adds meta data to entities like numbers. We use it to convert e.g. "120" into "hundert twenty". Server has to run locally! Todo: inform user if it does not.'''
+#Default location of the persistent MARY cache, shared by data_prepare.py and maryfy_corpus.py
+mary_cache_default_file = 'data/local/mary_cache.sqlite'
 
+def openMaryCache(filename=mary_cache_default_file, max_entries=0):
+    ''' Opens the persistent cache for MARY results, returns None if filename is empty (no caching)'''
+    if filename == '':
+        return None
+    return persistent_cache.PersistentCache(filename, namespace='mary', max_entries=max_entries)
+
+def applyPreMaryRules(sentence):
     for rule in pre_mary_transcription_replace_rules:
         target,replacement = rule
         sentence = sentence.replace(target,replacement)
+    return sentence
+
+def maryCacheKey(sentence, mary):
+    ''' Key for cached MARY results: the sentence as it is sent to MARY (with normalized whitespace), the MARY locale and the MARY server version'''
+    return (' '.join(applyPreMaryRules(sentence).split()), mary.locale, mary.version())
+
+def maryfySentence(sentence,mary,conn_num=0):
+    ''' Use DFKI's MARY software to get a XML file which tokenizes and adds meta data to entities like numbers. We use it to convert e.g. "120" into "hundert twenty". Server has to run locally! Todo: inform user if it does not.'''
+
+    sentence = applyPreMaryRules(sentence)
 
     contents = mary.generate(sentence,conn_num)
     return contents
@@ -78,15 +95,128 @@ def cutSequenceWith(seq, replace, start, end):
     assert(end > start and end <= len(seq))
     return seq[:start] + [replace] + seq[end:]
 
-def getCleanTokensAndPhonemes(sentence, mary, conn_num=0):
-    '''This uses mary client (needs a working MARY server on localhost) to parse a raw sentence and return a sequence of tokens and a sequence of phonemes'''
-    maryxml = maryfySentence(sentence,mary,conn_num)
+#
+# Single pass parser for MARY PHONEMES xml documents. The expat handlers collect tokens (with sounds_like substitution) and phonemes of
+# all pronounceable <t> elements, i.e. those with a ph attribute, and collapse runs of single character tokens (acronyms) on the fly.
+# The token text is what BeautifulSoup's tag.string gives, this is what the parser used before. Documents where this can't be done in a
+# single pass are handed to the old functions: with empty tokens we collapse with find_mary_acronym/collapseTokenSeqAt, documents that
+# expat can't parse (or with nested <t> elements) are parsed with BeautifulSoup.
+#
+
+class MaryEmptyToken(Exception):
+    pass
+
+class MaryUnsupportedXml(Exception):
+    pass
+
+def maryTagString(children):
+    '''Same as tag.string in BeautifulSoup, for the list of children of an element (strings, comments and lists of children)'''
+    if len(children) != 1:
+        return None
+    child = children[0]
+    if isinstance(child, str):
+        return child
+    if isinstance(child, tuple):
+        return child[1]
+    return maryTagString(child)
+
+class MaryPhonemesParser:
+
+    def __init__(self, collapse_acronyms=True):
+        self.collapse_acronyms = collapse_acronyms
+        self.tokens = []
+        self.phonemes = []
+        # current run of single character tokens
+        self.run_tokens = []
+        self.run_phonemes = []
+        # attributes of the open <t> element and the children lists of the elements that are open inside of it
+        self.token_attrs = None
+        self.stack = []
+
+    def startElement(self, name, attrs):
+        if self.token_attrs is not None:
+            if name.lower() == 't':
+                raise MaryUnsupportedXml('nested <t> element')
+            children = []
+            self.stack[-1].append(children)
+            self.stack.append(children)
+        elif name.lower() == 't':
+            self.token_attrs = dict([(key.lower(),value) for key,value in attrs.items()])
+            self.stack = [[]]
+
+    def characters(self, text):
+        if self.token_attrs is not None:
+            children = self.stack[-1]
+            if len(children) > 0 and isinstance(children[-1], str):
+                children[-1] += text
+            else:
+                children.append(text)
+
+    def comment(self, text):
+        if self.token_attrs is not None:
+            self.stack[-1].append(('comment', text))
+
+    def cdata(self):
+        # BeautifulSoup keeps CDATA sections as separate strings
+        if self.token_attrs is not None:
+            raise MaryUnsupportedXml('CDATA section in <t> element')
+
+    def endElement(self, name):
+        if self.token_attrs is None:
+            return
+        children = self.stack.pop()
+        if len(self.stack) > 0:
+            return
+        attrs = self.token_attrs
+        self.token_attrs = None
+
+        #Filter punctuation and other unpronounceable stuff
+        if 'ph' not in attrs:
+            return
+        token = attrs['sounds_like'] if 'sounds_like' in attrs else str(maryTagString(children)).strip()
+        phoneme = attrs['ph'].replace(' ','')
+
+        if not self.collapse_acronyms:
+            self.tokens.append(token)
+            self.phonemes.append(phoneme)
+        elif len(token) == 1:
+            self.run_tokens.append(token)
+            self.run_phonemes.append(phoneme)
+        elif len(token) == 0:
+            raise MaryEmptyToken()
+        else:
+            self.flushRun()
+            self.tokens.append(token)
+            self.phonemes.append(phoneme)
+
+    def flushRun(self):
+        if len(self.run_tokens) > 0:
+            self.tokens.append(''.join(self.run_tokens))
+            self.phonemes.append(''.join(self.run_phonemes))
+            self.run_tokens = []
+            self.run_phonemes = []
+
+    def parse(self, maryxml):
+        parser = xml.parsers.expat.ParserCreate()
+        parser.buffer_text = True
+        parser.StartElementHandler = self.startElement
+        parser.EndElementHandler = self.endElement
+        parser.CharacterDataHandler = self.characters
+        parser.CommentHandler = self.comment
+        parser.StartCdataSectionHandler = self.cdata
+        parser.Parse(maryxml, True)
+        self.flushRun()
+        return self.tokens,self.phonemes
+
+def legacyParseMaryPhonemes(maryxml):
+    '''The BeautifulSoup based parser, for documents that MaryPhonemesParser can't handle'''
+    from bs4 import BeautifulSoup
     soup = BeautifulSoup(maryxml)
 
     tokens_with_meta = []
 
     for token in soup.find_all('t'):
-        tokens_with_meta.append((unicode(token.string).strip(),token.attrs))
+        tokens_with_meta.append((str(token.string).strip(),token.attrs))
 
     #Filter punctuation and other unpronounceable stuff (todo: we should include an option to pronounce punctuation or leave it in there)
     tokens_with_meta = [elem for elem in tokens_with_meta if 'ph' in elem[1]]
@@ -95,6 +225,9 @@ def getCleanTokensAndPhonemes(sentence, mary, conn_num=0):
     tokens = [token for (token,meta) in tokens_with_meta]
     phonemes = [meta['ph'].replace(' ','') for (token,meta) in tokens_with_meta]
 
+    return collapseAcronyms(tokens,phonemes)
+
+def collapseAcronyms(tokens,phonemes):
     # Try the sentence 'Die ARD hat berichtet...' with MARY; it returns separate tokens A R D for ARD. The following code replaces these separate one char length tokens by collapsign them to a single token
     replace_positions = list(find_mary_acronym(tokens))
 
@@ -102,8 +235,34 @@ def getCleanTokensAndPhonemes(sentence, mary, conn_num=0):
         tokens = collapseTokenSeqAt(tokens,replace_positions)
         phonemes = collapseTokenSeqAt(phonemes,replace_positions)
 
+    return tokens,phonemes
+
+def parseMaryPhonemes(maryxml):
+    '''Returns the sequence of tokens and the sequence of phonemes of a MARY PHONEMES xml document, acronyms that MARY splits into letters are joined again'''
+    try:
+        return MaryPhonemesParser().parse(maryxml)
+    except MaryEmptyToken:
+        return collapseAcronyms(*MaryPhonemesParser(collapse_acronyms=False).parse(maryxml))
+    except (xml.parsers.expat.ExpatError, MaryUnsupportedXml):
+        return legacyParseMaryPhonemes(maryxml)
+
+def getCleanTokensAndPhonemes(sentence, mary, conn_num=0, cache=None):
+    '''This uses mary client (needs a working MARY server on localhost) to parse a raw sentence and return a sequence of tokens and a sequence of phonemes.
+       If a cache is given (see openMaryCache), results are looked up there first and MARY is only asked for sentences not seen before.'''
+    if cache is not None:
+        cache_key = maryCacheKey(sentence, mary)
+        cached = cache.get(cache_key)
+        if cached is not None:
+            return cached[0],cached[1]
+
+    maryxml = maryfySentence(sentence,mary,conn_num)
+    tokens,phonemes = parseMaryPhonemes(maryxml)
+
     assert(len(tokens)==len(phonemes))
 
+    if cache is not None:
+        cache.put(cache_key, [tokens,phonemes])
+
     return tokens,phonemes
 
 #checks if a directory exists and create it if necessary, see http://stackoverflow.com/questions/273192/check-if-a-directory-exists-and-create-it-if-necessary
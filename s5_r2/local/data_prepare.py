@@ -18,6 +18,7 @@
 from __future__ import print_function
 
 import argparse
+import audio_utils
 import common_utils
 import codecs
 import traceback
@@ -26,9 +27,10 @@ import maryclient
 import os
 import errno
 
-from bs4 import BeautifulSoup
+import xml.etree.ElementTree as ElementTree
 
 from common_utils import make_sure_path_exists
+from multiprocessing import Pool
 import collections
 import itertools
 
@@ -39,6 +41,12 @@ import itertools
 #After this amount of seconds between utterance recordigs, decide that a new speaker is recording the utterance (simple heuristic,  unfortunately corpus doesnt contain this information) 
 speakerid_diff_heuristic = 180
 
+#Fields we extract from each xml file, all of them are required
+tuda_xml_fields = ['sentence','cleaned_sentence','gender','ageclass','corpus','muttersprachler','bundesland','speaker_id']
+
+#Number of xml files handed to a worker at once, when parsing with multiple jobs
+xml_chunksize = 64
+
 mary = maryclient.maryclient()
 
 def exportDict(dest_file,utterances_phoneme_dict):
@@ -46,7 +54,7 @@ def exportDict(dest_file,utterances_phoneme_dict):
         for word in utterances_phoneme_dict:
             out.write(word+' '+utterances_phoneme_dict[word]+'\n')
 
-def writeKaldiDataFolder(dest_dir, utts, filter_fileid_list=None):
+def writeKaldiDataFolder(dest_dir, utts, filter_fileid_list=None, exclusions=None):
     ''' Exports the internal representation utts for all utterances into KALDIs corpus description format '''
     # Kaldi format, files: text,wav.scp,utt2spk,spk2gender
 
@@ -86,6 +94,8 @@ def writeKaldiDataFolder(dest_dir, utts, filter_fileid_list=None):
                         if filter_fileid_list != mic:
                             continue
                     kaldi_id =  kaldi_base_id + '_' + mic
+                    if exclusions is not None and audio_utils.isExcluded(exclusions, kaldi_id):
+                        continue
                     text.write(kaldi_id+' '+transcription+'\n')
                     wavscp.write(kaldi_id+' '+ fileid +'\n')
                     utt2spk.write(kaldi_id+' '+utt['speakerid']+'\n')
@@ -175,8 +185,30 @@ def replace_sublist(seq, target, replacement):
         seq[start:end] = replacement
     return seq
 
-#Load corpus xml files into python structures with BeautifulSoup
-def getUtterances(ids, use_mary=False, cache_cleaned_sentences = True):
+def parseTudaXml(myid):
+    '''Streams through the xml file of one utterance and extracts only the fields in tuda_xml_fields (first occurrence wins, tag names are case insensitive)'''
+    fields = {}
+    with open(myid+'.xml','rb') as myfile:
+        for event,elem in ElementTree.iterparse(myfile, events=('end',)):
+            tag = elem.tag.lower()
+            if tag in tuda_xml_fields and tag not in fields:
+                fields[tag] = elem.text
+            if len(fields) == len(tuda_xml_fields):
+                break
+    for field in tuda_xml_fields:
+        if field not in fields:
+            raise ValueError('field <'+field+'> not found in '+myid+'.xml')
+    return fields
+
+def loadTudaXml(myid):
+    '''Worker function for getUtterances, errors are passed back to the main process as strings instead of raising them in the worker'''
+    try:
+        return myid,parseTudaXml(myid),None
+    except Exception as err:
+        return myid,None,str(err)
+
+#Load corpus xml files into python structures, optionally with a pool of worker processes
+def getUtterances(ids, use_mary=False, cache_cleaned_sentences = True, jobs=1, mary_cache=None):
     '''Loads the corpus and gets python structured object that can be used to export the corpus to a format KALDI understands'''
     utts= []
     
@@ -185,54 +217,66 @@ def getUtterances(ids, use_mary=False, cache_cleaned_sentences = True):
 
     print('Reading and parsing TUDA corpus transcriptions',end='',flush=True)
 
+    #imap returns the parsed files in the order of ids, so that the output is the same as with a single job
+    if jobs > 1:
+        workerpool = Pool(processes=jobs)
+        parsed_xmls = workerpool.imap(loadTudaXml, list(ids), chunksize=xml_chunksize)
+    else:
+        workerpool = None
+        parsed_xmls = map(loadTudaXml, ids)
+
     lastutt = None
-    for i,myid in enumerate(ids):
+    for i,(myid,fields,err) in enumerate(parsed_xmls):
         if i%100 == 0:
             print('.',end='',flush=True)
+        if err is not None:
+            print('Error in file, omitting', myid)
+            print(err)
+            continue
         try:
-            with codecs.open(myid+'.xml','r','utf-8') as myfile:
-                #extract xml meta 
-                xml = myfile.read()
-                soup = BeautifulSoup(xml,"lxml")
-                sentence = soup.recording.sentence.string
-                cleaned_sentence = soup.recording.cleaned_sentence.string
-                gender = soup.recording.gender.string
-                age = soup.recording.ageclass.string
-                corpus = soup.recording.corpus.string
-                nativespeaker = soup.recording.muttersprachler.string
-                region = soup.recording.bundesland.string
-                speakerid= soup.recording.speaker_id.string
-
-                if speakerid is None or speakerid == '':
-                    print('ERROR, speakerid not found for', myid)
-
-                date = getDateFromID(myid)
-
-                if use_mary:
-                    if cache_cleaned_sentences and (cleaned_sentence not in cleaned_sentences_cache):
-                        clean_sentence_tokens,token_phonemes = common_utils.getCleanTokensAndPhonemes(cleaned_sentence,mary)
-                        cleaned_sentences_cache[cleaned_sentence] = (clean_sentence_tokens,token_phonemes)
-                        #print 'cleaning ', cleaned_sentence, ' -> ', clean_sentence_tokens , ' phonemes:', token_phonemes
-                    else:
-                        clean_sentence_tokens,token_phonemes = cleaned_sentences_cache[cleaned_sentence]
-
-                    if not cache_cleaned_sentences:
-                        clean_sentence_tokens,token_phonemes = common_utils.getCleanTokensAndPhonemes(sentence,mary)
-
-                    for token,phoneme_representation in itertools.izip(clean_sentence_tokens,token_phonemes):
-                        if token not in utts_phoneme_dict:
-                            utts_phoneme_dict[token] = phoneme_representation
-                
-                clean_sentence_tokens = cleaned_sentence.split(' ')
-                utt = {'id':myid.split('/')[-1],'fileids':ids[myid],'sentence':sentence,'clean_sentence_tokens':clean_sentence_tokens,
-                        'speakerid':speakerid,'gender':gender,'age':age,'corpus':corpus,'nativespeaker':nativespeaker,'region':region,'date':date}
-
-                utts.append(utt)
+            sentence = fields['sentence']
+            cleaned_sentence = fields['cleaned_sentence']
+            gender = fields['gender']
+            age = fields['ageclass']
+            corpus = fields['corpus']
+            nativespeaker = fields['muttersprachler']
+            region = fields['bundesland']
+            speakerid= fields['speaker_id']
+
+            if speakerid is None or speakerid == '':
+                print('ERROR, speakerid not found for', myid)
+
+            date = getDateFromID(myid)
+
+            if use_mary:
+                if cache_cleaned_sentences and (cleaned_sentence not in cleaned_sentences_cache):
+                    clean_sentence_tokens,token_phonemes = common_utils.getCleanTokensAndPhonemes(cleaned_sentence,mary,cache=mary_cache)
+                    cleaned_sentences_cache[cleaned_sentence] = (clean_sentence_tokens,token_phonemes)
+                    #print 'cleaning ', cleaned_sentence, ' -> ', clean_sentence_tokens , ' phonemes:', token_phonemes
+                else:
+                    clean_sentence_tokens,token_phonemes = cleaned_sentences_cache[cleaned_sentence]
+
+                if not cache_cleaned_sentences:
+                    clean_sentence_tokens,token_phonemes = common_utils.getCleanTokensAndPhonemes(sentence,mary,cache=mary_cache)
+
+                for token,phoneme_representation in zip(clean_sentence_tokens,token_phonemes):
+                    if token not in utts_phoneme_dict:
+                        utts_phoneme_dict[token] = phoneme_representation
+            
+            clean_sentence_tokens = cleaned_sentence.split(' ')
+            utt = {'id':myid.split('/')[-1],'fileids':ids[myid],'sentence':sentence,'clean_sentence_tokens':clean_sentence_tokens,
+                    'speakerid':speakerid,'gender':gender,'age':age,'corpus':corpus,'nativespeaker':nativespeaker,'region':region,'date':date}
+
+            utts.append(utt)
 
         except Exception as err:
             print('Error in file, omitting', myid)
             print(err)
 
+    if workerpool is not None:
+        workerpool.close()
+        workerpool.join()
+
     #Sort utterances by date
     utts = sorted(utts,key=lambda utt:utt['date'])
 
@@ -254,6 +298,9 @@ if __name__ == '__main__':
     parser.add_argument('-s', '--separate-mic-dirs', dest='separate_mic_dir', help='Add separate microphone directories, one per mic.', action='store_true', default=False)
     parser.add_argument('-k', '--kaldidirs-postfix', dest='kaldidirs_postfix', help='Add a post fix to the generated directory, e.g. if set to "_a", the training dir will be named train_a (same for test and dev)', type=str, default='')
     parser.add_argument('-a', '--write-all-dir', dest='write_all_dir', help='Additionally also write out a Kaldi directory containing all utterances (train+test+dev)', action='store_true', default=False)
+    parser.add_argument('-c', '--mary-cache', dest='mary_cache', help='Persistent cache file for MARY results (shared with maryfy_corpus.py), set to an empty string to disable it', type=str, default=common_utils.mary_cache_default_file)
+    parser.add_argument('-j', '--jobs', dest='jobs', help='Number of worker processes used to parse the corpus xml files', type=int, default=1)
+    parser.add_argument('-x', '--exclude', dest='exclude', help='Skip the audio files and utterances in this exclusion list (see scan_audio.py)', type=str, default=audio_utils.audio_exclude_default_file)
 
     args = parser.parse_args()
 
@@ -272,11 +319,17 @@ if __name__ == '__main__':
 
         print('Create data directories for the following type of microphones:', ' '.join(postfixes))
 
+        exclusions = audio_utils.readExclusionList(args.exclude)
+        excluded = 0
+
         omitted = 0
         for myid in ids_raw:
             for postfix in postfixes:
               check = myid + postfix + args.wav_extension
-              if os.path.isfile(check):
+              if os.path.isfile(check) and audio_utils.isExcluded(exclusions, '', [check]):
+                  ids[myid].append('missing')
+                  excluded += 1
+              elif os.path.isfile(check):
                   ids[myid].append(check)
               else:
                   ids[myid].append('missing')
@@ -285,8 +338,15 @@ if __name__ == '__main__':
         
         print('Found',len(ids),' wav files.')
         print('Omitted ',omitted,' xml transcription files (Some missing files is normal for the TUDA Kaldi corpus).')
+        if excluded > 0:
+            print('Excluded', excluded, 'wav files that are in', args.exclude)
+
+        mary_cache = common_utils.openMaryCache(args.mary_cache) if args.use_mary else None
+
+        utterances,utterances_phoneme_dict = getUtterances(ids, use_mary= args.use_mary, jobs=args.jobs, mary_cache=mary_cache)
 
-        utterances,utterances_phoneme_dict = getUtterances(ids, use_mary= args.use_mary)
+        if mary_cache is not None:
+            mary_cache.close()
         
         print('done.')
         print('Some example utterances:')
@@ -301,22 +361,22 @@ if __name__ == '__main__':
         train, test, dev = filenameSplit(utterances)
  
         print('Writing train'+args.kaldidirs_postfix+'...')
-        writeKaldiDataFolder('data/tuda_train'+args.kaldidirs_postfix+'/', train)
+        writeKaldiDataFolder('data/tuda_train'+args.kaldidirs_postfix+'/', train, exclusions=exclusions)
         print('Writing dev'+args.kaldidirs_postfix+'...')
-        writeKaldiDataFolder('data/dev'+args.kaldidirs_postfix+'/', dev)
+        writeKaldiDataFolder('data/dev'+args.kaldidirs_postfix+'/', dev, exclusions=exclusions)
         print('Writing test'+args.kaldidirs_postfix+'...')
-        writeKaldiDataFolder('data/test'+args.kaldidirs_postfix+'/', test)
+        writeKaldiDataFolder('data/test'+args.kaldidirs_postfix+'/', test, exclusions=exclusions)
 
         if args.separate_mic_dir:
             for out in [("dev"+args.kaldidirs_postfix, dev), ("test"+args.kaldidirs_postfix, test)]:
                 for mic in 'abcd':
                     outdir = 'data/'+out[0]+'_'+mic+'/'
                     print('Writing '+outdir+'...')            
-                    writeKaldiDataFolder(outdir, out[1], filter_fileid_list=mic)
+                    writeKaldiDataFolder(outdir, out[1], filter_fileid_list=mic, exclusions=exclusions)
 
         if args.write_all_dir:
             print('Writing all...')
-            writeKaldiDataFolder('data/all/', utterances)
+            writeKaldiDataFolder('data/all/', utterances, exclusions=exclusions)
 
         if args.use_mary:
             print('Writing phoneme dictionary for words in train/test/dev...')
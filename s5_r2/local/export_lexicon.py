@@ -17,32 +17,72 @@
 from __future__ import print_function
 
 import argparse
-import pickle
+import heapq
+import lexicon_store
 import io
 
+from operator import itemgetter
+
+#pronounciations of one entry of the dictionary, with frequencies normalized by the most frequent one, most frequent first
+def normalizedProns(entry):
+    freqMult = 1.0 / float(max([pron['freq'] for pron in entry]))
+    return sorted([(float(pron['freq'])*freqMult, pron['pron']) for pron in entry], reverse=True, key=itemgetter(0))
+
+def kaldiLines(word,prons):
+    #Kaldi probabilty format <word> <freq> <pronounciation>
+    return [word + ' ' + str(freq) + ' ' + ' '.join(pron) + '\n' for freq,pron in prons]
+
+def sphinxLines(word,prons):
+    return [word + ('('+str(i)+')' if i>0 else '') + '  ' + ' '.join(pron) + '\n' for i,(freq,pron) in enumerate(prons)]
+
 #generate string for one entry of the dictionary
 def generateEntry(word,entry,sphinx_format=False):
-    freqMult = 0.0
-    #find most frequent entry
-    freqs = [pron['freq'] for pron in entry]
-    freqMult = 1.0 / float(max(freqs))
-    freqs = [float(pron['freq'])*freqMult for pron in entry]
-    prons = [elem['pron'] for elem in entry]    
-
-    txt = ''
-    for i,(freq,pron) in enumerate(sorted(zip(freqs,prons), reverse=True, key=lambda x:x[0])):
-        if sphinx_format:
-            txt += word + ('('+str(i)+')' if i>0 else '') + '  ' + ' '.join(pron) + '\n'
-        else:
-            #Kaldi probabilty format <word> <freq> <pronounciation>
-            txt += word + ' ' + str(freq) + ' ' + ' '.join(pron) + '\n'
-    return txt
+    prons = normalizedProns(entry)
+    return ''.join(sphinxLines(word,prons) if sphinx_format else kaldiLines(word,prons))
+
+def sortedEntries(lexicon,extraEntries):
+    '''Streams (word, entry) in sorted order. A lexicon store is already sorted and read entry by entry, extraEntries take precedence over the lexicon.'''
+    if isinstance(lexicon, lexicon_store.LexiconStore):
+        entries = lexicon.items()
+    else:
+        entries = ((word,lexicon[word]) for word in sorted(lexicon.keys()))
+    extra = sorted(extraEntries.items(), key=itemgetter(0))
+    last_word = None
+    # extra entries come first for equal words, the lexicon entry is skipped then
+    for word,entry in heapq.merge(extra, entries, key=itemgetter(0)):
+        if word != last_word:
+            yield word,entry
+        last_word = word
+
+def exportLexicon(entries,kaldi_file='',sphinx_file='',flush_every=10000):
+    '''Writes (word, entry) pairs in Kaldi lexiconp.txt and/or Sphinx format in a single pass, the lines are written in batches'''
+    outfiles = []
+    if kaldi_file != '':
+        outfiles.append((io.open(kaldi_file,'w',encoding='utf-8',buffering=1<<20),kaldiLines,[]))
+    if sphinx_file != '':
+        outfiles.append((io.open(sphinx_file,'w',encoding='utf-8',buffering=1<<20),sphinxLines,[]))
+
+    try:
+        for num,(word,entry) in enumerate(entries):
+            prons = normalizedProns(entry)
+            for outfile,lines,buf in outfiles:
+                buf += lines(word,prons)
+            if num % flush_every == flush_every-1:
+                for outfile,lines,buf in outfiles:
+                    outfile.write(''.join(buf))
+                    del buf[:]
+        for outfile,lines,buf in outfiles:
+            outfile.write(''.join(buf))
+    finally:
+        for outfile,lines,buf in outfiles:
+            outfile.close()
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Prepares the files from the TUDA corpus (XML) into text transcriptions for KALDI')
-    parser.add_argument('-f', '--file', dest='file', help='process this (python pickle) lexicon file', type=str)
+    parser.add_argument('-f', '--file', dest='file', help='process this lexicon store or (python pickle) lexicon file', type=str)
     parser.add_argument('-o', '--outfile', dest='outfile', help='lexicon out file', type=str, default='lexiconp.txt')
     parser.add_argument('-sph', '--sphinx-format', dest='sphinx_format', help='export lexicon in sphinx format', action='store_true', default=False)
+    parser.add_argument('--sphinx-outfile', dest='sphinx_outfile', help='additionally export the lexicon in sphinx format to this file (in the same pass)', type=str, default='')
 
     args = parser.parse_args()
     
@@ -50,23 +90,24 @@ if __name__ == '__main__':
         print('Note: will use the Sphinx lexicon for this export.')
 
     print('Load ', args.file)
-    combinedDict = pickle.load( open( args.file , 'rb' ) )
-
-    print('Succesfully opened pickle file, now exporting to:', args.outfile) 
-    with io.open(args.outfile,'w',encoding='utf-8') as outfile:
-        if '%' in combinedDict:
-            combinedDict['<UNK>'] = combinedDict['%']
-            print('<UNK> is:', combinedDict['<UNK>'])
-            #del combinedDict['%']
-        else:
-            print('Warning!: No % entry found! Will add <UNK> -> usb mapping manually.')
-            combinedDict['<UNK>'] = [{'pron': ['usb'], 'freq': 100, 'manual': True}]
-
-        if '<Lachen>' not in combinedDict:
-            print('Warning!: No <Lachen> entry found! Will add <Lachen> -> lau mapping manually.')
-            combinedDict['<Lachen>'] = [{'pron': ['lau'], 'freq': 100, 'manual': True}]
-
-        for key in sorted(list(combinedDict.keys())):
-            txt = generateEntry(key,combinedDict[key],args.sphinx_format)
-            outfile.write(txt)
+    combinedDict = lexicon_store.loadLexicon(args.file)
+
+    print('Succesfully opened lexicon file, now exporting to:', args.outfile) 
+    #the lexicon store is read only, the extra entries are kept separately
+    extraEntries = {}
+    if '%' in combinedDict:
+        extraEntries['<UNK>'] = combinedDict['%']
+        print('<UNK> is:', extraEntries['<UNK>'])
+        #del combinedDict['%']
+    else:
+        print('Warning!: No % entry found! Will add <UNK> -> usb mapping manually.')
+        extraEntries['<UNK>'] = [{'pron': ['usb'], 'freq': 100, 'manual': True}]
 
+    if '<Lachen>' not in combinedDict:
+        print('Warning!: No <Lachen> entry found! Will add <Lachen> -> lau mapping manually.')
+        extraEntries['<Lachen>'] = [{'pron': ['lau'], 'freq': 100, 'manual': True}]
+
+    if args.sphinx_format:
+        exportLexicon(sortedEntries(combinedDict,extraEntries),sphinx_file=args.outfile)
+    else:
+        exportLexicon(sortedEntries(combinedDict,extraEntries),kaldi_file=args.outfile,sphinx_file=args.sphinx_outfile)
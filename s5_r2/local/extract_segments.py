@@ -0,0 +1,256 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2022 Language Technology, Universitaet Hamburg (author: Benjamin Milde)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import print_function
+
+import argparse
+import audio_archive
+import audio_utils
+import io
+import os
+import shutil
+
+from multiprocessing import Pool
+
+#
+# Cuts the segments of a data dir with long recordings (SWC: one "sox audio*.ogg ... |" command per article) out of their recordings
+# and writes a data dir without segments. Every recording is decoded once and all of its segments are written one after another
+# into an audio archive (see audio_archive.py), so later stages read the archives sequentially instead of decoding the whole
+# recording again in every feature extraction job. The recordings are split into one contiguous part per job, every job writes
+# its own archive:
+#
+#   python3 local/extract_segments.py -j 16 data/swc_train data/swc_train_extracted data/wav_16k/swc_train
+#
+# The new data dir has wav.scp entries "archive:offset" for every utterance, utt2dur and the utterance files of the old data dir
+# (text, utt2spk, ...) for the segments that could be extracted. Segments are cut like Kaldi's extract-segments does. The index of the
+# archives is written to archive_dir/index (see audio_archive.ArchiveReader).
+#
+# The archives are written to temporary files and renamed once all jobs are done, the index is written last. If the index is newer
+# than the segments and the wav.scp of the source data dir, the audio is not extracted again (unless --force is given), only the
+# utterance files are copied again.
+#
+
+# files of the data dir that are copied for the extracted utterances
+utterance_files = ['text', 'utt2spk', 'utt2gender', 'utt2lang', 'utt2uniq']
+# files of the data dir that are copied as they are
+speaker_files = ['spk2gender']
+
+# defaults of extract-segments
+default_min_segment_length = 0.1
+default_max_overshoot = 0.5
+
+def readSegments(filename):
+    '''{recording: [(utterance, start, end, channel)]} and the recordings in the order of their first segment'''
+    segments, recordings = {}, []
+    with io.open(filename, 'r', encoding='utf-8', errors='surrogateescape') as infile:
+        for line in infile:
+            split = line.split()
+            if len(split) not in [4, 5]:
+                if len(split) > 0:
+                    print('Warning, invalid line in segments file:', line.strip())
+                continue
+            utt, reco = split[0], split[1]
+            try:
+                start, end = float(split[2]), float(split[3])
+                channel = int(split[4]) if len(split) == 5 else -1
+            except ValueError:
+                print('Warning, invalid line in segments file:', line.strip())
+                continue
+            if start < 0 or (end != -1.0 and end <= 0) or (start >= end and end > 0):
+                print('Warning, invalid line in segments file [bad start/end times]:', line.strip())
+                continue
+            if reco not in segments:
+                segments[reco] = []
+                recordings.append(reco)
+            segments[reco].append((utt, start, end, channel))
+    return segments, recordings
+
+def cutSegment(fmt, data, start, end, channel, min_segment_length=default_min_segment_length, max_overshoot=default_max_overshoot):
+    '''(fmt chunk, samples) of a segment, like extract-segments cuts it. Returns (None, reason) if the segment has to be skipped.'''
+    sample_rate, channels, bits, block_align = audio_utils.wavFormat(fmt)
+    num_samp = len(data) // block_align
+    start_samp = int(start * sample_rate)
+    end_samp = int(end * sample_rate) if end != -1 else num_samp
+    if start_samp < 0 or start_samp >= num_samp:
+        return None, 'start sample out of range ' + str(start_samp) + ' [length:] ' + str(num_samp)
+    if end_samp > num_samp:
+        if end_samp >= num_samp + int(max_overshoot * sample_rate):
+            return None, 'end sample too far out of range ' + str(end_samp) + ' [length:] ' + str(num_samp)
+        end_samp = num_samp
+    if end_samp <= start_samp + int(min_segment_length * sample_rate):
+        return None, 'too short'
+
+    data = data[start_samp * block_align:end_samp * block_align]
+    if channel >= 0 and channels > 1:
+        if channel >= channels:
+            return None, 'invalid channel ' + str(channel)
+        sample_size = block_align // channels
+        data = b''.join([data[i + channel * sample_size:i + (channel + 1) * sample_size] for i in range(0, len(data), block_align)])
+        fmt = fmt[:2] + b'\x01\x00' + fmt[4:8] + (sample_rate * sample_size).to_bytes(4, 'little') + sample_size.to_bytes(2, 'little') + fmt[14:]
+    return (fmt, data), None
+
+def extractJob(task):
+    '''Decodes the recordings of one job and writes their segments into the archive of the job (in a worker process). Returns
+       [(utterance, wav.scp entry, duration)], the (utterance, offset, size) entries of the archive, the warnings and the number of
+       recordings that failed.'''
+    archive_file, recordings, min_segment_length, max_overshoot = task
+    results, warnings, failed = [], [], 0
+    writer = audio_archive.ArchiveWriter(archive_file + '.tmp', archive_file)
+    try:
+        for reco, rxfilename, segments in recordings:
+            try:
+                fmt, data = audio_archive.readAudio(rxfilename)
+            except (IOError, OSError) as err:
+                warnings.append('Could not read recording ' + reco + ': ' + str(err))
+                failed += 1
+                continue
+            for utt, start, end, channel in segments:
+                segment, reason = cutSegment(fmt, data, start, end, channel, min_segment_length, max_overshoot)
+                if segment is None:
+                    warnings.append('Skipping segment ' + utt + ': ' + reason)
+                    continue
+                sample_rate, channels, bits, block_align = audio_utils.wavFormat(segment[0])
+                results.append((utt, writer.add(utt, segment[0], segment[1]), float(len(segment[1]) // block_align) / sample_rate))
+    finally:
+        writer.close()
+    return results, writer.entries, warnings, failed
+
+def splitJobs(recordings, jobs):
+    '''Splits the (recording, rxfilename, segments) list into at most jobs contiguous parts with about the same length of segments'''
+    lengths = [sum([end - start if end != -1 else 0.0 for utt, start, end, channel in segments]) for reco, rxfilename, segments in recordings]
+    total = sum(lengths)
+    parts, part, part_length = [], [], 0.0
+    for recording, length in zip(recordings, lengths):
+        part.append(recording)
+        part_length += length
+        if part_length >= total * (len(parts) + 1) / jobs and len(parts) < jobs - 1:
+            parts.append(part)
+            part = []
+    if len(part) > 0:
+        parts.append(part)
+    return parts
+
+def copyUtteranceFiles(src_dir, dest_dir, utts):
+    '''Copies the utterance files of the source data dir for the utterances in utts and writes spk2utt'''
+    spk2utt = {}
+    for filename in utterance_files:
+        if not os.path.exists(os.path.join(src_dir, filename)):
+            continue
+        with io.open(os.path.join(src_dir, filename), 'r', encoding='utf-8', errors='surrogateescape') as infile, \
+             io.open(os.path.join(dest_dir, filename), 'w', encoding='utf-8', errors='surrogateescape') as outfile:
+            for line in infile:
+                split = line.split(None, 1)
+                if len(split) > 0 and split[0] in utts:
+                    outfile.write(line if line.endswith('\n') else line + '\n')
+                    if filename == 'utt2spk' and len(split) == 2:
+                        spk2utt.setdefault(split[1].strip(), []).append(split[0])
+    for filename in speaker_files:
+        if os.path.exists(os.path.join(src_dir, filename)):
+            with open(os.path.join(src_dir, filename), 'rb') as infile, open(os.path.join(dest_dir, filename), 'wb') as outfile:
+                outfile.write(infile.read())
+    if len(spk2utt) > 0:
+        with io.open(os.path.join(dest_dir, 'spk2utt'), 'w', encoding='utf-8', errors='surrogateescape') as outfile:
+            for spk in sorted(spk2utt.keys(), key=lambda spk: spk.encode('utf-8', 'surrogateescape')):
+                outfile.write(spk + ' ' + ' '.join(spk2utt[spk]) + '\n')
+
+def isUpToDate(src_dir, dest_dir, archive_dir):
+    '''True if the archives in archive_dir were written after the last change of the segments and wav.scp of src_dir'''
+    index_file = os.path.join(archive_dir, audio_archive.index_name)
+    if not os.path.exists(index_file) or not os.path.exists(os.path.join(dest_dir, 'wav.scp')):
+        return False
+    index_time = os.path.getmtime(index_file)
+    return all([os.path.getmtime(os.path.join(src_dir, name)) < index_time for name in ['segments', 'wav.scp']])
+
+def removeStaleShards(archive_dir, name, archive_files):
+    '''Removes archives of an earlier run (e.g. with more jobs) that are not part of archive_files'''
+    for filename in os.listdir(archive_dir):
+        path = os.path.join(archive_dir, filename)
+        if filename.startswith(name + '.') and (filename.endswith('.ark') or filename.endswith('.ark.tmp')) and path not in archive_files:
+            os.remove(path)
+
+def writeTable(filename, entries):
+    with io.open(filename + '.tmp', 'w', encoding='utf-8', errors='surrogateescape') as outfile:
+        for key, value in entries:
+            outfile.write(key + ' ' + value + '\n')
+    os.replace(filename + '.tmp', filename)
+
+def extractSegments(src_dir, dest_dir, archive_dir, jobs=1, min_segment_length=default_min_segment_length, max_overshoot=default_max_overshoot, force=False):
+    '''Writes a data dir without segments to dest_dir, the audio of its utterances goes to archives in archive_dir. Returns the number
+       of utterances and the number of segments that could not be extracted.'''
+    segments, recording_order = readSegments(os.path.join(src_dir, 'segments'))
+    num_segments = sum([len(recording_segments) for recording_segments in segments.values()])
+    if not force and isUpToDate(src_dir, dest_dir, archive_dir):
+        utts = set([utt for utt, rxfilename in audio_utils.readScp(os.path.join(dest_dir, 'wav.scp'))])
+        print('The archives in', archive_dir, 'are newer than the segments and wav.scp of', src_dir + ', only copying the utterance files.')
+        copyUtteranceFiles(src_dir, dest_dir, utts)
+        return len(utts), num_segments - len(utts)
+
+    wav_scp = dict(audio_utils.readScp(os.path.join(src_dir, 'wav.scp')))
+    missing = [reco for reco in recording_order if reco not in wav_scp]
+    if len(missing) > 0:
+        print('Warning,', len(missing), 'recordings of the segments file are not in wav.scp:', ' '.join(missing[:20]))
+    recordings = [(reco, wav_scp[reco], segments[reco]) for reco in recording_order if reco in wav_scp]
+
+    # files of an earlier extraction (feats.scp, cmvn.scp, ...) don't belong to the new archives, the index is only written again
+    # when the extraction is complete
+    if os.path.exists(dest_dir):
+        shutil.rmtree(dest_dir)
+    os.makedirs(dest_dir)
+    os.makedirs(archive_dir, exist_ok=True)
+    if os.path.exists(os.path.join(archive_dir, audio_archive.index_name)):
+        os.remove(os.path.join(archive_dir, audio_archive.index_name))
+    name = os.path.basename(os.path.normpath(dest_dir))
+    parts = splitJobs(recordings, max(1, jobs))
+    tasks = [(os.path.join(archive_dir, name + '.' + str(i + 1) + '.ark'), part, min_segment_length, max_overshoot) for i, part in enumerate(parts)]
+    print('Extracting', num_segments, 'segments of', len(recordings), 'recordings from', src_dir, 'with', len(tasks), 'jobs')
+    with Pool(processes=max(1, len(tasks))) as pool:
+        job_results = pool.map(extractJob, tasks, chunksize=1)
+
+    results, index, failed_recordings = [], [], 0
+    for (archive_file, part, min_length, overshoot), (job_result, entries, warnings, failed) in zip(tasks, job_results):
+        os.replace(archive_file + '.tmp', archive_file)
+        results += job_result
+        index += [(utt, archive_file, offset, size) for utt, offset, size in entries]
+        failed_recordings += failed
+        for warning in warnings:
+            print('Warning,', warning)
+
+    removeStaleShards(archive_dir, name, set([task[0] for task in tasks]))
+
+    writeTable(os.path.join(dest_dir, 'wav.scp'), [(utt, rxfilename) for utt, rxfilename, duration in results])
+    writeTable(os.path.join(dest_dir, 'utt2dur'), [(utt, repr(round(duration, 6))) for utt, rxfilename, duration in results])
+    copyUtteranceFiles(src_dir, dest_dir, set([utt for utt, rxfilename, duration in results]))
+    # the index is written last, it marks the extraction as complete (see isUpToDate)
+    audio_archive.writeIndex(os.path.join(archive_dir, audio_archive.index_name), index)
+
+    if failed_recordings > 0:
+        print('Warning, could not read', failed_recordings, 'recordings.')
+    return len(results), num_segments - len(results)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Cuts the segments of a data dir out of its recordings (decoding every recording once) into audio archives and writes a data dir without segments.')
+    parser.add_argument('src_dir', help='Data dir with segments and wav.scp', type=str)
+    parser.add_argument('dest_dir', help='New data dir with one wav.scp entry (archive:offset) per utterance', type=str)
+    parser.add_argument('archive_dir', help='Directory for the audio archives', type=str)
+    parser.add_argument('-j', '--jobs', dest='jobs', help='Number of jobs (processes and archives)', type=int, default=4)
+    parser.add_argument('--min-segment-length', dest='min_segment_length', help='Minimum segment length in seconds (like extract-segments)', type=float, default=default_min_segment_length)
+    parser.add_argument('--force', dest='force', help='Extract the segments again, also if the archives are newer than segments and wav.scp', action='store_true', default=False)
+    parser.add_argument('--max-overshoot', dest='max_overshoot', help='Segments that end at most this many seconds after the end of the recording are truncated (like extract-segments)', type=float, default=default_max_overshoot)
+
+    args = parser.parse_args()
+
+    extracted, skipped = extractSegments(args.src_dir, args.dest_dir, args.archive_dir, args.jobs, args.min_segment_length, args.max_overshoot, args.force)
+    print('Extracted', extracted, 'segments,', skipped, 'segments could not be extracted.')
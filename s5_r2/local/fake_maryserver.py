@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2022 Language Technology, Universitaet Hamburg (author: Benjamin Milde)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import print_function
+
+import argparse
+import random
+import sys
+import time
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+from xml.sax.saxutils import escape, quoteattr
+
+#
+# A local stand-in for the MARY TTS server, for testing maryclient, maryfy_corpus.py and the MARY server pool without Java and MARY.
+# It answers /process (OUTPUT_TYPE=PHONEMES) and /version like MARY 5.x does. The "phonemes" are just the lower cased letters of each
+# token, all upper case words are split into single letter tokens (like MARY does with acronyms). Responses can be delayed and
+# requests can fail randomly, to test timeouts and retries.
+#
+
+punctuation = '.,;:!?"()'
+
+def tokenize(text):
+    tokens = []
+    for word in text.split():
+        while len(word) > 0 and word[0] in punctuation:
+            tokens.append(word[0])
+            word = word[1:]
+        trailing = []
+        while len(word) > 0 and word[-1] in punctuation:
+            trailing.insert(0, word[-1])
+            word = word[:-1]
+        if word != '':
+            tokens.append(word)
+        tokens += trailing
+    return tokens
+
+def phonemes_xml(text, locale):
+    xml = ['<?xml version="1.0" encoding="UTF-8"?>',
+           '<maryxml xmlns="http://mary.dfki.de/2002/MaryXML" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" version="0.5" xml:lang=' + quoteattr(locale) + '>',
+           '<p>', '<s>']
+    for token in tokenize(text):
+        if token in punctuation:
+            xml.append('<t pos="$.">\n' + escape(token) + '\n</t>')
+        elif token.isupper() and token.isalpha() and len(token) > 1:
+            xml.append('<mtu orig=' + quoteattr(token) + '>')
+            for letter in token:
+                xml.append('<t g2p_method="rules" ph=' + quoteattr("' " + letter.lower() + ' e:') + ' pos="NN">\n' + escape(letter) + '\n</t>')
+            xml.append('</mtu>')
+        else:
+            xml.append('<t g2p_method="lexicon" ph=' + quoteattr("' " + ' '.join(token.lower())) + ' pos="NN">\n' + escape(token) + '\n</t>')
+    xml += ['</s>', '</p>', '</maryxml>']
+    return '\n'.join(xml) + '\n'
+
+class FakeMaryHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+    def reply(self, status, text):
+        data = text.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/plain; charset=UTF-8')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path.startswith('/version'):
+            self.reply(200, self.server.version + '\n')
+        else:
+            self.reply(404, 'not found\n')
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        params = parse_qs(self.rfile.read(length).decode('ascii'))
+
+        self.server.requests += 1
+        if self.server.delay > 0:
+            time.sleep(random.uniform(0, 2 * self.server.delay))
+        if random.random() < self.server.fail_rate:
+            # simulate a broken connection
+            self.close_connection = True
+            return
+
+        if not self.path.startswith('/process'):
+            self.reply(404, 'not found\n')
+            return
+        text = params.get('INPUT_TEXT', [''])[0]
+        locale = params.get('LOCALE', ['de'])[0]
+        self.reply(200, phonemes_xml(text, locale))
+
+def serve(port, delay=0.0, fail_rate=0.0, version='Mary TTS server 5.2 (fake)', verbose=False):
+    server = ThreadingHTTPServer(('127.0.0.1', port), FakeMaryHandler)
+    server.daemon_threads = True
+    server.delay = delay
+    server.fail_rate = fail_rate
+    server.version = version
+    server.verbose = verbose
+    server.requests = 0
+    return server
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Local stand-in for a MARY TTS server (PHONEMES output only), for testing.')
+    parser.add_argument('-p', '--port', dest='port', help='Listen on this port', type=int, default=59125)
+    parser.add_argument('-d', '--delay', dest='delay', help='Average delay of a response in seconds', type=float, default=0.0)
+    parser.add_argument('-f', '--fail-rate', dest='fail_rate', help='Fraction of requests that fail with a dropped connection', type=float, default=0.0)
+    parser.add_argument('-V', '--server-version', dest='version', help='Version string returned by /version', type=str, default='Mary TTS server 5.2 (fake)')
+    parser.add_argument('-v', '--verbose', dest='verbose', help='Log every request', action='store_true', default=False)
+
+    # the real MARY server is configured with java properties, e.g. marytts-server -Dsocket.port=59126, we understand this one as well
+    argv = []
+    for arg in sys.argv[1:]:
+        if arg.startswith('-Dsocket.port='):
+            argv += ['--port', arg[len('-Dsocket.port='):]]
+        else:
+            argv.append(arg)
+    args = parser.parse_args(argv)
+
+    server = serve(args.port, args.delay, args.fail_rate, args.version, args.verbose)
+    print('Fake MARY server listening on port', args.port)
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
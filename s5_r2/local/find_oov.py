@@ -19,11 +19,17 @@ from __future__ import print_function
 
 import io
 import argparse
+import apply_g2p
+import lexicon_store
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Finds out of vocabulary (OOV) words in a Kaldi text transcription file given a wordlist.')
     parser.add_argument('-c', '--corpus-text', dest='corpustext', help='process this Kali format transcription text file', type=str, default='data/train/text')
-    parser.add_argument('-w', '--wordlist', dest='wordlist', help='this is the current wordlist', type=str, default='wordlist.txt')
+    parser.add_argument('-w', '--wordlist', dest='wordlist', help='this is the current wordlist (set to an empty string to only use --lexicon-store)', type=str, default='wordlist.txt')
+    parser.add_argument('-g', '--g2p-model', dest='g2p_model', help='report how many OOV words are already predicted with this G2P model in the G2P cache', type=str, default='')
+    parser.add_argument('--g2p-cache', dest='g2p_cache', help='G2P cache file (see apply_g2p.py)', type=str, default=apply_g2p.g2p_cache_default_file)
+    parser.add_argument('-u', '--uncached-outfile', dest='uncached_outfile', help='write OOV words without a cached G2P prediction to this file (needs --g2p-model)', type=str, default='')
+    parser.add_argument('-l', '--lexicon-store', dest='lexicon_store', help='words in this lexicon store (see lexicon_store.py) are known words as well', type=str, default='')
     parser.add_argument('-o', '--outfile', dest='outfile', help='write OOV words to this file', type=str, default='oov.txt')
 #    parser.add_argument('-sph', '--sphinx-format', dest='sphinx_format', help='export lexicon in sphinx format', action='store_true', default=False)
 
@@ -32,13 +38,17 @@ if __name__ == '__main__':
 
     args = parser.parse_args()
 
-    with io.open(args.wordlist,'r',encoding='utf-8') as infile:
-        for line in infile:
-            if line[-1] == '\n':
-                line = line[:-1]
-            word = line
-            if word not in train_words:
-                train_words[word] = True
+    if args.wordlist != '':
+        with io.open(args.wordlist,'r',encoding='utf-8') as infile:
+            for line in infile:
+                if line[-1] == '\n':
+                    line = line[:-1]
+                word = line
+                if word not in train_words:
+                    train_words[word] = True
+
+    #words of the lexicon store are looked up on demand, the store is not loaded into memory
+    lexicon = lexicon_store.LexiconStore(args.lexicon_store) if args.lexicon_store != '' else {}
 
     with io.open(args.corpustext,'r',encoding='utf-8') as infile:
         for line in infile:
@@ -46,9 +56,22 @@ if __name__ == '__main__':
             for word in split:
                 if word not in train_words:
                     if word not in oov_words:
-                        oov_words[word] = True
+                        if word not in lexicon:
+                            oov_words[word] = True
+                        else:
+                            train_words[word] = True
 
     with io.open(args.outfile,'w',encoding='utf-8') as outfile:
         for word in sorted(list(oov_words.keys())):
             outfile.write(word + '\n')
 
+    if args.g2p_model != '':
+        cache = apply_g2p.openG2PCache(args.g2p_cache, args.g2p_model)
+        cached = cache.get_many(oov_words.keys()) if cache is not None else {}
+        uncached = sorted([word for word in oov_words if word not in cached])
+        print('Found', len(oov_words), 'OOV words,', len(cached), 'of them have cached G2P predictions,', len(uncached), 'are new.')
+        if args.uncached_outfile != '':
+            with io.open(args.uncached_outfile,'w',encoding='utf-8') as outfile:
+                for word in uncached:
+                    outfile.write(word + '\n')
+
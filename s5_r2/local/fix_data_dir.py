@@ -0,0 +1,230 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2022 Language Technology, Universitaet Hamburg (author: Benjamin Milde)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import print_function
+
+import argparse
+import io
+import os
+import sys
+
+#
+# Does what utils/fix_data_dir.sh does in one process: all files of a data dir (text, utt2spk, wav.scp, segments, feats.scp, cmvn.scp,
+# ...) are loaded once into an index (the keys are interned, so an utterance id shared by all files is stored once), the utterances
+# that are in all of the required files are kept, together with their speakers and recordings, and every file is written back
+# sorted like LC_ALL=C sort would sort it, with spk2utt regenerated. Duplicate keys keep their first line. Only files that changed
+# are written, the old versions go to data_dir/.backup/ and the dropped utterances, speakers and recordings with the reason are
+# listed in data_dir/.backup/fix_data_dir_report.txt:
+#
+#   python3 local/fix_data_dir.py data/tuda_train
+#
+# Like fix_data_dir.sh, utterances with a duration or number of frames that is not positive in utt2dur or utt2num_frames are dropped
+# too. --drop-empty-text also drops utterances that have no words in text.
+#
+
+# files with one line per utterance
+utterance_files = ['utt2spk', 'utt2uniq', 'feats.scp', 'vad.scp', 'text', 'segments', 'utt2lang', 'utt2dur', 'utt2num_frames', 'utt2gender']
+# an utterance has to be in all of these files that exist (and in wav.scp and reco2dur, if there are no segments)
+required_utterance_files = ['feats.scp', 'text', 'segments', 'utt2lang', 'utt2dur', 'utt2num_frames']
+# the value of an utterance in these files has to be positive
+positive_utterance_files = ['utt2dur', 'utt2num_frames']
+# files with one line per recording, if there are segments (otherwise wav.scp and reco2dur are utterance files)
+recording_files = ['wav.scp', 'reco2file_and_channel', 'reco2dur']
+# files with one line per speaker, spk2utt is written from utt2spk
+speaker_files = ['spk2gender', 'cmvn.scp', 'spk2warp']
+# a speaker has to be in all of these files that exist
+required_speaker_files = ['cmvn.scp', 'spk2gender']
+
+backup_dir_name = '.backup'
+report_name = 'fix_data_dir_report.txt'
+
+def cKey(key):
+    '''Sort key for the order of LC_ALL=C sort (bytes)'''
+    return key.encode('utf-8', 'surrogateescape')
+
+def readKaldiFile(filename):
+    '''{key: line} of a Kaldi file (with the first line of every key, keys are interned), and the duplicate keys'''
+    entries, duplicates = {}, []
+    with io.open(filename, 'r', encoding='utf-8', errors='surrogateescape', newline='\n') as infile:
+        for line in infile:
+            line = line.rstrip('\n')
+            split = line.split(None, 1)
+            if len(split) == 0:
+                continue
+            key = sys.intern(split[0])
+            if key in entries:
+                duplicates.append(key)
+            else:
+                entries[key] = line
+    return entries, duplicates
+
+def field(line, num):
+    '''Field num of a line, None if it has fewer fields'''
+    split = line.split(None, num + 1)
+    return sys.intern(split[num]) if len(split) > num else None
+
+def isPositive(value):
+    try:
+        return value is not None and float(value) > 0
+    except ValueError:
+        return False
+
+def writeIfChanged(data_dir, name, lines):
+    '''Writes the lines to data_dir/name if its content changes, the old file is moved to data_dir/.backup/ first. True if it was written.'''
+    filename = os.path.join(data_dir, name)
+    content = ''.join([line + '\n' for line in lines])
+    if os.path.exists(filename):
+        with io.open(filename, 'r', encoding='utf-8', errors='surrogateescape', newline='\n') as infile:
+            if infile.read() == content:
+                return False
+        backup_dir = os.path.join(data_dir, backup_dir_name)
+        os.makedirs(backup_dir, exist_ok=True)
+        os.replace(filename, os.path.join(backup_dir, name))
+    with io.open(filename + '.tmp', 'w', encoding='utf-8', errors='surrogateescape', newline='\n') as outfile:
+        outfile.write(content)
+    os.replace(filename + '.tmp', filename)
+    return True
+
+def fixDataDir(data_dir, drop_empty_text=False, verbose=True):
+    '''Fixes the data dir in place, returns (number of utterances kept, number of utterances before). Raises IOError if the data dir
+       has no utt2spk or no utterance is left.'''
+    if not os.path.exists(os.path.join(data_dir, 'utt2spk')):
+        raise IOError('No such file ' + os.path.join(data_dir, 'utt2spk'))
+    has_segments = os.path.exists(os.path.join(data_dir, 'segments'))
+    utt_names = utterance_files + ([] if has_segments else ['wav.scp', 'reco2dur'])
+    reco_names = recording_files if has_segments else ['reco2file_and_channel']
+    required_names = required_utterance_files + ([] if has_segments else ['wav.scp', 'reco2dur'])
+
+    files, report = {}, []
+    for name in utt_names + reco_names + speaker_files:
+        filename = os.path.join(data_dir, name)
+        # an empty reco2dur is ignored, like fix_data_dir.sh does
+        if os.path.exists(filename) and not (name == 'reco2dur' and os.path.getsize(filename) == 0):
+            files[name], duplicates = readKaldiFile(filename)
+            report += ['duplicate ' + key + ' ' + name for key in duplicates]
+    utt2spk = files['utt2spk']
+
+    # recordings that have a wav.scp entry (and a reco2file_and_channel entry) and segments
+    recordings = None
+    if has_segments:
+        recordings = set([field(line, 1) for line in files['segments'].values()])
+        for name in ['wav.scp', 'reco2file_and_channel']:
+            if name in files:
+                recordings &= set(files[name].keys())
+
+    # utterances that are in all required files, with their speaker and recording
+    dropped_utts = {}
+    for utt, line in utt2spk.items():
+        spk = field(line, 1)
+        missing = [name for name in required_names if name in files and utt not in files[name]]
+        not_positive = [name for name in positive_utterance_files if name in files and utt in files[name] and not isPositive(field(files[name][utt], 1))]
+        if spk is None:
+            dropped_utts[utt] = 'no speaker in utt2spk'
+        elif len(missing) > 0:
+            dropped_utts[utt] = 'not in ' + ', '.join(missing)
+        elif len(not_positive) > 0:
+            dropped_utts[utt] = ', '.join([name + ' is ' + str(field(files[name][utt], 1)) for name in not_positive])
+        elif has_segments and field(files['segments'][utt], 1) not in recordings:
+            dropped_utts[utt] = 'recording ' + str(field(files['segments'][utt], 1)) + ' not in wav.scp or without audio'
+        elif drop_empty_text and 'text' in files and field(files['text'][utt], 1) is None:
+            dropped_utts[utt] = 'empty text'
+
+    # speakers that are in all required speaker files
+    speakers = set([field(line, 1) for utt, line in utt2spk.items() if utt not in dropped_utts])
+    dropped_speakers = {}
+    for name in required_speaker_files:
+        if name in files:
+            for spk in speakers - set(files[name].keys()):
+                dropped_speakers[spk] = 'not in ' + name
+            speakers &= set(files[name].keys())
+    for utt, line in utt2spk.items():
+        if utt not in dropped_utts and field(line, 1) not in speakers:
+            dropped_utts[utt] = 'speaker ' + field(line, 1) + ' ' + dropped_speakers[field(line, 1)]
+    utts = sorted([utt for utt in utt2spk if utt not in dropped_utts], key=cKey)
+    if len(utts) == 0:
+        raise IOError('No utterances remained in ' + data_dir)
+
+    # recordings that still have segments
+    if has_segments:
+        used_recordings = set([field(files['segments'][utt], 1) for utt in utts])
+        report += ['recording ' + reco + ' no utterances left' for reco in sorted(recordings - used_recordings, key=cKey)]
+        segment_recordings = set([field(line, 1) for line in files['segments'].values()]) - set([None])
+        report += ['recording ' + reco + ' not in wav.scp' for reco in sorted(segment_recordings - recordings, key=cKey)]
+        recordings = used_recordings
+
+    report += ['utterance ' + utt + ' ' + reason for utt, reason in sorted(dropped_utts.items(), key=lambda item: cKey(item[0]))]
+    report += ['speaker ' + spk + ' ' + reason for spk, reason in sorted(dropped_speakers.items(), key=lambda item: cKey(item[0]))]
+
+    # write everything in C order
+    summary = []
+    keep = {}
+    for name in utt_names:
+        keep[name] = utts
+    for name in reco_names:
+        keep[name] = sorted(recordings, key=cKey) if has_segments else None
+    for name in speaker_files:
+        keep[name] = sorted(speakers, key=cKey)
+    for name in utt_names + reco_names + speaker_files:
+        if name not in files:
+            continue
+        if keep[name] is None:
+            # reco2file_and_channel without segments is only sorted
+            keep[name] = sorted(files[name].keys(), key=cKey)
+        lines = [files[name][key] for key in keep[name] if key in files[name]]
+        if len(lines) != len(files[name]):
+            summary.append('filtered ' + name + ' from ' + str(len(files[name])) + ' to ' + str(len(lines)) + ' lines')
+        writeIfChanged(data_dir, name, lines)
+
+    spk2utt = {}
+    for utt in utts:
+        spk2utt.setdefault(field(utt2spk[utt], 1), []).append(utt)
+    spk_order = sorted(spk2utt.keys(), key=cKey)
+    writeIfChanged(data_dir, 'spk2utt', [spk + ' ' + ' '.join(spk2utt[spk]) for spk in spk_order])
+    if [utt for spk in spk_order for utt in spk2utt[spk]] != utts:
+        print('Warning, utt2spk of', data_dir, 'is not in sorted order when sorted first on speaker-id (fix this by making speaker-ids prefixes of utt-ids)')
+
+    # the report of an earlier run is replaced
+    report_file = os.path.join(data_dir, backup_dir_name, report_name)
+    if len(report) > 0:
+        os.makedirs(os.path.dirname(report_file), exist_ok=True)
+        with io.open(report_file, 'w', encoding='utf-8', errors='surrogateescape') as outfile:
+            for line in report:
+                outfile.write(line + '\n')
+    elif os.path.exists(report_file):
+        os.remove(report_file)
+
+    if verbose:
+        for line in summary:
+            print(data_dir + ':', line)
+        if len(utts) != len(utt2spk):
+            print(data_dir + ': kept', len(utts), 'utterances out of', len(utt2spk), '(see', report_file + ')')
+        else:
+            print(data_dir + ': kept all', len(utts), 'utterances.')
+    return len(utts), len(utt2spk)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Fixes a Kaldi data dir like utils/fix_data_dir.sh (sorting all files, keeping only the utterances, speakers and recordings that are in all files), in one pass.')
+    parser.add_argument('data_dirs', help='Kaldi data dirs', type=str, nargs='+')
+    parser.add_argument('--drop-empty-text', dest='drop_empty_text', help='Also drop utterances without words in text', action='store_true', default=False)
+
+    args = parser.parse_args()
+
+    for data_dir in args.data_dirs:
+        try:
+            fixDataDir(data_dir, args.drop_empty_text)
+        except IOError as err:
+            print('Error:', err, file=sys.stderr)
+            sys.exit(1)
@@ -56,9 +56,13 @@ if [ -s $data/utt2dur ] && \
 elif [ -f $data/wav.scp ]; then
   echo "$0: obtaining durations from recordings"
 
+  # local/audio_utils.py reads the durations from the headers of the audio files (also for sox and sph2pipe commands), with a pool
+  # of threads. It only decodes entries it can't resolve from the headers and fails if some durations could not be determined.
+  if python3 local/audio_utils.py --jobs $[$nj*4] $data/wav.scp $data/reco2dur; then
+    echo "$0: successfully obtained recording lengths from the audio file headers"
   # if the wav.scp contains only lines of the form
   # utt1  /foo/bar/sph2pipe -f wav /baz/foo.sph |
-  if cat $data/wav.scp | perl -e '
+  elif cat $data/wav.scp | perl -e '
      while (<>) { s/\|\s*$/ |/;  # make sure final | is preceded by space.
              @A = split; if (!($#A == 5 && $A[1] =~ m/sph2pipe$/ &&
                                $A[2] eq "-f" && $A[3] eq "wav" && $A[5] eq "|")) { exit(1); }
@@ -121,8 +125,8 @@ elif [ -f $data/wav.scp ]; then
     for n in `seq $nj`; do
       cat $temp_data_dir/$n/reco2dur
     done > $data/reco2dur
+    rm -r $temp_data_dir
   fi
-  rm -r $temp_data_dir
 else
   echo "$0: Expected $data/wav.scp to exist"
   exit 1
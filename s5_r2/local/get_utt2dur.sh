@@ -43,9 +43,13 @@ if [ -s $data/segments ]; then
 elif [ -f $data/wav.scp ]; then
   echo "$0: segments file does not exist so getting durations from wave files"
 
+  # local/audio_utils.py reads the durations from the headers of the audio files (also for sox and sph2pipe commands), with a pool
+  # of threads. It only decodes entries it can't resolve from the headers and fails if some durations could not be determined.
+  if python3 local/audio_utils.py --jobs $[$nj*4] $data/wav.scp $data/utt2dur; then
+    echo "$0: successfully obtained utterance lengths from the audio file headers"
   # if the wav.scp contains only lines of the form
   # utt1  /foo/bar/sph2pipe -f wav /baz/foo.sph |
-  if cat $data/wav.scp | perl -e '
+  elif cat $data/wav.scp | perl -e '
      while (<>) { s/\|\s*$/ |/;  # make sure final | is preceded by space.
              @A = split; if (!($#A == 5 && $A[1] =~ m/sph2pipe$/ &&
                                $A[2] eq "-f" && $A[3] eq "wav" && $A[5] eq "|")) { exit(1); }
@@ -0,0 +1,248 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2022 Language Technology, Universitaet Hamburg (author: Benjamin Milde)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import print_function
+
+import argparse
+import io
+import mmap
+import pickle
+import struct
+import sys
+
+from array import array
+
+#
+# Compact binary lexicon store, an alternative to the combined.dict pickle of build_big_lexicon.py. The file is memory mapped, so opening it
+# is instant and only the parts that are looked up are read from disk. It consists of a header and these sections (little endian):
+#
+#   phones       phone table, utf-8, one phone per line (phone ids are line numbers)
+#   word_offsets uint32, num_words+1 offsets of the words in word_blob
+#   word_blob    utf-8 encoded words, sorted by their utf-8 bytes (= code point order, the order of sorted() in python)
+#   word_prons   uint32, num_words+1 indices of the first pronounciation of each word
+#   pron_phones  uint32, num_prons+1 indices of the first phone of each pronounciation
+#   phone_ids    uint16, phone ids of all pronounciations
+#   freqs        int32, frequency of each pronounciation
+#   manual       uint8, manual flag of each pronounciation
+#
+# Pronounciations of a word are stored in the order of the source dictionary. LexiconStore can be used like the dict of the pickle
+# (word -> list of {'pron','freq','manual'}), but it is read only.
+#
+# Convert a legacy pickle:
+#   python3 local/lexicon_store.py -i data/local/combined.dict -o data/local/combined.lex
+#
+
+magic = b'KTDELEX\x00'
+format_version = 1
+
+# magic, version, num_phones, num_words, num_prons, num_phone_ids and (offset, length) of each section
+sections = ['phones', 'word_offsets', 'word_blob', 'word_prons', 'pron_phones', 'phone_ids', 'freqs', 'manual']
+section_types = {'word_offsets':'I', 'word_prons':'I', 'pron_phones':'I', 'phone_ids':'H', 'freqs':'i', 'manual':'B'}
+header_format = '<8sIIIIQ' + 'QQ' * len(sections)
+header_size = struct.calcsize(header_format)
+
+def isLexiconStore(filename):
+    '''True if filename is a lexicon store (and not e.g. a pickle)'''
+    with open(filename, 'rb') as infile:
+        return infile.read(len(magic)) == magic
+
+def writeLexiconStore(filename, phoneme_dict):
+    '''Writes a pronounciation dictionary (word -> list of {'pron','freq','manual'}) as lexicon store'''
+    words = sorted(phoneme_dict.keys(), key=lambda word: word.encode('utf-8'))
+    phones = sorted(set([phone for entries in phoneme_dict.values() for entry in entries for phone in entry['pron']]))
+    if len(phones) > 65535:
+        raise ValueError('Too many distinct phones for the lexicon store: ' + str(len(phones)))
+    phone_id = dict([(phone, i) for i, phone in enumerate(phones)])
+
+    data = dict([(section, array(typecode)) for section, typecode in section_types.items()])
+    word_blob = io.BytesIO()
+    data['word_offsets'].append(0)
+    data['word_prons'].append(0)
+    data['pron_phones'].append(0)
+    for word in words:
+        word_blob.write(word.encode('utf-8'))
+        data['word_offsets'].append(word_blob.tell())
+        for entry in phoneme_dict[word]:
+            data['phone_ids'].extend([phone_id[phone] for phone in entry['pron']])
+            data['pron_phones'].append(len(data['phone_ids']))
+            data['freqs'].append(entry['freq'])
+            data['manual'].append(1 if entry['manual'] else 0)
+        data['word_prons'].append(len(data['freqs']))
+
+    for section_data in data.values():
+        if sys.byteorder != 'little':
+            section_data.byteswap()
+    data['phones'] = '\n'.join(phones).encode('utf-8')
+    data['word_blob'] = word_blob.getvalue()
+
+    with open(filename, 'wb') as outfile:
+        outfile.write(b'\x00' * header_size)
+        positions = []
+        for section in sections:
+            # sections are 8 byte aligned, so that they can be cast to arrays in place
+            outfile.write(b'\x00' * (-outfile.tell() % 8))
+            start = outfile.tell()
+            if isinstance(data[section], array):
+                data[section].tofile(outfile)
+            else:
+                outfile.write(data[section])
+            positions += [start, outfile.tell() - start]
+        outfile.seek(0)
+        outfile.write(struct.pack(header_format, magic, format_version, len(phones), len(words), len(data['freqs']), len(data['phone_ids']), *positions))
+
+class LexiconStore:
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.file = open(filename, 'rb')
+        self.mm = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        header = struct.unpack_from(header_format, self.mm, 0)
+        if header[0] != magic:
+            raise ValueError(filename + ' is not a lexicon store')
+        if header[1] != format_version:
+            raise ValueError(filename + ' has lexicon store format version ' + str(header[1]) + ', expected ' + str(format_version))
+        self.num_words, self.num_prons = header[3], header[4]
+
+        self.views = []
+        self.data = {}
+        for i, section in enumerate(sections):
+            start, length = header[6+2*i], header[7+2*i]
+            if section == 'word_blob':
+                self.word_blob_start = start
+            view = memoryview(self.mm)[start:start+length]
+            self.views.append(view)
+            if section in section_types:
+                if sys.byteorder == 'little':
+                    view = view.cast(section_types[section])
+                    self.views.append(view)
+                else:
+                    view = array(section_types[section], view.tobytes())
+                    view.byteswap()
+            self.data[section] = view
+
+        phones = bytes(self.data['phones']).decode('utf-8')
+        self.phones = phones.split('\n') if header[2] > 0 else []
+
+    def close(self):
+        # the memoryviews have to be released before the mmap can be closed
+        for view in reversed(self.views):
+            view.release()
+        self.views = []
+        self.data = {}
+        self.mm.close()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        return self.num_words
+
+    def wordBytes(self, i):
+        offsets = self.data['word_offsets']
+        return self.mm[self.word_blob_start+offsets[i]:self.word_blob_start+offsets[i+1]]
+
+    def word(self, i):
+        return self.wordBytes(i).decode('utf-8')
+
+    def find(self, word):
+        '''Index of word in the sorted word index (binary search), -1 if it is not in the lexicon'''
+        key = word.encode('utf-8')
+        lo, hi = 0, self.num_words
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.wordBytes(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.num_words and self.wordBytes(lo) == key:
+            return lo
+        return -1
+
+    def prons(self, i):
+        '''Pronounciation entries of the i-th word, in the same format as in the pickle'''
+        word_prons, pron_phones, phone_ids = self.data['word_prons'], self.data['pron_phones'], self.data['phone_ids']
+        freqs, manual, phones = self.data['freqs'], self.data['manual'], self.phones
+        return [{'pron':[phones[phone] for phone in phone_ids[pron_phones[p]:pron_phones[p+1]]], 'freq':freqs[p], 'manual':manual[p] == 1}
+                for p in range(word_prons[i], word_prons[i+1])]
+
+    def __contains__(self, word):
+        return self.find(word) != -1
+
+    def __getitem__(self, word):
+        i = self.find(word)
+        if i == -1:
+            raise KeyError(word)
+        return self.prons(i)
+
+    def get(self, word, default=None):
+        i = self.find(word)
+        return self.prons(i) if i != -1 else default
+
+    def keys(self):
+        '''All words, sorted'''
+        for i in range(self.num_words):
+            yield self.word(i)
+
+    __iter__ = keys
+
+    def values(self):
+        for i in range(self.num_words):
+            yield self.prons(i)
+
+    def items(self):
+        for i in range(self.num_words):
+            yield self.word(i), self.prons(i)
+
+    def to_dict(self):
+        return dict(self.items())
+
+def loadLexicon(filename):
+    '''Opens a lexicon store, or loads a legacy pickle of build_big_lexicon.py. Both can be used as read only dict of word -> pronounciations.'''
+    if isLexiconStore(filename):
+        return LexiconStore(filename)
+    with open(filename, 'rb') as infile:
+        return pickle.load(infile)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Converts a combined.dict pickle (build_big_lexicon.py -e) into a lexicon store and exports word lists and G2P training data from it.')
+    parser.add_argument('-i', '--input', dest='input', help='Lexicon store or legacy pickle', type=str, required=True)
+    parser.add_argument('-o', '--output', dest='output', help='Write a lexicon store to this file', type=str, default='')
+    parser.add_argument('-w', '--wordlist', dest='wordlist', help='Write all words (one per line, sorted) to this file', type=str, default='')
+    parser.add_argument('-g', '--g2p-train', dest='g2p_train', help='Write G2P training data (word followed by its phones, one line per pronounciation) to this file', type=str, default='')
+
+    args = parser.parse_args()
+
+    lexicon = loadLexicon(args.input)
+
+    if args.output != '':
+        print('Writing lexicon store', args.output)
+        writeLexiconStore(args.output, lexicon)
+
+    if args.wordlist != '':
+        with io.open(args.wordlist, 'w', encoding='utf-8') as outfile:
+            for word in sorted(lexicon.keys()):
+                outfile.write(word + '\n')
+
+    if args.g2p_train != '':
+        with io.open(args.g2p_train, 'w', encoding='utf-8') as outfile:
+            for word in sorted(lexicon.keys()):
+                for entry in lexicon[word]:
+                    outfile.write(word + ' ' + ' '.join(entry['pron']) + '\n')
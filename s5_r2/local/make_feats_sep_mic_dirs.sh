@@ -5,11 +5,11 @@
 
 for x in dev_a dev_b dev_c dev_d dev_e test_a test_b test_c test_d test_e; do
   echo "Creating features for: $x"
-  utils/fix_data_dir.sh data/$x # some files fail to get mfcc for many reasons
+  python3 local/fix_data_dir.py data/$x # some files fail to get mfcc for many reasons
   steps/make_mfcc.sh --cmd "$train_cmd" --nj $nJobs data/$x exp/make_mfcc/$x $mfccdir
-  utils/fix_data_dir.sh data/$x # some files fail to get mfcc for many reasons
+  python3 local/fix_data_dir.py data/$x # some files fail to get mfcc for many reasons
   steps/compute_cmvn_stats.sh data/$x exp/make_mfcc/$x $mfccdir
-  utils/fix_data_dir.sh data/$x
+  python3 local/fix_data_dir.py data/$x
 done
 
 for datadir in dev_a dev_b dev_c dev_d dev_e test_a test_b test_c test_d test_e; do
@@ -17,5 +17,5 @@ for datadir in dev_a dev_b dev_c dev_d dev_e test_a test_b test_c test_d test_e;
   utils/copy_data_dir.sh data/$datadir data/${datadir}_hires
   steps/make_mfcc.sh --nj $nJobs --mfcc-config conf/mfcc_hires.conf --cmd "$train_cmd" data/${datadir}_hires
   steps/compute_cmvn_stats.sh data/${datadir}_hires
-  utils/fix_data_dir.sh data/${datadir}_hires
+  python3 local/fix_data_dir.py data/${datadir}_hires
 done
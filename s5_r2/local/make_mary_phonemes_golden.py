@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2022 Language Technology, Universitaet Hamburg (author: Benjamin Milde)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import print_function
+
+import argparse
+import common_utils
+import io
+import json
+import os
+import sys
+import warnings
+
+#
+# Writes the expected tokens and phonemes of the golden set of MARY responses (mary_phonemes_golden.json, see benchmark_mary_parser.py)
+# with the old BeautifulSoup based parser (common_utils.legacyParseMaryPhonemes, with the default HTML parser of BeautifulSoup), so that
+# the expat parser is checked against the output of the original code. Needs BeautifulSoup (pip install beautifulsoup4). New documents
+# can be added to the golden file with only "sentence" and "maryxml" set, their expected output is filled in:
+#
+# python3 local/make_mary_phonemes_golden.py
+#
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Writes the expected output of the MARY PHONEMES golden set with the BeautifulSoup based parser.')
+    parser.add_argument('-g', '--golden', dest='golden', help='Golden set of MARY responses', type=str, default=os.path.join(os.path.dirname(os.path.abspath(__file__)),'mary_phonemes_golden.json'))
+
+    args = parser.parse_args()
+
+    try:
+        import bs4
+    except ImportError:
+        print('BeautifulSoup is needed to generate the golden set: pip install beautifulsoup4', file=sys.stderr)
+        sys.exit(1)
+    print('Using BeautifulSoup', bs4.__version__)
+    # BeautifulSoup warns that it parses xml with its HTML parser, which is what the old code did
+    warnings.simplefilter('ignore')
+
+    with io.open(args.golden, 'r', encoding='utf-8') as golden_file:
+        golden = json.load(golden_file)
+
+    changed = 0
+    for case in golden:
+        tokens, phonemes = common_utils.legacyParseMaryPhonemes(case['maryxml'])
+        if case.get('tokens') != list(tokens) or case.get('phonemes') != list(phonemes):
+            print('Changed:', case['sentence'], case.get('tokens'), '->', list(tokens), case.get('phonemes'), '->', list(phonemes))
+            changed += 1
+        case['tokens'] = list(tokens)
+        case['phonemes'] = list(phonemes)
+
+    with io.open(args.golden, 'w', encoding='utf-8') as golden_file:
+        golden_file.write(json.dumps(golden, ensure_ascii=False, indent=1))
+    print('Wrote', len(golden), 'documents to', args.golden + ',', changed, 'changed.')
@@ -0,0 +1,257 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2022 Language Technology, Universitaet Hamburg (author: Benjamin Milde)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import print_function
+
+import argparse
+import multiprocessing
+import os
+import shlex
+import signal
+import subprocess
+import threading
+import time
+
+try:
+    from urllib.request import urlopen
+except ImportError:
+    from urllib2 import urlopen
+
+#
+# Supervisor for a pool of MARY TTS server instances. MaryServerPool starts N instances on distinct ports and waits until they answer
+# /version, instead of sleeping a fixed amount of time. Clients (see maryclient.endpoints) pick the least loaded instance that is up
+# through a MaryEndpoints object that is shared between processes. A monitor thread recycles one instance at a time, once it served
+# max_requests requests, its memory grew by more than max_rss_growth MB, max_failures requests in a row failed or it died. The other
+# instances keep serving requests in the meantime, so throughput never drops to zero.
+#
+# The command to start an instance is a template with a {port} placeholder, e.g. for MARY 5.x:
+#   bash /opt/marytts/bin/marytts-server -Dsocket.port={port}
+# or, for testing:
+#   python3 local/fake_maryserver.py -Dsocket.port={port}
+#
+
+class MaryEndpoints:
+    '''State of the MARY instances that is shared between processes: which instances are up, their load and how many requests they served.'''
+
+    def __init__(self, ports):
+        self.ports = list(ports)
+        self.lock = multiprocessing.Lock()
+        self.up = multiprocessing.Array('b', len(self.ports), lock=False)
+        self.in_flight = multiprocessing.Array('i', len(self.ports), lock=False)
+        self.served = multiprocessing.Array('l', len(self.ports), lock=False)
+        self.failed = multiprocessing.Array('l', len(self.ports), lock=False)
+        self.next_instance = multiprocessing.Value('l', 0, lock=False)
+
+    def acquire(self, timeout=300.0):
+        '''Returns the index of the least loaded instance that is up (round robin among equally loaded instances) and counts the request as in flight.'''
+        deadline = time.time() + timeout
+        while True:
+            with self.lock:
+                best = -1
+                num = len(self.ports)
+                for offset in range(num):
+                    i = (self.next_instance.value + offset) % num
+                    if self.up[i] and (best == -1 or self.in_flight[i] < self.in_flight[best]):
+                        best = i
+                if best != -1:
+                    self.in_flight[best] += 1
+                    self.next_instance.value = (best + 1) % num
+                    return best
+            if time.time() > deadline:
+                raise RuntimeError('No MARY server instance is up')
+            time.sleep(0.1)
+
+    def release(self, i, failed=False):
+        with self.lock:
+            self.in_flight[i] -= 1
+            self.served[i] += 1
+            # failed counts consecutive failures, a single failed request in between successful ones doesn't recycle an instance
+            if failed:
+                self.failed[i] += 1
+            else:
+                self.failed[i] = 0
+
+    def set_up(self, i, up):
+        with self.lock:
+            self.up[i] = 1 if up else 0
+            if up:
+                self.served[i] = 0
+                self.failed[i] = 0
+
+    def any_up(self):
+        with self.lock:
+            return any(self.up)
+
+def process_group_rss(pgid):
+    '''Resident memory in MB of all processes in a process group (the start script and the JVM), Linux only'''
+    rss_pages = 0
+    try:
+        pids = [pid for pid in os.listdir('/proc') if pid.isdigit()]
+    except OSError:
+        return 0.0
+    for pid in pids:
+        try:
+            with open('/proc/' + pid + '/stat') as stat_in:
+                stat = stat_in.read()
+            # the process name can contain spaces, fields after it are well defined
+            fields = stat[stat.rindex(')')+2:].split()
+            if int(fields[2]) == pgid:
+                rss_pages += int(fields[21])
+        except (IOError, OSError, ValueError, IndexError):
+            continue
+    return rss_pages * os.sysconf('SC_PAGE_SIZE') / 1024.0 / 1024.0
+
+class MaryServerPool:
+
+    def __init__(self, command, num_instances=2, base_port=59125, max_requests=20000, max_rss_growth=0.0, max_failures=3,
+                 startup_timeout=180.0, check_interval=2.0, host='127.0.0.1'):
+        self.command = command
+        self.host = host
+        self.endpoints = MaryEndpoints(range(base_port, base_port + num_instances))
+        self.max_requests = max_requests
+        self.max_rss_growth = max_rss_growth
+        self.max_failures = max_failures
+        self.startup_timeout = startup_timeout
+        self.check_interval = check_interval
+
+        self.procs = [None] * num_instances
+        self.rss_baseline = [0.0] * num_instances
+        self.monitor_thread = None
+        self.stopping = threading.Event()
+
+    def instance_command(self, i):
+        port = str(self.endpoints.ports[i])
+        return [arg.replace('{port}', port) for arg in shlex.split(self.command)]
+
+    def is_ready(self, i):
+        try:
+            response = urlopen('http://' + self.host + ':' + str(self.endpoints.ports[i]) + '/version', timeout=2.0)
+            return response.getcode() == 200
+        except Exception:
+            return False
+
+    def launch(self, i):
+        # each instance gets its own process group, so that we can stop the start script together with the JVM it spawned
+        self.procs[i] = subprocess.Popen(self.instance_command(i), stdout=subprocess.DEVNULL, start_new_session=True)
+
+    def wait_ready(self, i):
+        deadline = time.time() + self.startup_timeout
+        while not self.is_ready(i):
+            if self.procs[i].poll() is not None:
+                raise RuntimeError('MARY instance on port ' + str(self.endpoints.ports[i]) + ' exited with code ' + str(self.procs[i].returncode))
+            if time.time() > deadline:
+                raise RuntimeError('MARY instance on port ' + str(self.endpoints.ports[i]) + ' did not become ready within ' + str(self.startup_timeout) + 's')
+            time.sleep(0.2)
+        self.rss_baseline[i] = process_group_rss(self.procs[i].pid)
+        self.endpoints.set_up(i, True)
+
+    def stop_instance(self, i, timeout=10.0):
+        self.endpoints.set_up(i, False)
+        proc = self.procs[i]
+        if proc is None:
+            return
+        if proc.poll() is None:
+            try:
+                os.killpg(proc.pid, signal.SIGTERM)
+                proc.wait(timeout)
+            except subprocess.TimeoutExpired:
+                os.killpg(proc.pid, signal.SIGKILL)
+                proc.wait()
+            except OSError:
+                pass
+        self.procs[i] = None
+
+    def recycle(self, i, reason, drain_timeout=30.0):
+        '''Takes instance i out of rotation, waits for its requests to finish and restarts it'''
+        print('Recycling MARY instance on port', self.endpoints.ports[i], '(' + reason + ')')
+        self.endpoints.set_up(i, False)
+        deadline = time.time() + drain_timeout
+        while self.endpoints.in_flight[i] > 0 and time.time() < deadline:
+            time.sleep(0.1)
+        self.stop_instance(i)
+        self.launch(i)
+        self.wait_ready(i)
+
+    def start(self):
+        '''Starts all instances (in parallel) and the monitor thread, returns once all instances are ready'''
+        for i in range(len(self.procs)):
+            self.launch(i)
+        for i in range(len(self.procs)):
+            self.wait_ready(i)
+        print('MARY server pool is up on ports', ' '.join([str(port) for port in self.endpoints.ports]))
+        self.monitor_thread = threading.Thread(target=self.monitor, name='mary_supervisor')
+        self.monitor_thread.daemon = True
+        self.monitor_thread.start()
+        return self.endpoints
+
+    def recycle_reason(self, i):
+        if self.procs[i] is None or self.procs[i].poll() is not None:
+            return 'process died'
+        if self.max_failures > 0 and self.endpoints.failed[i] >= self.max_failures:
+            return str(self.endpoints.failed[i]) + ' failed requests in a row'
+        if self.max_requests > 0 and self.endpoints.served[i] >= self.max_requests:
+            return str(self.endpoints.served[i]) + ' requests served'
+        if self.max_rss_growth > 0:
+            growth = process_group_rss(self.procs[i].pid) - self.rss_baseline[i]
+            if growth > self.max_rss_growth:
+                return 'memory grew by %.0f MB' % growth
+        return None
+
+    def monitor(self):
+        # recycles at most one instance at a time, the others keep serving requests
+        while not self.stopping.wait(self.check_interval):
+            for i in range(len(self.procs)):
+                if self.stopping.is_set():
+                    break
+                reason = self.recycle_reason(i)
+                if reason is not None:
+                    try:
+                        self.recycle(i, reason)
+                    except RuntimeError as err:
+                        print('Warning, could not restart MARY instance:', err)
+
+    def close(self):
+        self.stopping.set()
+        if self.monitor_thread is not None:
+            self.monitor_thread.join()
+        for i in range(len(self.procs)):
+            self.stop_instance(i)
+
+def script_command(scriptpath):
+    '''Command template for a MARY start script (e.g. marytts-server), or the script argument itself if it is already a template'''
+    if '{port}' in scriptpath:
+        return scriptpath
+    return 'bash ' + shlex.quote(scriptpath) + ' -Dsocket.port={port}'
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Runs a supervised pool of MARY TTS servers on consecutive ports until interrupted.')
+    parser.add_argument('-m', '--mary', dest='mary', help='MARY start script, or a command template with a {port} placeholder', type=str, required=True)
+    parser.add_argument('-n', '--instances', dest='instances', help='Number of MARY instances', type=int, default=2)
+    parser.add_argument('-p', '--base-port', dest='base_port', help='Port of the first instance', type=int, default=59125)
+    parser.add_argument('--max-requests', dest='max_requests', help='Recycle an instance after this many requests (0 = never)', type=int, default=20000)
+    parser.add_argument('--max-rss-growth', dest='max_rss_growth', help='Recycle an instance when its memory grew by this many MB (0 = never)', type=float, default=0.0)
+
+    args = parser.parse_args()
+
+    pool = MaryServerPool(script_command(args.mary), args.instances, args.base_port, args.max_requests, args.max_rss_growth)
+    pool.start()
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        pool.close()
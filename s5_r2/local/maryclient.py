@@ -27,6 +27,17 @@ import ctypes
 import sys
 import traceback
 
+import asyncio
+import collections
+import concurrent.futures
+import threading
+import time
+
+try:
+    from urllib.parse import urlencode
+except ImportError:
+    from urllib import urlencode
+
 #
 # A simple MARY TTS client (5.x) in Python, only generates intermidate MARY TTS phoneme format. 
 # This class reuses connections with the request framework (esp. helpful for bulk processing), but you have to install it:
@@ -46,6 +57,9 @@ class maryclient:
         self.audio = 'WAVE_FILE'
         self.locale = 'de'
         self.voice = ''
+        self.server_version = None
+        # shared state of a supervised pool of MARY servers (see mary_supervisor.py), requests are routed to the least loaded instance
+        self.endpoints = None
 
         self.reserve(connections)
 
@@ -64,10 +78,269 @@ class maryclient:
                 #'AUDIO': self.audio,
                 #'VOICE': self.voice,
                 }
-        r = self.connection_pool[connection_pool_num].post('http://'+self.host+':'+str(self.port)+'/process',data=params,timeout=(10.0,10.0))
+        if self.endpoints is None:
+            r = self.connection_pool[connection_pool_num].post('http://'+self.host+':'+str(self.port)+'/process',data=params,timeout=(10.0,10.0))
+        else:
+            instance = self.endpoints.acquire()
+            failed = True
+            try:
+                r = self.connection_pool[connection_pool_num].post('http://'+self.host+':'+str(self.endpoints.ports[instance])+'/process',data=params,timeout=(10.0,10.0))
+                failed = (r.status_code != requests.codes.ok)
+            finally:
+                self.endpoints.release(instance, failed)
         
         if r.status_code != requests.codes.ok:
             raise RuntimeError('error in http request:'+str(r.status_code))
         
         returnbuffer = r.text
         return returnbuffer
+
+    def version(self):
+        '''Returns the version string of the MARY server (asked only once per client). It is part of the key for cached MARY results.'''
+        if self.server_version is None:
+            port = self.port
+            if self.endpoints is not None:
+                # all instances of a pool run the same MARY installation
+                instance = self.endpoints.acquire()
+                self.endpoints.release(instance)
+                port = self.endpoints.ports[instance]
+            r = self.connection_pool[0].get('http://'+self.host+':'+str(port)+'/version',timeout=(10.0,10.0))
+            if r.status_code != requests.codes.ok:
+                raise RuntimeError('error in http request:'+str(r.status_code))
+            self.server_version = ' '.join(r.text.split())
+        return self.server_version
+
+
+#
+# An asyncio based MARY TTS client. It keeps up to in_flight keep-alive HTTP connections to the MARY server busy at the same time,
+# so that a single process can saturate the server. The event loop runs in a background thread, which means that the client can
+# be used from normal (synchronous) code as well:
+#
+#   mary = asyncmaryclient(in_flight=16)
+#   for maryxml in mary.generate_many(sentences):    # streaming, results are returned in input order
+#       ...
+#   maryxml = mary.generate(sentence)                 # same as maryclient.generate
+#
+# Requests that time out or fail because of a broken connection are retried with exponential backoff. With endpoints (see
+# mary_supervisor.py), every request goes to the least loaded instance of the pool, keep-alive connections are kept per instance.
+# Only needs the python standard library. See fake_maryserver.py for a local stand-in MARY server that can be used for testing.
+#
+
+class MaryConnectionError(IOError):
+    pass
+
+class asyncmaryclient:
+
+    def __init__(self, in_flight = 8, timeout = 10.0, retries = 3, backoff = 0.5):
+
+        self.host = '127.0.0.1'
+        self.port = 59125
+        self.input_type = 'TEXT'
+        self.output_type = 'PHONEMES'
+        self.audio = 'WAVE_FILE'
+        self.locale = 'de'
+        self.voice = ''
+        self.server_version = None
+        # shared state of a supervised pool of MARY servers (see mary_supervisor.py), requests are routed to the least loaded instance
+        self.endpoints = None
+
+        self.in_flight = in_flight
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+
+        self.loop = None
+        self.thread = None
+        # bounds the number of requests in flight
+        self.slots = None
+        # idle keep-alive connections by port, each one is [reader, writer]
+        self.idle = None
+
+    def start(self):
+        '''Starts the event loop thread, this is done automatically on the first request'''
+        if self.loop is None:
+            self.loop = asyncio.new_event_loop()
+            self.thread = threading.Thread(target=self.loop.run_forever, name='asyncmaryclient')
+            self.thread.daemon = True
+            self.thread.start()
+            asyncio.run_coroutine_threadsafe(self._reserve(), self.loop).result()
+        return self.loop
+
+    def close(self):
+        if self.loop is not None:
+            asyncio.run_coroutine_threadsafe(self._close_connections(), self.loop).result()
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.thread.join()
+            self.loop.close()
+            self.loop = None
+            self.thread = None
+
+    async def _reserve(self):
+        self.slots = asyncio.Semaphore(self.in_flight)
+        self.idle = {}
+
+    async def _close_connections(self):
+        for connections in self.idle.values():
+            for connection in connections:
+                self._drop(connection)
+        self.idle = {}
+
+    def _drop(self, connection):
+        if connection[1] is not None:
+            connection[1].close()
+        connection[0],connection[1] = None,None
+
+    async def _http(self, connection, port, method, path, body=b''):
+        '''Sends one HTTP/1.1 request over a keep-alive connection and returns status code and response text'''
+        if connection[1] is None:
+            connection[0],connection[1] = await asyncio.open_connection(self.host, port)
+        reader,writer = connection
+
+        header = method + ' ' + path + ' HTTP/1.1\r\nHost: ' + self.host + ':' + str(port) + '\r\nConnection: keep-alive\r\n'
+        if method == 'POST':
+            header += 'Content-Type: application/x-www-form-urlencoded\r\nContent-Length: ' + str(len(body)) + '\r\n'
+        writer.write((header + '\r\n').encode('ascii') + body)
+        await writer.drain()
+
+        status_line = await reader.readline()
+        if status_line == b'':
+            raise MaryConnectionError('connection closed by MARY server')
+        status = int(status_line.split()[1])
+
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            key,value = line.decode('latin-1').split(':', 1)
+            headers[key.strip().lower()] = value.strip()
+
+        if 'content-length' in headers:
+            data = await reader.readexactly(int(headers['content-length']))
+        elif headers.get('transfer-encoding', '').lower() == 'chunked':
+            data = b''
+            while True:
+                chunk_size = int((await reader.readline()).split(b';')[0], 16)
+                if chunk_size == 0:
+                    await reader.readline()
+                    break
+                data += await reader.readexactly(chunk_size)
+                await reader.readline()
+        else:
+            data = await reader.read()
+            headers['connection'] = 'close'
+
+        if headers.get('connection', '').lower() == 'close':
+            self._drop(connection)
+
+        charset = 'utf-8'
+        if 'charset=' in headers.get('content-type', ''):
+            charset = headers['content-type'].split('charset=')[1].split(';')[0].strip()
+
+        return status,data.decode(charset)
+
+    async def _acquire(self, timeout=300.0):
+        '''Index of the least loaded instance of the endpoints, without blocking the event loop while no instance is up'''
+        deadline = time.time() + timeout
+        while True:
+            try:
+                return self.endpoints.acquire(timeout=0.0)
+            except RuntimeError:
+                if time.time() > deadline:
+                    raise
+            await asyncio.sleep(0.1)
+
+    async def _request(self, method, path, body=b''):
+        '''Sends the request over an idle connection (or a new one) to the server or the least loaded instance of the endpoints.
+           Timeouts and connection errors are retried with exponential backoff.'''
+        attempt = 0
+        while True:
+            async with self.slots:
+                instance = None
+                port = self.port
+                if self.endpoints is not None:
+                    instance = await self._acquire()
+                    port = self.endpoints.ports[instance]
+                idle = self.idle.setdefault(port, [])
+                connection = idle.pop() if len(idle) > 0 else [None, None]
+                failed = True
+                try:
+                    status,text = await asyncio.wait_for(self._http(connection, port, method, path, body), self.timeout)
+                    failed = (status != 200)
+                    return status,text
+                except (asyncio.TimeoutError, asyncio.IncompleteReadError, MaryConnectionError, ConnectionError, OSError) as err:
+                    self._drop(connection)
+                    if attempt >= self.retries:
+                        raise MaryConnectionError('MARY request failed after ' + str(attempt+1) + ' attempts: ' + repr(err))
+                except:
+                    self._drop(connection)
+                    raise
+                finally:
+                    if connection[1] is not None:
+                        idle.append(connection)
+                    if instance is not None:
+                        self.endpoints.release(instance, failed)
+            await asyncio.sleep(self.backoff * (2 ** attempt))
+            attempt += 1
+
+    async def agenerate(self, message):
+        '''Coroutine version of generate, can be used directly in asyncio code running on this client's loop'''
+        params = {'INPUT_TEXT': message.encode('utf-8'),
+                'INPUT_TYPE': self.input_type,
+                'OUTPUT_TYPE': self.output_type,
+                'LOCALE': self.locale
+                }
+        status,text = await self._request('POST', '/process', urlencode(params).encode('ascii'))
+        if status != 200:
+            raise RuntimeError('error in http request:'+str(status))
+        return text
+
+    def generate(self, message, connection_pool_num=0):
+        '''Sends the text string in message to the MARY server and returns the result (blocking).
+           connection_pool_num is only there for compatibility with maryclient and is ignored.'''
+        loop = self.start()
+        return asyncio.run_coroutine_threadsafe(self.agenerate(message), loop).result()
+
+    def generate_many(self, messages, return_exceptions=False):
+        '''Streams the results for all messages in input order. Messages are read lazily from the iterable, so that only a bounded number
+           of requests is pending at any time. If return_exceptions is set, failed requests return their exception instead of raising it.
+           Messages that are None (e.g. sentences that are already cached) are not sent, their result is None.'''
+        loop = self.start()
+        pending = collections.deque()
+
+        # we queue a few more requests than there are connections, so that connections don't idle while results are consumed
+        window = 2 * self.in_flight
+
+        try:
+            for message in messages:
+                if message is None:
+                    future = concurrent.futures.Future()
+                    future.set_result(None)
+                    pending.append(future)
+                else:
+                    pending.append(asyncio.run_coroutine_threadsafe(self.agenerate(message), loop))
+                if len(pending) >= window:
+                    yield self._result(pending.popleft(), return_exceptions)
+            while len(pending) > 0:
+                yield self._result(pending.popleft(), return_exceptions)
+        finally:
+            for future in pending:
+                future.cancel()
+
+    def _result(self, future, return_exceptions):
+        try:
+            return future.result()
+        except Exception as err:
+            if return_exceptions:
+                return err
+            raise
+
+    def version(self):
+        '''Returns the version string of the MARY server (asked only once per client)'''
+        if self.server_version is None:
+            loop = self.start()
+            status,text = asyncio.run_coroutine_threadsafe(self._request('GET', '/version'), loop).result()
+            if status != 200:
+                raise RuntimeError('error in http request:'+str(status))
+            self.server_version = ' '.join(text.split())
+        return self.server_version
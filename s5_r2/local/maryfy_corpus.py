@@ -12,111 +12,196 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+from __future__ import print_function
+
 import common_utils
 import argparse
 import codecs
-import multiprocessing
+import collections
+import json
+import mary_supervisor
 import maryclient
-import subprocess
-import time
-
-import RemoteException
-
-from functools import partial
+import os
+import threading
 
 from multiprocessing import Pool
 
 ignore_lines = ['<','#']
-buffer_size = 500
 
-@RemoteException.showError
-def processLine(line,mary,scriptpath):
-    #http://stackoverflow.com/questions/10190981/get-a-unique-id-for-worker-in-python-multiprocessing-pool
+#
+# The corpus is processed as a stream: a reader feeds input lines into a bounded work queue, the main process sends the lines that are
+# not cached yet to MARY with an asyncio client (maryclient.asyncmaryclient) that keeps --in-flight requests going at the same time,
+# a pool of workers (imap with a chunk size) parses the MARY results and the main process writes them in input order as soon as they
+# are ready. After every checkpoint_every lines, the output is flushed to disk and the number of committed input lines is stored in
+# <output>.checkpoint. If the job is killed, running it again with the same arguments truncates the output to the last checkpoint and
+# resumes from there.
+#
+
+#cache of a worker process, set by initWorker
+worker_cache = None
+
+def initWorker(cache):
+    global worker_cache
+    worker_cache = cache
+
+def maryRequests(numbered_lines,mary,cache,meta):
+    '''Yields the message for MARY of every line, None for lines that are cached. (lineno, line, cache key, cached result) of every line is appended to meta.'''
+    for lineno,line in numbered_lines:
+        cache_key,cached = None,None
+        if cache is not None:
+            cache_key = common_utils.maryCacheKey(line,mary)
+            cached = cache.get(cache_key)
+        meta.append((lineno,line,cache_key,cached))
+        yield common_utils.applyPreMaryRules(line) if cached is None else None
+    # this runs in the task thread of the worker pool, which also owns the sqlite connection of the cache
+    if cache is not None:
+        cache.flush()
+
+def maryResults(numbered_lines,mary,cache):
+    '''Yields (lineno, line, cache key, cached result, MARY xml or the exception of a failed request) in input order'''
+    meta = collections.deque()
+    for maryxml in mary.generate_many(maryRequests(numbered_lines,mary,cache,meta),return_exceptions=True):
+        yield meta.popleft() + (maryxml,)
+
+def processResult(result):
+    lineno,line,cache_key,cached,maryxml = result
     tokens = []
     try:
-        proc_num = multiprocessing.current_process()._identity[0]-1
-        tokens,phonemes = common_utils.getCleanTokensAndPhonemes(line,mary,proc_num)
+        if cached is not None:
+            tokens = cached[0]
+        elif isinstance(maryxml,Exception):
+            raise maryxml
+        else:
+            tokens,phonemes = common_utils.parseMaryPhonemes(maryxml)
+            assert(len(tokens)==len(phonemes))
+            if worker_cache is not None:
+                worker_cache.put(cache_key,[tokens,phonemes])
     except Exception as err:
-        print '[',proc_num,']','Error, omitting', line
-        print err
-        if scriptpath != '' and ('Read timed out' in str(err)):
-            print 'restarting maryServer'
-            restartMaryServer(scriptpath,None)
-    return ' '.join(tokens)
-
-def processBuffer(workerpool,mary,mybuffer,outfile,scriptpath):
-    func = partial(processLine, mary=mary,scriptpath=scriptpath)
-    sentences = workerpool.map(func, mybuffer)
-    for sentence in sentences:
-        if sentence != '':
-            outputfile.write(sentence+'\n')
-
-def startMaryServer(scriptpath):
-    maryproc=subprocess.Popen(['bash', scriptpath], stdout=subprocess.PIPE)
-    time.sleep(5.0)
-    return maryproc
-
-def restartMaryServer(scriptpath,maryproc):
-    #maryproc.terminate()
-    #maryproc.kill()
-    proc=subprocess.Popen(['killall','-9','java'], stdout=subprocess.PIPE)
-    time.sleep(1.0)
-    return startMaryServer(scriptpath)
+        print('[',os.getpid(),']','Error, omitting', line)
+        print(err)
+    return lineno,' '.join(tokens)
+
+def readCorpus(inputfile,skip_lines,pending):
+    '''Yields (lineno, line) for all lines after skip_lines. Comment lines are not counted. The pending semaphore bounds the number of lines that are read but not written yet.'''
+    lineno = 0
+    for line in inputfile:
+        if any([line.startswith(elem) for elem in ignore_lines]):
+            continue
+        lineno += 1
+        if lineno <= skip_lines:
+            continue
+        pending.acquire()
+        yield lineno,line
+
+def loadCheckpoint(checkpoint_file,inputfile):
+    if not os.path.isfile(checkpoint_file):
+        return None
+    with open(checkpoint_file) as checkpoint_in:
+        checkpoint = json.load(checkpoint_in)
+    if checkpoint['input'] != os.path.abspath(inputfile):
+        print('Warning, ignoring checkpoint',checkpoint_file,'it belongs to another input file:',checkpoint['input'])
+        return None
+    return checkpoint
+
+def writeCheckpoint(checkpoint_file,inputfile,outputfile,lineno):
+    '''Makes sure everything up to lineno is on disk and then atomically replaces the checkpoint file'''
+    outputfile.flush()
+    os.fsync(outputfile.fileno())
+    checkpoint = {'input':os.path.abspath(inputfile), 'lines':lineno, 'output_bytes':outputfile.tell()}
+    with open(checkpoint_file+'.tmp','w') as checkpoint_out:
+        json.dump(checkpoint,checkpoint_out)
+        checkpoint_out.flush()
+        os.fsync(checkpoint_out.fileno())
+    os.replace(checkpoint_file+'.tmp',checkpoint_file)
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Prepares a German text corpus, each sentence on a new line, with MARYs TTS frontend.')
     parser.add_argument('-i', '--input', dest='input', help='Input corpus file', type=str, default = '')
     parser.add_argument('-o', '--output', dest='output', help='Output corpus file', type=str, default='')
-    parser.add_argument('-p', '--num-proc', dest='num_proc', help='Number of processes to use for MARYs TTS server', type=int, default=1)
+    parser.add_argument('-p', '--num-proc', dest='num_proc', help='Number of processes that parse the MARY results', type=int, default=1)
+    parser.add_argument('--in-flight', dest='in_flight', help='Number of concurrent requests to the MARY server(s)', type=int, default=16)
     parser.add_argument('-s', '--skip', dest='skip_lines', help='Skip this number of lines in the input file', type=int, default=0)
-    parser.add_argument('-a', '--append', dest='append', help='Skip this number of lines in the input file', action='store_true')
-
-    parser.add_argument('-m', '--mary', dest='mary', help='Run MARY TTS server with this script', type=str, default='')
+    parser.add_argument('-a', '--append', dest='append', help='Append to the output file instead of overwriting it', action='store_true')
+    parser.add_argument('--chunksize', dest='chunksize', help='Number of lines handed to a worker at once', type=int, default=16)
+    parser.add_argument('--max-pending', dest='max_pending', help='Maximum number of lines that are read, but not yet written to the output file', type=int, default=10000)
+    parser.add_argument('--checkpoint-every', dest='checkpoint_every', help='Write a checkpoint every n lines', type=int, default=5000)
+    parser.add_argument('--no-resume', dest='no_resume', help='Ignore an existing checkpoint of a previous run and start from scratch (or from --skip)', action='store_true')
+
+    parser.add_argument('-m', '--mary', dest='mary', help='Run MARY TTS servers with this script (or a command template with a {port} placeholder), otherwise a running server on the default port is used', type=str, default='')
+    parser.add_argument('-n', '--mary-instances', dest='mary_instances', help='Number of MARY servers to run with --mary', type=int, default=2)
+    parser.add_argument('--mary-base-port', dest='mary_base_port', help='Port of the first MARY server, the others use the following ports', type=int, default=59125)
+    parser.add_argument('--mary-max-requests', dest='mary_max_requests', help='Restart a MARY server after this many requests (0 = never)', type=int, default=20000)
+    parser.add_argument('--mary-max-rss-growth', dest='mary_max_rss_growth', help='Restart a MARY server when its memory grew by this many MB (0 = never)', type=float, default=0.0)
+    parser.add_argument('-c', '--mary-cache', dest='mary_cache', help='Persistent cache file for MARY results (shared with data_prepare.py), set to an empty string to disable it', type=str, default=common_utils.mary_cache_default_file)
+    parser.add_argument('--mary-cache-size', dest='mary_cache_size', help='Maximum number of sentences in the MARY cache, least recently used sentences are evicted first (0 = unbounded)', type=int, default=0)
 
     args = parser.parse_args()
 
     assert(args.input != args.output)
 
-    workerpool = Pool(processes=args.num_proc)
-    mary = maryclient.maryclient(2*args.num_proc)
-    print 'Reserved',args.num_proc,'processes.'
-    print 'Input file:',args.input,'output file:',args.output
-    
-    outfile_opt = 'w'
+    cache = common_utils.openMaryCache(args.mary_cache, args.mary_cache_size)
+    checkpoint_file = args.output + '.checkpoint'
+
+    print('Input file:',args.input,'output file:',args.output)
+
+    outfile_opt = 'wb'
+    skip_lines = args.skip_lines
 
     if args.append:
-        outfile_opt = 'a'
-        print 'appending to output file.'
-
-    if args.skip_lines > 0:
-        print "I'm skipping the first",args.skip_lines,"of the input file"
-
-    scriptpath = args.mary
-
-    if scriptpath != '':
-        print 'starting mary server...'
-        maryproc = startMaryServer(scriptpath)
-
-    with codecs.open(args.input,'r','utf-8') as inputfile, codecs.open(args.output,'w','utf-8') as outputfile:
-        lineno = 0
-        mybuffer = []
-        for line in inputfile:
-            if any([line.startswith(elem) for elem in ignore_lines]):
-                continue
-            if lineno >= args.skip_lines:
-                mybuffer.append(line)
-            lineno += 1
-            if(lineno % buffer_size == 0 and len(mybuffer)>0):
-                processBuffer(workerpool,mary,mybuffer,outputfile,scriptpath)
-                del mybuffer
-                mybuffer = []
-                print 'Processed:',lineno,'lines.'
-
-            if scriptpath != '':
-                #restart mary tts every 10000 requests
-                if(lineno % 20000 == 0):
-                    maryproc = restartMaryServer(scriptpath,maryproc)                
-
-        #process any outstanding elements        
-        if len(mybuffer)>0:
-            processBuffer(workerpool,mary,mybuffer,outputfile,scriptpath)
+        outfile_opt = 'ab'
+        print('appending to output file.')
+
+    checkpoint = None if args.no_resume else loadCheckpoint(checkpoint_file,args.input)
+    if checkpoint is not None:
+        print('Resuming from checkpoint',checkpoint_file,'after',checkpoint['lines'],'lines of the input file.')
+        # everything after the last checkpoint is written again
+        with open(args.output,'ab') as outputfile:
+            outputfile.truncate(checkpoint['output_bytes'])
+        outfile_opt = 'ab'
+        skip_lines = checkpoint['lines']
+
+    if skip_lines > 0:
+        print("I'm skipping the first",skip_lines,"of the input file")
+
+    marypool = None
+    endpoints = None
+    if args.mary != '':
+        print('starting mary servers...')
+        marypool = mary_supervisor.MaryServerPool(mary_supervisor.script_command(args.mary), args.mary_instances, args.mary_base_port,
+                                                  args.mary_max_requests, args.mary_max_rss_growth)
+        endpoints = marypool.start()
+
+    mary = maryclient.asyncmaryclient(in_flight=args.in_flight)
+    mary.endpoints = endpoints
+
+    workerpool = Pool(processes=args.num_proc, initializer=initWorker, initargs=(cache,))
+    print('Reserved',args.num_proc,'processes,',args.in_flight,'concurrent MARY requests.')
+
+    # the work queue has to hold at least one chunk per worker and the requests in flight
+    pending = threading.BoundedSemaphore(max(args.max_pending, 2*args.chunksize*args.num_proc + 2*args.in_flight))
+
+    with codecs.open(args.input,'r','utf-8') as inputfile, open(args.output,outfile_opt) as outputfile:
+        lineno = skip_lines
+        results = maryResults(readCorpus(inputfile,skip_lines,pending),mary,cache)
+        for lineno,sentence in workerpool.imap(processResult, results, chunksize=args.chunksize):
+            if sentence != '':
+                outputfile.write((sentence+'\n').encode('utf-8'))
+            pending.release()
+
+            if lineno % args.checkpoint_every == 0:
+                writeCheckpoint(checkpoint_file,args.input,outputfile,lineno)
+                print('Processed:',lineno,'lines.')
+
+        outputfile.flush()
+        os.fsync(outputfile.fileno())
+
+    workerpool.close()
+    workerpool.join()
+    mary.close()
+    if marypool is not None:
+        marypool.close()
+
+    # the run is complete, a new run should start from the beginning again
+    if os.path.isfile(checkpoint_file):
+        os.remove(checkpoint_file)
+    print('Done, processed',lineno,'lines.')
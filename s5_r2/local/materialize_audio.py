@@ -0,0 +1,231 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2022 Language Technology, Universitaet Hamburg (author: Benjamin Milde)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import print_function
+
+import argparse
+import audio_utils
+import hashlib
+import io
+import json
+import os
+import subprocess
+import sys
+
+from multiprocessing import Pool
+from urllib.parse import quote
+
+#
+# Decodes the "sox ... - |" (or other command) entries of a wav.scp once into a store of wav files and rewrites the wav.scp to point
+# at them, so that MFCC extraction, utt2dur, speed perturbation, cleanup etc. read the 16 kHz wav files instead of decoding and
+# resampling the mp3/ogg/flac sources on every pass. The commands run in a pool of worker processes, the stored files are exactly the
+# output of the wav.scp commands (with the sizes in the wav header filled in):
+#
+#   python3 local/materialize_audio.py -j 16 data/commonvoice_train
+#
+# The store has a manifest with the command and the checksums of its source files for every entry. On later runs (also after the
+# wav.scp has been rewritten) only entries whose command or source files changed are decoded again. Source files whose size and
+# modification time didn't change are not read again, unless --verify-checksums is given. Commands whose source files can't be
+# determined (see audio_utils.inputFiles) are only decoded again if the command changes. Entries that fail to decode keep their
+# command in the wav.scp.
+#
+
+# the format that the wav.scp commands of the prepare scripts produce
+expected_format = (16000, 1, 16)
+
+manifest_name = 'manifest.jsonl'
+
+def defaultStore(data_dir):
+    return os.path.join('data', 'wav_16k', os.path.basename(os.path.normpath(data_dir)))
+
+def storeFile(store, key):
+    '''Path of the wav file of a key in the store, keys are spread over 256 subdirectories'''
+    return os.path.join(store, hashlib.sha1(key.encode('utf-8', 'surrogateescape')).hexdigest()[:2], quote(key, safe='') + '.wav')
+
+def fileChecksum(filename):
+    sha1 = hashlib.sha1()
+    with open(filename, 'rb') as infile:
+        for block in iter(lambda: infile.read(1 << 20), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+def sourceInfo(rxfilename, old_sources=None, verify_checksums=False):
+    '''[file, size, mtime, sha1] of the source files of a wav.scp command. Checksums of files with the same size and modification time
+       as in old_sources are reused, unless verify_checksums is set. Returns [] if the source files can't be determined.'''
+    files = audio_utils.inputFiles(rxfilename)
+    if files is None:
+        return []
+    old = dict([(source[0], source) for source in (old_sources or [])])
+    sources = []
+    for filename in files:
+        stat = os.stat(filename)
+        if not verify_checksums and filename in old and old[filename][1] == stat.st_size and old[filename][2] == stat.st_mtime_ns:
+            sources.append(old[filename])
+        else:
+            sources.append([filename, stat.st_size, stat.st_mtime_ns, fileChecksum(filename)])
+    return sources
+
+def writeWavStream(stream, output):
+    '''Writes a wav stream to the file output, with the sizes in the header set to the length of the stream. Returns (sample rate,
+       channels, bits per sample, number of samples), None if it is not a wav stream.'''
+    header = audio_utils.readWavHeader(stream)
+    if header is None:
+        return None
+    fmt = header[0]
+    sample_rate, channels, bits, block_align = audio_utils.wavFormat(fmt)
+    if not block_align:
+        return None
+    header_size = len(audio_utils.wavHeader(fmt, 0))
+    data_size = 0
+    with open(output, 'wb') as outfile:
+        outfile.write(audio_utils.wavHeader(fmt, 0))
+        for block in iter(lambda: stream.read(1 << 20), b''):
+            outfile.write(block)
+            data_size += len(block)
+        # a partial sample at the end of the stream is dropped, like Kaldi does
+        data_size -= data_size % block_align
+        outfile.truncate(header_size + data_size)
+        outfile.seek(0)
+        outfile.write(audio_utils.wavHeader(fmt, data_size))
+    return sample_rate, channels, bits, data_size // block_align
+
+def decodeToWav(rxfilename, output):
+    '''Runs a wav.scp command and writes its output to the wav file output, see writeWavStream. None if the command fails.'''
+    proc = subprocess.Popen(rxfilename.strip()[:-1], shell=True, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    try:
+        info = writeWavStream(proc.stdout, output)
+    finally:
+        # read the rest of the output, so that the command doesn't block
+        for block in iter(lambda: proc.stdout.read(1 << 20), b''):
+            pass
+        proc.stdout.close()
+    if proc.wait() != 0:
+        return None
+    return info
+
+def materializeEntry(task):
+    '''Decodes one wav.scp entry into the store (in a worker process), returns (key, manifest record, status)'''
+    key, rxfilename, output, old_record, verify_checksums = task
+    try:
+        sources = sourceInfo(rxfilename, old_record['sources'] if old_record is not None else None, verify_checksums)
+    except (IOError, OSError) as err:
+        return key, None, 'failed: ' + str(err)
+    record = {'key': key, 'rxfilename': rxfilename, 'output': output, 'sources': sources}
+    if (old_record is not None and old_record['rxfilename'] == rxfilename and old_record['output'] == output
+            and [source[3] for source in old_record['sources']] == [source[3] for source in sources] and os.path.exists(output)):
+        record['format'] = old_record['format']
+        return key, record, 'unchanged'
+
+    if not os.path.exists(os.path.dirname(output)):
+        os.makedirs(os.path.dirname(output), exist_ok=True)
+    tmp_output = output + '.tmp' + str(os.getpid())
+    try:
+        info = decodeToWav(rxfilename, tmp_output)
+        if info is None:
+            return key, None, 'failed: could not decode ' + rxfilename
+        os.replace(tmp_output, output)
+    finally:
+        if os.path.exists(tmp_output):
+            os.remove(tmp_output)
+    record['format'] = list(info)
+    return key, record, 'decoded'
+
+def readManifest(store):
+    '''Manifest records of the store by key'''
+    records = {}
+    manifest_file = os.path.join(store, manifest_name)
+    if os.path.exists(manifest_file):
+        with io.open(manifest_file, 'r', encoding='utf-8', errors='surrogateescape') as infile:
+            for line in infile:
+                if line.strip() != '':
+                    record = json.loads(line)
+                    records[record['key']] = record
+    return records
+
+def writeManifest(store, records):
+    manifest_file = os.path.join(store, manifest_name)
+    with io.open(manifest_file + '.tmp', 'w', encoding='utf-8', errors='surrogateescape') as outfile:
+        for record in records:
+            outfile.write(json.dumps(record, ensure_ascii=False) + '\n')
+    os.replace(manifest_file + '.tmp', manifest_file)
+
+def originalEntry(manifest, key, rxfilename):
+    '''The command of a wav.scp entry that points to the store'''
+    if key in manifest and rxfilename == manifest[key]['output']:
+        return manifest[key]['rxfilename']
+    return rxfilename
+
+def materialize(data_dir, store='', jobs=1, verify_checksums=False):
+    '''Materializes the command entries of data_dir/wav.scp and rewrites it, returns the number of entries that failed'''
+    store = store if store != '' else defaultStore(data_dir)
+    wav_scp = os.path.join(data_dir, 'wav.scp')
+    entries = audio_utils.readScp(wav_scp)
+    manifest = readManifest(store)
+
+    tasks = []
+    for key, rxfilename in entries:
+        # entries that were rewritten by an earlier run are checked against the command they came from
+        rxfilename = originalEntry(manifest, key, rxfilename)
+        old_record = manifest.get(key)
+        if rxfilename.strip().endswith('|'):
+            tasks.append((key, rxfilename, storeFile(store, key), old_record, verify_checksums))
+
+    if len(tasks) == 0:
+        print('No commands to materialize in', wav_scp)
+        return 0
+
+    os.makedirs(store, exist_ok=True)
+    print('Materializing', len(tasks), 'of', len(entries), 'entries of', wav_scp, 'into', store, 'with', jobs, 'processes')
+    records, statuses = {}, {}
+    with Pool(processes=max(1, jobs)) as pool:
+        for key, record, status in pool.imap_unordered(materializeEntry, tasks, chunksize=16):
+            statuses[key] = status
+            if record is not None:
+                records[key] = record
+                if tuple(record['format'][:3]) != expected_format:
+                    print('Warning,', key, 'is not 16 kHz mono 16 bit:', record['format'][:3])
+
+    failed = [key for key, status in statuses.items() if status.startswith('failed')]
+    for key in failed[:20]:
+        print('Warning, could not materialize', key + ':', statuses[key][len('failed: '):])
+
+    writeManifest(store, [records[key] for key, rxfilename, output, old_record, verify in tasks if key in records])
+    # the backup has the commands of all entries, also of the ones that were materialized before
+    with io.open(wav_scp + '.orig', 'w', encoding='utf-8', errors='surrogateescape') as outfile:
+        for key, rxfilename in entries:
+            outfile.write(key + ' ' + originalEntry(manifest, key, rxfilename) + '\n')
+    with io.open(wav_scp + '.tmp', 'w', encoding='utf-8', errors='surrogateescape') as outfile:
+        for key, rxfilename in entries:
+            # entries that failed to decode go back to their command
+            outfile.write(key + ' ' + (records[key]['output'] if key in records else originalEntry(manifest, key, rxfilename)) + '\n')
+    os.replace(wav_scp + '.tmp', wav_scp)
+
+    decoded = len([status for status in statuses.values() if status == 'decoded'])
+    print('Decoded', decoded, 'entries,', len(records) - decoded, 'were unchanged,', len(failed), 'failed.')
+    return len(failed)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Decodes the command entries of a wav.scp once into a store of wav files and rewrites the wav.scp to point at them.')
+    parser.add_argument('data_dir', help='Kaldi data dir', type=str)
+    parser.add_argument('-s', '--store', dest='store', help='Directory for the wav files and the manifest, default is data/wav_16k/<name of the data dir>', type=str, default='')
+    parser.add_argument('-j', '--jobs', dest='jobs', help='Number of decoding processes', type=int, default=4)
+    parser.add_argument('--verify-checksums', dest='verify_checksums', help='Compute the checksums of all source files, also of the ones with unchanged size and modification time', action='store_true', default=False)
+
+    args = parser.parse_args()
+
+    failed = materialize(args.data_dir, args.store, args.jobs, args.verify_checksums)
+    if failed > 0:
+        print('Warning,', failed, 'entries could not be materialized, they still decode their source files.', file=sys.stderr)
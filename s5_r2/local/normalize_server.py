@@ -0,0 +1,231 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2022 Language Technology, Universitaet Hamburg (author: Benjamin Milde)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import socket
+import socketserver
+import sys
+import text_normalizer
+import threading
+import time
+
+#
+# Text normalization server: loads the spaCy model once and normalizes texts for any number of clients over a Unix socket, so that
+# prepare_commonvoice_data.py and renormalize_datadir_text.py (option -s) don't have to load the model on every invocation and several
+# data dirs can be normalized concurrently against one resident model. run.sh starts it on first use and stops it when it exits:
+#
+#   python3 local/normalize_server.py -s data/local/normalize.sock serve &
+#   python3 local/normalize_server.py -s data/local/normalize.sock wait
+#   python3 local/renormalize_datadir_text.py -s data/local/normalize.sock -t data/tuda_train/text
+#   python3 local/normalize_server.py -s data/local/normalize.sock stop
+#
+# Clients send one JSON request per line and get one JSON response line back:
+#   {"cmd": "normalize", "texts": [...]} -> {"results": [...]} (null for texts that could not be normalized)
+#   {"cmd": "ping"} -> {"ok": true}
+#   {"cmd": "shutdown"} -> {"ok": true}
+#
+# The normalize action is a simple client that normalizes stdin (one text per line) to stdout.
+#
+
+normalize_socket_default_file = 'data/local/normalize.sock'
+
+# texts per request, requests of concurrent clients are processed in turns
+max_request_texts = 10000
+
+class NormalizeHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        for line in self.rfile:
+            try:
+                request = json.loads(line.decode('utf-8'))
+                response = self.server.process(request)
+            except Exception as err:
+                response = {'error': repr(err)}
+            self.wfile.write(json.dumps(response).encode('utf-8') + b'\n')
+            self.wfile.flush()
+
+class NormalizeServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_file, normalizer):
+        self.normalizer = normalizer
+        # the spaCy pipeline is not thread safe, requests are normalized one after another
+        self.lock = threading.Lock()
+        socketserver.UnixStreamServer.__init__(self, socket_file, NormalizeHandler)
+
+    def process(self, request):
+        cmd = request.get('cmd')
+        if cmd == 'normalize':
+            with self.lock:
+                return {'results': self.normalizer.normalize_many(request['texts'])}
+        elif cmd == 'ping':
+            return {'ok': True}
+        elif cmd == 'shutdown':
+            # shutdown() waits for serve_forever to return, it can't be called from a handler thread
+            threading.Thread(target=self.shutdown).start()
+            return {'ok': True}
+        raise ValueError('Unknown command: ' + str(cmd))
+
+class NormalizeClient:
+    '''Client for the normalization server, normalize_many can be used like the one of text_normalizer.BatchNormalizer'''
+
+    def __init__(self, socket_file, timeout=None):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(timeout)
+        self.sock.connect(socket_file)
+        self.file = self.sock.makefile('rwb')
+
+    def request(self, request):
+        self.file.write(json.dumps(request).encode('utf-8') + b'\n')
+        self.file.flush()
+        line = self.file.readline()
+        if line == b'':
+            raise IOError('Normalization server closed the connection')
+        response = json.loads(line.decode('utf-8'))
+        if 'error' in response:
+            raise RuntimeError('Normalization server error: ' + response['error'])
+        return response
+
+    def normalize_many(self, texts, stopwords=None):
+        '''Normalizes a list of texts, returns a list with the normalized texts (None for texts that could not be normalized)'''
+        results = []
+        for i in range(0, len(texts), max_request_texts):
+            results += self.request({'cmd': 'normalize', 'texts': texts[i:i+max_request_texts]})['results']
+        if stopwords is None:
+            return results
+        # lowercasing stopwords is done on the client side, so that clients can have their own stopword lists
+        lowercased = []
+        for text, result in zip(texts, results):
+            try:
+                lowercased.append(None if result is None else text_normalizer.lowercaseStopword(text, result, stopwords))
+            except Exception:
+                lowercased.append(None)
+        return lowercased
+
+    def ping(self):
+        return self.request({'cmd': 'ping'})['ok']
+
+    def shutdown(self):
+        return self.request({'cmd': 'shutdown'})['ok']
+
+    def close(self):
+        self.file.close()
+        self.sock.close()
+
+def isRunning(socket_file):
+    try:
+        client = NormalizeClient(socket_file, timeout=10.0)
+    except (IOError, OSError):
+        return False
+    try:
+        return client.ping()
+    except (IOError, OSError, RuntimeError, ValueError):
+        return False
+    finally:
+        client.close()
+
+def openNormalizer(socket_file='', batch_size=256, n_process=1, disable=text_normalizer.default_disable, cache_file='', cache_size=0):
+    '''Connects to the normalization server on socket_file, or loads the spaCy model in this process if socket_file is empty.
+       If cache_file is set, texts are looked up in the persistent normalization cache first.'''
+    if socket_file != '':
+        print('Using the normalization server on', socket_file)
+        normalizer = NormalizeClient(socket_file)
+    else:
+        normalizer = text_normalizer.BatchNormalizer(text_normalizer.loadSpacy(), batch_size, n_process, disable)
+    cache = text_normalizer.openNormalizeCache(cache_file, cache_size)
+    if cache is not None:
+        normalizer = text_normalizer.CachedNormalizer(normalizer, cache)
+    return normalizer
+
+def serve(socket_file, batch_size=256, n_process=1, disable=text_normalizer.default_disable):
+    if os.path.exists(socket_file):
+        if isRunning(socket_file):
+            print('A normalization server is already running on', socket_file)
+            sys.exit(1)
+        # stale socket of a server that was killed
+        os.remove(socket_file)
+    print('Loading spaCy model', text_normalizer.default_spacy_model)
+    normalizer = text_normalizer.BatchNormalizer(text_normalizer.loadSpacy(), batch_size, n_process, disable)
+    server = NormalizeServer(socket_file, normalizer)
+    print('Normalization server is listening on', socket_file)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        os.remove(socket_file)
+    print('Normalization server stopped.')
+
+def processAlive(pid):
+    '''True if the process pid exists and is not a zombie'''
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    try:
+        with open('/proc/' + str(pid) + '/stat') as stat_in:
+            stat = stat_in.read()
+        return stat[stat.rindex(')')+2:].split()[0] != 'Z'
+    except (IOError, OSError, ValueError, IndexError):
+        return True
+
+def waitReady(socket_file, timeout=600.0, pid=0):
+    '''Waits until the server answers, gives up after timeout seconds or as soon as the server process pid (if given) exited'''
+    deadline = time.time() + timeout
+    while not isRunning(socket_file):
+        if pid > 0 and not processAlive(pid):
+            print('Normalization server on', socket_file, 'exited before it became ready')
+            sys.exit(1)
+        if time.time() > deadline:
+            print('Normalization server on', socket_file, 'did not become ready within', timeout, 's')
+            sys.exit(1)
+        time.sleep(0.5)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Text normalization server that keeps the spaCy model loaded, and a simple client for it.')
+    parser.add_argument('action', help='serve: run the server, wait: wait until it is ready, ping: exit code 0 if it is running, stop: shut it down, normalize: normalize stdin to stdout',
+                        choices=['serve', 'wait', 'ping', 'stop', 'normalize'])
+    parser.add_argument('-s', '--socket', dest='socket', help='Unix socket of the server', type=str, default=normalize_socket_default_file)
+    parser.add_argument('-b', '--batch-size', dest='batch_size', help='Batch size for the spaCy pipeline (nlp.pipe)', type=int, default=256)
+    parser.add_argument('-j', '--n-process', dest='n_process', help='Number of spaCy processes', type=int, default=1)
+    parser.add_argument('--disable', dest='disable', help='Comma separated list of spaCy pipeline components that are not needed for normalization', type=str, default=','.join(text_normalizer.default_disable))
+    parser.add_argument('--timeout', dest='timeout', help='Seconds to wait for the server to become ready', type=float, default=600.0)
+    parser.add_argument('--pid', dest='pid', help='Process id of the server, wait returns as soon as it exited', type=int, default=0)
+
+    args = parser.parse_args()
+
+    if args.action == 'serve':
+        serve(args.socket, args.batch_size, args.n_process, [name for name in args.disable.split(',') if name != ''])
+    elif args.action == 'wait':
+        waitReady(args.socket, args.timeout, args.pid)
+    elif args.action == 'ping':
+        sys.exit(0 if isRunning(args.socket) else 1)
+    elif args.action == 'stop':
+        if isRunning(args.socket):
+            client = NormalizeClient(args.socket)
+            client.shutdown()
+            client.close()
+    elif args.action == 'normalize':
+        client = NormalizeClient(args.socket)
+        texts = [line.rstrip('\n') for line in sys.stdin]
+        for result in client.normalize_many(texts):
+            print(result if result is not None else '')
+        client.close()
@@ -18,43 +18,102 @@ from __future__ import print_function
 
 import sys
 import argparse
+import io
+import re
+
+from functools import lru_cache
 
 from german_asr_lm_tools.normalize_numbers import NumberFormatter
 
 # Also change some very frequent words to new ortographic rules in German
 # e.g. muß -> muss
-word_replace_rules = {'muß':'muss', 'daß':'dass', 'Daß':'dass', '-$':' ', '-$':' ', '$':'', '$':'', '-':'' , '  ' : ' '}
+word_replace_rules = {'muß':'muss', 'daß':'dass', 'Daß':'dass', '-$':' ', '$':'', '-':'' , '  ' : ' '}
 
-def process_input(norm_number_words=False, convert_numbers=False):
-    if norm_number_words or convert_numbers:
-        nf = NumberFormatter()
+# applied to the input line before tokenization: remove ähs, ähms and unks as well as hesitations (häs)
+pre_replace_rules = [('Das', 'das'), ('Äh', ''), ('äh', ''), ('Ähm', ''), ('ähm', ''), ('häs', ''), ('<UNK>', ''), ('<unk>', '')]
 
-    for line in sys.stdin:
-        line = line.replace('Das', 'das')
-        # remove ähs, ähms and unks as well as hesitations (häs)
-        line = line.replace('Äh', '').replace('äh', '').replace('Ähm', '').replace('ähm', '').replace('häs', '').replace('<UNK>', '').replace('<unk>', '')
-        split = line.split()
-        if norm_number_words or convert_numbers:
-             split = nf.normalize_text(split, convert_to_numbers=convert_numbers)
-        if len(split) > 1:
-            if len(split[1]) > 1:
-                split[1] = split[1][0].upper() + split[1][1:]
-                output = ' '.join(split)
-            elif len(split[1]) == 1:
-                split[1] = split[1][0].upper()
-                output = ' '.join(split)
-            else:
-                #if we have issues just pass the line unchanged
-                output = line
-
-            for replace_rule in word_replace_rules.items():
-                output = output.replace(replace_rule[0], replace_rule[1])
-            print(output)
+# number of distinct token sequences that are memoized for NumberFormatter.normalize_text
+normalize_text_cache_size = 200000
+
+def compileRules(rules):
+    '''Compiles a list of (target, replacement) rules into one regex alternation, earlier rules take precedence'''
+    replacements = {}
+    for target, replacement in rules:
+        replacements.setdefault(target, replacement)
+    return re.compile('|'.join([re.escape(target) for target, replacement in rules])), replacements
 
+pre_replace_compiled = compileRules(pre_replace_rules)
+word_replace_list = list(word_replace_rules.items())
+word_replace_compiled = compileRules(word_replace_list)
+
+def legacyApplyRules(text, rules):
+    for target, replacement in rules:
+        text = text.replace(target, replacement)
+    return text
+
+def applyRules(text, rules, compiled):
+    '''Same result as replacing the rules one after another (legacyApplyRules), but in a single pass over text'''
+    pattern, replacements = compiled
+    result = pattern.sub(lambda match: replacements[match.group(0)], text)
+    # a replacement can create a new match for a later rule (e.g. 'a - b' -> 'a  b'), the chain of str.replace handles these rare cases
+    if pattern.search(result) is not None:
+        return legacyApplyRules(text, rules)
+    return result
+
+def memoizedNormalizeText(nf, convert_numbers=False, max_entries=normalize_text_cache_size):
+    '''nf.normalize_text for token lists, memoized for repeated token sequences (hypotheses repeat a lot between LM weights)'''
+    @lru_cache(maxsize=max_entries)
+    def normalize_tokens(tokens):
+        return tuple(nf.normalize_text(list(tokens), convert_to_numbers=convert_numbers))
+    return lambda split: list(normalize_tokens(tuple(split)))
+
+def normalizeLine(line, normalize_text=None):
+    '''Normalizes one hypothesis line (utterance id followed by words), returns the output line without the final newline'''
+    line = applyRules(line, pre_replace_rules, pre_replace_compiled)
+    split = line.split()
+    if normalize_text is not None:
+        split = normalize_text(split)
+    if len(split) > 1:
+        if len(split[1]) > 1:
+            split[1] = split[1][0].upper() + split[1][1:]
+            output = ' '.join(split)
+        elif len(split[1]) == 1:
+            split[1] = split[1][0].upper()
+            output = ' '.join(split)
         else:
             #if we have issues just pass the line unchanged
-            print(line)
+            output = line
 
+        return applyRules(output, word_replace_list, word_replace_compiled)
+    else:
+        #if we have issues just pass the line unchanged
+        return line
+
+def numberNormalizer(norm_number_words=False, convert_numbers=False):
+    if norm_number_words or convert_numbers:
+        return memoizedNormalizeText(NumberFormatter(), convert_numbers)
+    return None
+
+def process_input(norm_number_words=False, convert_numbers=False):
+    normalize_text = numberNormalizer(norm_number_words, convert_numbers)
+
+    for line in sys.stdin:
+        print(normalizeLine(line, normalize_text))
+
+def process_batch(batch_list, norm_number_words=False, convert_numbers=False):
+    '''Normalizes many hypothesis files in one process, batch_list has one "input_file output_file" pair per line'''
+    normalize_text = numberNormalizer(norm_number_words, convert_numbers)
+
+    with io.open(batch_list, 'r', encoding='utf-8') as batch_in:
+        pairs = [line.split() for line in batch_in if line.strip() != '']
+
+    for pair in pairs:
+        if len(pair) != 2:
+            print('Error, expected "input_file output_file" in', batch_list, 'but got:', ' '.join(pair), file=sys.stderr)
+            sys.exit(1)
+        with io.open(pair[0], 'r', encoding='utf-8') as infile, io.open(pair[1], 'w', encoding='utf-8') as outfile:
+            for line in infile:
+                outfile.write(normalizeLine(line, normalize_text) + '\n')
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Prepares the files from the TUDA corpus (XML) into text transcriptions for KALDI')
@@ -62,5 +121,10 @@ if __name__ == '__main__':
     parser.add_argument('-w', '--norm-number-words', dest='norm_number_words', help='Normalize number words (drei und sechzig -> dreiundsechzig)', action='store_true', default=False)
     parser.add_argument('-n', '--convert-numbers', dest='convert_numbers', help='Convert numbers (drei und sechzig -> 63, dreiundsechzig -> 63)', action='store_true', default=False)
 
+    parser.add_argument('-b', '--batch-list', dest='batch_list', help='Instead of stdin, normalize the files in this list (one "input_file output_file" pair per line) in one process', type=str, default='')
+
     args = parser.parse_args()
-    process_input(args.norm_number_words, args.convert_numbers)
+    if args.batch_list != '':
+        process_batch(args.batch_list, args.norm_number_words, args.convert_numbers)
+    else:
+        process_input(args.norm_number_words, args.convert_numbers)
@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2022 Language Technology, Universitaet Hamburg (author: Benjamin Milde)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import json
+import time
+import sqlite3
+import hashlib
+
+#
+# A persistent, content addressed key/value cache in a single sqlite file. Keys are tuples of strings
+# (e.g. sentence, locale, version), they are stored as sha1 hash of their parts. Values can be anything
+# that can be serialized to json. The file can be shared by several processes, sqlite takes care of locking.
+# If max_entries is set, the least recently used entries are evicted when the cache grows beyond that size.
+#
+
+# Values are evicted in batches, we remove this fraction of max_entries in one go once the cache is full
+evict_fraction = 0.1
+
+# Check the size of the cache every n inserts
+evict_check_every = 1000
+
+class PersistentCache:
+
+    def __init__(self, filename, namespace='', max_entries=0, timeout=120.0):
+        self.filename = filename
+        self.namespace = namespace
+        self.max_entries = max_entries
+        self.timeout = timeout
+        self.inserts = 0
+        self.pending_touches = []
+        self.connection = None
+        self.pid = None
+
+    def __getstate__(self):
+        # sqlite connections can't be shared with other processes, they reconnect lazily
+        state = self.__dict__.copy()
+        state['connection'] = None
+        state['pid'] = None
+        state['pending_touches'] = []
+        return state
+
+    def connect(self):
+        if self.connection is not None and self.pid == os.getpid():
+            return self.connection
+
+        dirname = os.path.dirname(self.filename)
+        if dirname != '' and not os.path.isdir(dirname):
+            os.makedirs(dirname)
+
+        self.connection = sqlite3.connect(self.filename, timeout=self.timeout)
+        self.pid = os.getpid()
+        # WAL mode allows concurrent readers while one process writes
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS cache (namespace TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL, last_access REAL NOT NULL, PRIMARY KEY (namespace, key))')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS cache_last_access ON cache (last_access)')
+        self.connection.commit()
+        return self.connection
+
+    def close(self):
+        if self.connection is not None and self.pid == os.getpid():
+            self.flush()
+            self.connection.close()
+        self.connection = None
+        self.pid = None
+
+    def hash_key(self, key):
+        '''Content address of a key tuple'''
+        if isinstance(key, str):
+            key = (key,)
+        return hashlib.sha1('\x1f'.join(key).encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        '''Returns the cached value for key or None if it is not in the cache'''
+        return self.get_many([key]).get(key, None)
+
+    def get_many(self, keys, batch_size=500):
+        '''Bulk lookup, returns a dict key -> value for all keys that are in the cache'''
+        connection = self.connect()
+        keys = list(keys)
+        hashed = {}
+        for key in keys:
+            hashed[self.hash_key(key)] = key
+
+        results = {}
+        hashes = list(hashed.keys())
+        for i in range(0, len(hashes), batch_size):
+            batch = hashes[i:i+batch_size]
+            query = 'SELECT key, value FROM cache WHERE namespace = ? AND key IN (' + ','.join(['?']*len(batch)) + ')'
+            for hashed_key, value in connection.execute(query, [self.namespace] + batch):
+                results[hashed[hashed_key]] = json.loads(value)
+                self.pending_touches.append(hashed_key)
+
+        if len(self.pending_touches) >= evict_check_every:
+            self.flush()
+
+        return results
+
+    def put(self, key, value):
+        self.put_many([(key, value)])
+
+    def put_many(self, items):
+        '''Bulk insert of (key, value) pairs, existing values are overwritten'''
+        connection = self.connect()
+        now = time.time()
+        rows = [(self.namespace, self.hash_key(key), json.dumps(value), now) for key, value in items]
+        connection.executemany('INSERT OR REPLACE INTO cache (namespace, key, value, last_access) VALUES (?, ?, ?, ?)', rows)
+        connection.commit()
+
+        self.inserts += len(rows)
+        if self.max_entries > 0 and self.inserts >= evict_check_every:
+            self.inserts = 0
+            self.evict()
+
+    def flush(self):
+        '''Writes the access times of cache hits, they are used for LRU eviction'''
+        if len(self.pending_touches) == 0 or self.connection is None:
+            return
+        now = time.time()
+        self.connection.executemany('UPDATE cache SET last_access = ? WHERE namespace = ? AND key = ?', [(now, self.namespace, hashed_key) for hashed_key in self.pending_touches])
+        self.connection.commit()
+        self.pending_touches = []
+
+    def evict(self):
+        '''Removes the least recently used entries (over all namespaces), if the cache holds more than max_entries'''
+        self.flush()
+        connection = self.connect()
+        size = connection.execute('SELECT COUNT(*) FROM cache').fetchone()[0]
+        if size > self.max_entries:
+            remove = size - self.max_entries + int(self.max_entries * evict_fraction)
+            connection.execute('DELETE FROM cache WHERE rowid IN (SELECT rowid FROM cache ORDER BY last_access LIMIT ?)', (remove,))
+            connection.commit()
+
+    def purge(self, keep_namespace=None, namespace_prefix=''):
+        '''Deletes all entries in namespaces starting with namespace_prefix, except for keep_namespace. Returns the number of deleted entries.'''
+        connection = self.connect()
+        query = 'DELETE FROM cache WHERE substr(namespace, 1, ?) = ?'
+        params = [len(namespace_prefix), namespace_prefix]
+        if keep_namespace is not None:
+            query += ' AND namespace != ?'
+            params.append(keep_namespace)
+        cursor = connection.execute(query, params)
+        connection.commit()
+        return cursor.rowcount
+
+    def __len__(self):
+        connection = self.connect()
+        return connection.execute('SELECT COUNT(*) FROM cache WHERE namespace = ?', (self.namespace,)).fetchone()[0]
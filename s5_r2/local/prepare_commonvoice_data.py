@@ -15,23 +15,28 @@
 # limitations under the License.
 
 import argparse
+import audio_utils
 import common_utils
-import german_asr_lm_tools.normalize_sentences as normalize_sentences
-import spacy
+import normalize_server
 import re
+import text_normalizer
 
 validated_filename = 'validated.tsv'
 
 wav_scp_template = "sox $filepath -t wav -r 16k -b 16 -e signed - |"
 
-def process(corpus_path, output_datadir):
+def process(corpus_path, output_datadir, normalize_socket='', normalize_cache=text_normalizer.normalize_cache_default_file, normalize_cache_size=0, exclude_file=audio_utils.audio_exclude_default_file):
     common_utils.make_sure_path_exists(output_datadir)
-    nlp = spacy.load('de_core_news_lg')
+    normalizer = normalize_server.openNormalizer(normalize_socket, cache_file=normalize_cache, cache_size=normalize_cache_size)
 
     # Common voice has repetitions and the text is not normalized
     # we cache text normalizations since they can be slow
     normalize_cache = {}
 
+    # clips that scan_audio.py found to be broken are skipped
+    exclusions = audio_utils.readExclusionList(exclude_file)
+    excluded = 0
+
     # we first load the entire corpus text into memory, sort by ID and then write it out into Kaldis data_dir format
     corpus = {}
 
@@ -56,15 +61,30 @@ def process(corpus_path, output_datadir):
 
                 spk = myid
 
-                if text not in normalize_cache:
-                    normalized_text = normalize_sentences.normalize(nlp, text)
-                    normalize_cache[text] = normalized_text
-                else:
-                    normalized_text = normalize_cache[text]
+                if audio_utils.isExcluded(exclusions, spk + '_' + myid, [corpus_path + 'clips/' + filename]):
+                    excluded += 1
+                    continue
+
+                normalize_cache[text] = None
+                corpus[myid] = (filename, text)
+
+    if excluded > 0:
+        print('Excluded', excluded, 'clips that are in', exclude_file)
 
-                #print(myid, filename, text, normalized_text)
+    # every distinct text is normalized once, in batches
+    print('Normalizing', len(normalize_cache), 'distinct texts')
+    texts = list(normalize_cache.keys())
+    for i in range(0, len(texts), 10000):
+        normalize_cache.update(zip(texts[i:i+10000], normalizer.normalize_many(texts[i:i+10000])))
+    normalizer.close()
 
-                corpus[myid] = (filename, normalized_text)
+    for myid in list(corpus.keys()):
+        filename, text = corpus[myid]
+        if normalize_cache[text] is None:
+            print('Warning, error normalizing:', text)
+            del corpus[myid]
+        else:
+            corpus[myid] = (filename, normalize_cache[text])
 
     print('done loading common voice tsv!')
     print('Now writing out to', output_datadir,'in Kaldi format!')
@@ -85,7 +105,11 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Prepares the files from the Commonvoice German corpus for KALDI')
     parser.add_argument('-c', '--corpus-path', dest='corpus_path', help='path to the corpus data', default='data/wav/cv/', type=str)
     parser.add_argument('-o', '--output-datadir', dest='output_datadir', help='lexicon out file', type=str, default='data/commonvoice_train/')
+    parser.add_argument('-s', '--normalize-server', dest='normalize_socket', help='Use the normalization server (normalize_server.py) on this socket instead of loading the spaCy model', type=str, default='')
+    parser.add_argument('--normalize-cache', dest='normalize_cache', help='Persistent cache file for normalized texts, set to an empty string to disable it', type=str, default=text_normalizer.normalize_cache_default_file)
+    parser.add_argument('-x', '--exclude', dest='exclude', help='Skip the clips and utterances in this exclusion list (see scan_audio.py)', type=str, default=audio_utils.audio_exclude_default_file)
+    parser.add_argument('--normalize-cache-size', dest='normalize_cache_size', help='Maximum number of texts in the normalization cache, least recently used texts are evicted first (0 = unbounded)', type=int, default=0)
 
     args = parser.parse_args()
 
-    process(args.corpus_path, args.output_datadir)
+    process(args.corpus_path, args.output_datadir, args.normalize_socket, args.normalize_cache, args.normalize_cache_size, args.exclude)
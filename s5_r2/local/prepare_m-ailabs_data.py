@@ -22,11 +22,12 @@ import json
 import re
 import subprocess
 import argparse
+import audio_utils
 import common_utils
 
 punct = re.compile('[ !\',\-\.:;\?]+')
 
-def create_kaldi_datadir(odir, mailabs_corpus_dir):
+def create_kaldi_datadir(odir, mailabs_corpus_dir, exclusions=None):
     with open(odir + '/text', 'w', encoding='utf-8') as text, \
         open(odir + '/wav.scp', 'w') as wavscp, \
         open(odir + '/utt2spk', 'w') as utt2spk:
@@ -48,6 +49,9 @@ def create_kaldi_datadir(odir, mailabs_corpus_dir):
 
                 uttid = wspk + '_' + wav[:-4]
 
+                if exclusions is not None and audio_utils.isExcluded(exclusions, uttid, [wavdir + wav]):
+                    continue
+
                 text.write('{} {}\n'.format(uttid, re.sub(punct, ' ', utts[wav]['clean']).strip()))
                 utt2spk.write('{} {}\n'.format(uttid, wspk))
                 wavscp.write('{} sox {} -r 16k -t wav -c 1 -b 16 -e signed - |\n'.format(uttid, wavdir + wav))
@@ -58,10 +62,12 @@ if __name__ == "__main__":
                         help='Path to the M-ailabs data (download here: http://www.m-ailabs.bayern/en/the-mailabs-speech-dataset/)', type=str, default='data/wav/m_ailabs/de_DE/')
     parser.add_argument('-o', '--outputfolder', dest='outputfolder',
                         help='Export to this Kaldi folder.', type=str, default='data/m_ailabs_train')
+    parser.add_argument('-x', '--exclude', dest='exclude',
+                        help='Skip the audio files and utterances in this exclusion list (see scan_audio.py)', type=str, default=audio_utils.audio_exclude_default_file)
     args = parser.parse_args()
 
     common_utils.make_sure_path_exists(args.outputfolder)
 
-    create_kaldi_datadir(args.outputfolder, args.inputcorpus)
+    create_kaldi_datadir(args.outputfolder, args.inputcorpus, audio_utils.readExclusionList(args.exclude))
 
     #subprocess.call('utils/fix_data_dir.sh {}'.format(odir), shell=True)
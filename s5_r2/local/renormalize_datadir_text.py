@@ -16,10 +16,10 @@
 
 import argparse
 import common_utils
-#import normalize_sentences
-import german_asr_lm_tools.normalize_sentences as normalize_sentences
-import spacy
+import normalize_server
+import os
 import shutil
+import text_normalizer
 import time
 
 def load_lowercase_stopwords(filename='local/stopwords.de.txt'):
@@ -34,9 +34,9 @@ def load_lowercase_stopwords(filename='local/stopwords.de.txt'):
 
     return stopwords
 
-def process(text_kaldi_file):
-    nlp = spacy.load('de_core_news_lg')
-    texts = []
+def process(text_kaldi_file, batch_size=256, n_process=1, disable=text_normalizer.default_disable, chunk_lines=10000, normalize_socket='',
+            normalize_cache=text_normalizer.normalize_cache_default_file, normalize_cache_size=0):
+    normalizer = normalize_server.openNormalizer(normalize_socket, batch_size, n_process, disable, normalize_cache, normalize_cache_size)
     normalize_cache = {}
     i=0
 
@@ -46,54 +46,70 @@ def process(text_kaldi_file):
 
     stopwords = load_lowercase_stopwords()
 
-    print('Opening and processing', text_kaldi_file)
-    with open(text_kaldi_file) as infile:
-        for line in infile:
-            i +=1
-
-            if i%10000 == 0:
-                print('At line:', i)
+    # the normalized text is streamed into a temporary file next to the text file, which then replaces it
+    tmp_file = text_kaldi_file + '.tmp' + nonce
+    num_written = 0
 
-            if line[-1] == '\n':
-                line = line[:-1]
-            split = line.split()
+    print('Opening and processing', text_kaldi_file)
+    with open(text_kaldi_file) as infile, open(tmp_file, 'w') as outfile:
+        while True:
+            chunk = []
+            for line in infile:
+                i +=1
+
+                if i%10000 == 0:
+                    print('At line:', i)
+
+                if line[-1] == '\n':
+                    line = line[:-1]
+                split = line.split()
+
+                # first element in the split id the ID
+                if len(split) > 1:
+                    chunk.append((split[0], ' '.join(split[1:])))
+                else:
+                    print('Warning,', split[0] if len(split) > 0 else 'line ' + str(i), 'has no text!')
 
-            # first element in the split id the ID
-            if len(split) > 1:
-                myid = split[0]
-                text = ' '.join(split[1:])
+                if len(chunk) >= chunk_lines:
+                    break
 
-                first_word = split[1]
+            if len(chunk) == 0:
+                break
 
+            # only texts that were not seen before are normalized, in batches
+            new_texts = []
+            for myid, text in chunk:
                 if text not in normalize_cache:
-                    should_lowercase = first_word in stopwords
-
-                    try:
-                        normalized_text = normalize_sentences.normalize(nlp, text)
-                        # Npte the normalization step looks at POS tags to decide if the first word should be lowercased, but gets some 
-                        if should_lowercase:
-                            # check that the first word isnt in all upper case:
-                            if not normalized_text[1].isupper():
-                                normalized_text = normalized_text[0].lower() + normalized_text[1:]
-                        normalize_cache[text] = normalized_text
-                    except:
-                        print('Warning, error normalizing:', text)
-                        continue
-                else:
-                    normalized_text = normalize_cache[text]
+                    normalize_cache[text] = None
+                    new_texts.append(text)
+            normalize_cache.update(zip(new_texts, normalizer.normalize_many(new_texts, stopwords)))
+
+            for myid, text in chunk:
+                normalized_text = normalize_cache[text]
+                if normalized_text is None:
+                    print('Warning, error normalizing:', text)
+                    continue
+                # no newline after the last line, as before
+                outfile.write(('\n' if num_written > 0 else '') + myid + ' ' + normalized_text)
+                num_written += 1
 
-                texts.append(myid + ' ' + normalized_text)
-            else:
-                print('Warning,', myid, 'has no text!')
+    normalizer.close()
 
     print('Rewrite', text_kaldi_file)
-    with open(text_kaldi_file, 'w') as outfile:
-        outfile.write('\n'.join(texts))
+    os.replace(tmp_file, text_kaldi_file)
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Renormalize text file in Kaldi data dir format.')
     parser.add_argument('-t', '--text-kaldi-file', dest='text_kaldi_file', help='path to the Kaldi text file',  type=str)
+    parser.add_argument('-b', '--batch-size', dest='batch_size', help='Batch size for the spaCy pipeline (nlp.pipe)', type=int, default=256)
+    parser.add_argument('-j', '--n-process', dest='n_process', help='Number of spaCy processes', type=int, default=1)
+    parser.add_argument('--disable', dest='disable', help='Comma separated list of spaCy pipeline components that are not needed for normalization', type=str, default=','.join(text_normalizer.default_disable))
+    parser.add_argument('--chunk-lines', dest='chunk_lines', help='Number of lines that are read and normalized at once', type=int, default=10000)
+    parser.add_argument('-s', '--normalize-server', dest='normalize_socket', help='Use the normalization server (normalize_server.py) on this socket instead of loading the spaCy model', type=str, default='')
+    parser.add_argument('--normalize-cache', dest='normalize_cache', help='Persistent cache file for normalized texts, set to an empty string to disable it', type=str, default=text_normalizer.normalize_cache_default_file)
+    parser.add_argument('--normalize-cache-size', dest='normalize_cache_size', help='Maximum number of texts in the normalization cache, least recently used texts are evicted first (0 = unbounded)', type=int, default=0)
 
     args = parser.parse_args()
 
-    process(args.text_kaldi_file)
+    process(args.text_kaldi_file, args.batch_size, args.n_process, [name for name in args.disable.split(',') if name != ''], args.chunk_lines, args.normalize_socket,
+            args.normalize_cache, args.normalize_cache_size)
@@ -0,0 +1,310 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2022 Language Technology, Universitaet Hamburg (author: Benjamin Milde)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import print_function
+
+import argparse
+import audio_archive
+import audio_utils
+import extract_segments
+import io
+import materialize_audio
+import math
+import os
+import sys
+
+from array import array
+from multiprocessing import Pool
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+#
+# Scans the audio of Kaldi data dirs before feature extraction, with a pool of worker processes. Every wav.scp entry is read (or
+# decoded) once and checked for:
+#   unreadable   the file or command can't be read, or is not a wav file
+#   truncated    the wav data is shorter than its header says, or the decoded audio is shorter than the duration in the headers of
+#                the source files (mp3, ogg, flac, ...)
+#   sample_rate, channels, bits   not 16 kHz mono 16 bit
+#   empty, too_short   no samples or less than --min-length seconds
+#   silence      the peak level is below --silence-threshold dBFS
+#   clipped      more than --max-clipped of the samples are at full scale
+# If the data dir has segments, every recording is decoded once and its segments are checked (with the cutting rules of
+# extract-segments, bad_segment if a segment can't be cut).
+#
+# Problems are written to an exclusion list, one line per problem "kind id reasons data_dir" with the kinds file (a source audio
+# file), recording and utterance. The list is shared by all data dirs, the lines of a data dir are replaced when it is scanned again.
+# For packed or materialized data dirs, the file lines name the source files of the original wav.scp entries (from wav.scp.orig or
+# the manifest of the store), entries whose source can't be determined only get recording/utterance lines.
+# The prepare scripts skip the files and utterances in it (option --exclude), --filter also removes them from the scanned data dirs
+# right away (run local/fix_data_dir.py afterwards):
+#
+#   python3 local/scan_audio.py -j 16 --filter data/commonvoice_train data/m_ailabs_train
+#
+# The sample checks use numpy if it is installed.
+#
+
+default_sample_rate = 16000
+default_channels = 1
+default_min_length = 0.1
+default_silence_threshold = -50.0
+default_max_clipped = 0.001
+
+# per utterance files that --filter removes excluded utterances from
+utterance_files = ['segments', 'text', 'utt2spk', 'utt2dur', 'utt2num_frames', 'feats.scp', 'utt2gender', 'utt2lang', 'utt2uniq']
+
+class ScanOptions:
+
+    def __init__(self, sample_rate=default_sample_rate, channels=default_channels, min_length=default_min_length,
+                 silence_threshold=default_silence_threshold, max_clipped=default_max_clipped):
+        self.sample_rate = sample_rate
+        self.channels = channels
+        self.min_length = min_length
+        self.silence_threshold = silence_threshold
+        self.max_clipped = max_clipped
+
+def sampleStats(data):
+    '''(peak, number of samples at full scale) of 16 bit little endian samples'''
+    if numpy is not None:
+        samples = numpy.frombuffer(data, dtype='<i2')
+        if len(samples) == 0:
+            return 0, 0
+        peak = max(int(samples.max()), -int(samples.min()))
+        return peak, int(numpy.count_nonzero((samples == 32767) | (samples == -32768)))
+    samples = array('h')
+    samples.frombytes(data)
+    if sys.byteorder == 'big':
+        samples.byteswap()
+    if len(samples) == 0:
+        return 0, 0
+    return max(max(samples), -min(samples)), samples.count(32767) + samples.count(-32768)
+
+def checkSamples(fmt, data, options):
+    '''Problems of decoded audio'''
+    sample_rate, channels, bits, block_align = audio_utils.wavFormat(fmt)
+    problems = []
+    if sample_rate != options.sample_rate:
+        problems.append('sample_rate')
+    if channels != options.channels:
+        problems.append('channels')
+    if bits != 16:
+        problems.append('bits')
+    num_samples = len(data) // block_align
+    if num_samples == 0:
+        return problems + ['empty']
+    if float(num_samples) / sample_rate < options.min_length:
+        problems.append('too_short')
+    if bits == 16:
+        peak, clipped = sampleStats(data)
+        if peak == 0 or 20.0 * math.log10(peak / 32768.0) < options.silence_threshold:
+            problems.append('silence')
+        if float(clipped) / (len(data) // 2) > options.max_clipped:
+            problems.append('clipped')
+    return problems
+
+def readEntry(rxfilename):
+    '''(fmt chunk, samples, problems) of a wav.scp entry, fmt is None if it can't be read'''
+    rxfilename = rxfilename.strip()
+    if not rxfilename.endswith('|') and (audio_utils.parseOffsetRxfilename(rxfilename) is None or os.path.exists(rxfilename)):
+        try:
+            with open(rxfilename, 'rb') as infile:
+                header = audio_utils.readWavHeader(infile)
+                if header is None:
+                    return None, None, ['unreadable']
+                data = infile.read(header[1])
+        except (IOError, OSError):
+            return None, None, ['unreadable']
+        block_align = audio_utils.wavFormat(header[0])[3]
+        if not block_align:
+            return None, None, ['unreadable']
+        return header[0], data[:len(data) - len(data) % block_align], ['truncated'] if len(data) < header[1] else []
+
+    try:
+        fmt, data = audio_archive.readAudio(rxfilename)
+    except (IOError, OSError) as err:
+        return None, None, ['truncated' if str(err).startswith('Truncated') else 'unreadable']
+    problems = []
+    if rxfilename.endswith('|'):
+        # compare with the duration in the headers of the source files, sox stops early on broken mp3 and ogg files
+        expected = audio_utils.headerDuration(rxfilename)
+        sample_rate, channels, bits, block_align = audio_utils.wavFormat(fmt)
+        if expected is not None and float(len(data) // block_align) / sample_rate < expected - max(0.1, 0.01 * expected):
+            problems.append('truncated')
+    return fmt, data, problems
+
+def scanEntry(task):
+    '''Scans one wav.scp entry (in a worker process), returns (key, problems of the recording, [(utterance, problems)])'''
+    key, rxfilename, segments, options = task
+    fmt, data, problems = readEntry(rxfilename)
+    if fmt is None:
+        return key, problems, []
+    if segments is None:
+        return key, problems + checkSamples(fmt, data, options), []
+
+    # problems of the recording that apply to all of its segments, segments after the end of a truncated recording can't be cut
+    problems = [problem for problem in problems if problem != 'truncated']
+    problems += [problem for problem in checkSamples(fmt, data, options) if problem in ['sample_rate', 'channels', 'bits', 'empty']]
+    utterance_problems = []
+    if len(problems) == 0:
+        for utt, start, end, channel in segments:
+            segment, reason = extract_segments.cutSegment(fmt, data, start, end, channel)
+            segment_problems = ['bad_segment'] if segment is None else checkSamples(segment[0], segment[1], options)
+            if len(segment_problems) > 0:
+                utterance_problems.append((utt, segment_problems))
+    return key, problems, utterance_problems
+
+def sourceEntries(data_dir, entries):
+    '''{key: original wav.scp entry} for (key, rxfilename) entries, also for entries that point into audio archives (through
+       wav.scp.orig, see audio_archive.py) or into a store of materialized audio (through its manifest, see materialize_audio.py).
+       None for entries whose original entry can't be found.'''
+    orig_file = os.path.join(data_dir, 'wav.scp.orig')
+    orig = dict(audio_utils.readScp(orig_file)) if os.path.exists(orig_file) else {}
+    manifests = {}
+
+    def isArchiveEntry(rxfilename):
+        return audio_utils.parseOffsetRxfilename(rxfilename) is not None and not os.path.exists(rxfilename)
+
+    def fromManifest(key, rxfilename):
+        # files of a store are in <store>/<xx>/<key>.wav, the manifest is in <store>
+        store = os.path.dirname(os.path.dirname(rxfilename))
+        if store not in manifests:
+            manifests[store] = materialize_audio.readManifest(store) if os.path.exists(os.path.join(store, materialize_audio.manifest_name)) else {}
+        record = manifests[store].get(key)
+        return record['rxfilename'] if record is not None and record['output'] == rxfilename else None
+
+    sources = {}
+    for key, rxfilename in entries:
+        rxfilename = rxfilename.strip()
+        if isArchiveEntry(rxfilename):
+            rxfilename = orig.get(key)
+        if rxfilename is not None and not rxfilename.endswith('|'):
+            materialized = fromManifest(key, rxfilename)
+            if materialized is not None:
+                rxfilename = materialized
+        if rxfilename is not None and isArchiveEntry(rxfilename):
+            rxfilename = None
+        sources[key] = rxfilename
+    return sources
+
+def scanDataDir(data_dir, options, jobs=1):
+    '''Scans a data dir, returns ({recording: problems}, {utterance: problems}, {recording: source files})'''
+    entries = audio_utils.readScp(os.path.join(data_dir, 'wav.scp'))
+    segments_file = os.path.join(data_dir, 'segments')
+    segments = extract_segments.readSegments(segments_file)[0] if os.path.exists(segments_file) else None
+    if segments is not None:
+        entries = [(key, rxfilename) for key, rxfilename in entries if key in segments]
+    tasks = [(key, rxfilename, segments[key] if segments is not None else None, options) for key, rxfilename in entries]
+
+    print('Scanning', len(tasks), 'recordings of', data_dir, 'with', jobs, 'processes')
+    recording_problems, utterance_problems = {}, {}
+    with Pool(processes=max(1, jobs)) as pool:
+        for key, problems, utt_problems in pool.imap_unordered(scanEntry, tasks, chunksize=8):
+            if len(problems) > 0:
+                recording_problems[key] = problems
+            utterance_problems.update(utt_problems)
+    # the file lines of the exclusion list have to name the source files that the prepare scripts see
+    sources = sourceEntries(data_dir, [(key, rxfilename) for key, rxfilename in entries if key in recording_problems])
+    files = dict([(key, (audio_utils.inputFiles(source) or []) if source is not None else []) for key, source in sources.items()])
+    return recording_problems, utterance_problems, files
+
+def exclusionLines(data_dir, recording_problems, utterance_problems, files, has_segments):
+    lines = []
+    for key in sorted(recording_problems.keys()):
+        reasons = ','.join(recording_problems[key])
+        lines += ['file ' + os.path.normpath(filename) + ' ' + reasons + ' ' + data_dir for filename in files[key]]
+        # without segments, the wav.scp keys are utterance ids
+        lines.append(('recording ' if has_segments else 'utterance ') + key + ' ' + reasons + ' ' + data_dir)
+    for utt in sorted(utterance_problems.keys()):
+        lines.append('utterance ' + utt + ' ' + ','.join(utterance_problems[utt]) + ' ' + data_dir)
+    return lines
+
+def updateExclusionList(filename, data_dirs, lines):
+    '''Replaces the lines of data_dirs in the exclusion list with lines'''
+    old_lines = []
+    if os.path.exists(filename):
+        with io.open(filename, 'r', encoding='utf-8', errors='surrogateescape') as infile:
+            old_lines = [line.rstrip('\n') for line in infile if line.strip() != '' and not line.startswith('#')]
+    old_lines = [line for line in old_lines if len(line.split()) < 4 or line.split()[3] not in data_dirs]
+    if os.path.dirname(filename) != '':
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+    with io.open(filename + '.tmp', 'w', encoding='utf-8', errors='surrogateescape') as outfile:
+        outfile.write('# kind id reasons data_dir, written by local/scan_audio.py\n')
+        for line in old_lines + lines:
+            outfile.write(line + '\n')
+    os.replace(filename + '.tmp', filename)
+
+def filterDataDir(data_dir, bad_recordings, bad_utterances):
+    '''Removes the excluded recordings and utterances from the files of a data dir'''
+    has_segments = os.path.exists(os.path.join(data_dir, 'segments'))
+    if has_segments and len(bad_recordings) > 0:
+        # the utterances of excluded recordings
+        with io.open(os.path.join(data_dir, 'segments'), 'r', encoding='utf-8', errors='surrogateescape') as infile:
+            bad_utterances = bad_utterances | set([line.split()[0] for line in infile if len(line.split()) >= 2 and line.split()[1] in bad_recordings])
+    for filename in ['wav.scp', 'reco2dur', 'reco2file_and_channel'] + utterance_files:
+        path = os.path.join(data_dir, filename)
+        if not os.path.exists(path):
+            continue
+        with io.open(path, 'r', encoding='utf-8', errors='surrogateescape') as infile:
+            lines = infile.readlines()
+        if filename in ['wav.scp', 'reco2dur', 'reco2file_and_channel']:
+            bad = bad_recordings if has_segments else bad_utterances
+            kept = [line for line in lines if len(line.split()) == 0 or line.split()[0] not in bad]
+        elif filename == 'segments':
+            kept = [line for line in lines if len(line.split()) < 2 or (line.split()[0] not in bad_utterances and line.split()[1] not in bad_recordings)]
+        else:
+            kept = [line for line in lines if len(line.split()) == 0 or line.split()[0] not in bad_utterances]
+        if len(kept) < len(lines):
+            with io.open(path, 'w', encoding='utf-8', errors='surrogateescape') as outfile:
+                outfile.writelines(kept)
+            print('Removed', len(lines) - len(kept), 'lines from', path)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Checks the audio of Kaldi data dirs (headers, format, truncation, silence, clipping) and writes an exclusion list for the prepare scripts.')
+    parser.add_argument('data_dirs', help='Kaldi data dirs', type=str, nargs='+')
+    parser.add_argument('-j', '--jobs', dest='jobs', help='Number of processes', type=int, default=4)
+    parser.add_argument('-x', '--exclude-list', dest='exclude_list', help='Exclusion list that is updated', type=str, default=audio_utils.audio_exclude_default_file)
+    parser.add_argument('--filter', dest='filter', help='Also remove the excluded recordings and utterances from the data dirs', action='store_true', default=False)
+    parser.add_argument('--sample-rate', dest='sample_rate', help='Expected sample rate', type=int, default=default_sample_rate)
+    parser.add_argument('--channels', dest='channels', help='Expected number of channels', type=int, default=default_channels)
+    parser.add_argument('--min-length', dest='min_length', help='Minimum length of an utterance in seconds', type=float, default=default_min_length)
+    parser.add_argument('--silence-threshold', dest='silence_threshold', help='Audio with a lower peak level (in dBFS) is silence', type=float, default=default_silence_threshold)
+    parser.add_argument('--max-clipped', dest='max_clipped', help='Maximum fraction of samples at full scale', type=float, default=default_max_clipped)
+
+    args = parser.parse_args()
+
+    options = ScanOptions(args.sample_rate, args.channels, args.min_length, args.silence_threshold, args.max_clipped)
+    data_dirs = [os.path.normpath(data_dir) for data_dir in args.data_dirs]
+    lines = []
+    for data_dir in data_dirs:
+        has_segments = os.path.exists(os.path.join(data_dir, 'segments'))
+        recording_problems, utterance_problems, files = scanDataDir(data_dir, options, args.jobs)
+        lines += exclusionLines(data_dir, recording_problems, utterance_problems, files, has_segments)
+
+        counts = {}
+        for problems in list(recording_problems.values()) + list(utterance_problems.values()):
+            for problem in problems:
+                counts[problem] = counts.get(problem, 0) + 1
+        print(data_dir + ':', len(recording_problems), 'bad recordings,' if has_segments else 'bad utterances,', len(utterance_problems), 'bad segments',
+              ' '.join([problem + ': ' + str(count) for problem, count in sorted(counts.items())]))
+        if args.filter and has_segments:
+            filterDataDir(data_dir, set(recording_problems.keys()), set(utterance_problems.keys()))
+        elif args.filter:
+            filterDataDir(data_dir, set(), set(recording_problems.keys()))
+
+    updateExclusionList(args.exclude_list, data_dirs, lines)
+    print('Wrote', len(lines), 'exclusions to', args.exclude_list)
@@ -76,24 +76,36 @@ if [ $stage -le 0 ]; then
         lattice-prune --beam=$beam ark:- ark:- \| \
         lattice-mbr-decode  --word-symbol-table=$symtab \
         ark:- ark,t:- \| \
-        utils/int2sym.pl -f 2- $symtab \| \
-        $hyp_filtering_cmd '>' $dir/scoring_kaldi/penalty_$wip/LMWT.txt || exit 1;
+        utils/int2sym.pl -f 2- $symtab '>' $dir/scoring_kaldi/penalty_$wip/LMWT.unfilt.txt || exit 1;
 
     else
       $cmd LMWT=$min_lmwt:$max_lmwt $dir/scoring_kaldi/penalty_$wip/log/best_path.LMWT.log \
         lattice-scale --inv-acoustic-scale=LMWT "ark:gunzip -c $dir/lat.*.gz|" ark:- \| \
         lattice-add-penalty --word-ins-penalty=$wip ark:- ark:- \| \
         lattice-best-path --word-symbol-table=$symtab ark:- ark,t:- \| \
-        utils/int2sym.pl -f 2- $symtab \| \
-        $hyp_filtering_cmd '>' $dir/scoring_kaldi/penalty_$wip/LMWT.txt || exit 1;
+        utils/int2sym.pl -f 2- $symtab '>' $dir/scoring_kaldi/penalty_$wip/LMWT.unfilt.txt || exit 1;
     fi
+  done
 
-    $cmd LMWT=$min_lmwt:$max_lmwt $dir/scoring_kaldi/penalty_$wip/log/score.LMWT.log \
-      cat $dir/scoring_kaldi/penalty_$wip/LMWT.txt \| \
-      compute-wer --text --mode=${compute_wer_mode} \
-      ark:$dir/scoring_kaldi/test_filt.txt  ark,p:- ">&" $dir/wer_LMWT_$wip || exit 1;
+  # the hypotheses of all LM weights and penalties are filtered in one process (local/wer_hyp_filter supports a batch list),
+  # other filters are run once per file
+  for wip in $(echo $word_ins_penalty | sed 's/,/ /g'); do
+    for lmwt in $(seq $min_lmwt $max_lmwt); do
+      echo $dir/scoring_kaldi/penalty_$wip/$lmwt.unfilt.txt $dir/scoring_kaldi/penalty_$wip/$lmwt.txt
+    done
+  done > $dir/scoring_kaldi/hyp_filter.list
+  if [ "$hyp_filtering_cmd" == "local/wer_hyp_filter" ]; then
+    $hyp_filtering_cmd --batch-list $dir/scoring_kaldi/hyp_filter.list || exit 1;
+  else
+    while read unfilt filt; do
+      $hyp_filtering_cmd < $unfilt > $filt || exit 1;
+    done < $dir/scoring_kaldi/hyp_filter.list
+  fi
 
-  done
+  # all LMWT/penalty combinations are scored in one process, it writes the same wer_LMWT_WIP files as compute-wer
+  $cmd $dir/scoring_kaldi/log/score_grid.log \
+    python3 local/score_wer_grid.py --mode ${compute_wer_mode} --lmwt $min_lmwt:$max_lmwt --word-ins-penalty $word_ins_penalty \
+    $dir/scoring_kaldi/test_filt.txt $dir || exit 1;
 fi
 
 
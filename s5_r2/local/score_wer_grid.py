@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2022 Language Technology, Universitaet Hamburg (author: Benjamin Milde)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import print_function
+
+import argparse
+import io
+import re
+import struct
+import sys
+
+#
+# Scores all LM weight / word insertion penalty combinations of a decode dir in one process, instead of one compute-wer pipeline per
+# combination (see local/score.sh). The reference is read once, words are mapped to integer ids and the edit distance of each distinct
+# (utterance, hypothesis) pair is only computed once, as most hypotheses are the same for neighbouring LM weights.
+#
+# The wer_LMWT_WIP files are the same as the ones of "compute-wer --text --mode=MODE ark:REF ark,p:-": the edit distance and the
+# counts of insertions, deletions and substitutions follow Kaldi's LevenshteinEditDistance and the percentages are computed in single
+# precision. Optionally the best WER is written in the format of utils/best_wer.sh.
+#
+# python3 local/score_wer_grid.py --lmwt 7:17 --word-ins-penalty 0.0,0.5,1.0 exp/chain/tdnn1f/decode_dev/scoring_kaldi/test_filt.txt \
+#     exp/chain/tdnn1f/decode_dev
+#
+
+hyp_file_template = '{dir}/scoring_kaldi/penalty_{wip}/{lmwt}.txt'
+wer_file_template = '{dir}/wer_{lmwt}_{wip}'
+
+# Kaldi splits text archive lines on these characters only
+kaldi_whitespace = re.compile('[ \t\r]+')
+
+def readTranscripts(filename, word_ids):
+    '''Reads a Kaldi text archive (utterance id followed by words), returns a list of (utterance id, tuple of word ids) in file order'''
+    transcripts = []
+    # like Kaldi, lines are only split on \n and words are compared byte wise
+    with io.open(filename, 'r', encoding='utf-8', errors='surrogateescape', newline='\n') as infile:
+        for line in infile:
+            split = [field for field in kaldi_whitespace.split(line.rstrip('\n')) if field != '']
+            if len(split) == 0:
+                continue
+            transcripts.append((split[0], tuple([word_ids.setdefault(word, len(word_ids)) for word in split[1:]])))
+    return transcripts
+
+def levenshtein(ref, hyp):
+    '''Edit distance and number of insertions, deletions and substitutions, with the same tie breaking as Kaldi's LevenshteinEditDistance'''
+    # rows hold (total cost, insertions, deletions, substitutions)
+    prev_row = [(j, j, 0, 0) for j in range(len(hyp) + 1)]
+    for i in range(1, len(ref) + 1):
+        ref_word = ref[i-1]
+        cur_row = [(i, 0, i, 0)]
+        left = cur_row[0]
+        for j in range(1, len(hyp) + 1):
+            diag = prev_row[j-1]
+            if ref_word == hyp[j-1]:
+                left = diag
+            else:
+                up = prev_row[j]
+                if diag[0] <= up[0] and diag[0] <= left[0]:
+                    left = (diag[0] + 1, diag[1], diag[2], diag[3] + 1)
+                elif up[0] <= left[0]:
+                    left = (up[0] + 1, up[1], up[2] + 1, up[3])
+                else:
+                    left = (left[0] + 1, left[1] + 1, left[2], left[3])
+            cur_row.append(left)
+        prev_row = cur_row
+    return prev_row[len(hyp)]
+
+def float32(value):
+    '''Rounds to single precision, like the BaseFloat percentages of compute-wer'''
+    return struct.unpack('f', struct.pack('f', value))[0]
+
+def percent(count, total):
+    if total == 0:
+        return float('nan')
+    return float32(100.0 * count / total)
+
+class WerScorer:
+
+    def __init__(self, ref_file, mode='strict'):
+        if mode not in ['strict', 'present', 'all']:
+            raise ValueError('Unknown mode: ' + mode)
+        self.ref_file = ref_file
+        self.mode = mode
+        self.word_ids = {}
+        self.refs = readTranscripts(ref_file, self.word_ids)
+        # (utterance index, hypothesis) -> edit distance counts, shared by all hypothesis files
+        self.distances = {}
+
+    def score(self, hyp_file):
+        '''Returns the counts of compute-wer for a hypothesis file'''
+        hyps = {}
+        for key, words in readTranscripts(hyp_file, self.word_ids):
+            hyps.setdefault(key, words)
+
+        stats = dict([(name, 0) for name in ['num_words', 'word_errs', 'num_sent', 'sent_errs', 'num_ins', 'num_del', 'num_sub', 'num_absent_sents']])
+        for i, (key, ref) in enumerate(self.refs):
+            if key in hyps:
+                hyp = hyps[key]
+            else:
+                if self.mode == 'strict':
+                    raise RuntimeError('No hypothesis for key ' + key + ' and strict mode specifier.')
+                stats['num_absent_sents'] += 1
+                if self.mode == 'present':
+                    continue
+                hyp = ()
+            stats['num_words'] += len(ref)
+            if hyp == ref:
+                errs, ins, dels, subs = 0, 0, 0, 0
+            else:
+                distance_key = (i, hyp)
+                if distance_key not in self.distances:
+                    self.distances[distance_key] = levenshtein(ref, hyp)
+                errs, ins, dels, subs = self.distances[distance_key]
+            stats['word_errs'] += errs
+            stats['num_ins'] += ins
+            stats['num_del'] += dels
+            stats['num_sub'] += subs
+            stats['num_sent'] += 1
+            stats['sent_errs'] += 1 if hyp != ref else 0
+        return stats
+
+    def report(self, stats):
+        '''The output of compute-wer (including the command line it logs) for the counts of a hypothesis file'''
+        return ('compute-wer --text --mode=' + self.mode + ' ark:' + self.ref_file + ' ark,p:- \n'
+                + '%%WER %.2f [ %d / %d, %d ins, %d del, %d sub ]%s\n' % (percent(stats['word_errs'], stats['num_words']), stats['word_errs'],
+                     stats['num_words'], stats['num_ins'], stats['num_del'], stats['num_sub'], ' [PARTIAL]' if stats['num_absent_sents'] != 0 else '')
+                + '%%SER %.2f [ %d / %d ]\n' % (percent(stats['sent_errs'], stats['num_sent']), stats['sent_errs'], stats['num_sent'])
+                + 'Scored %d sentences, %d not present in hyp.\n' % (stats['num_sent'], stats['num_absent_sents']))
+
+def parseLmwtRange(lmwt):
+    '''"7:17" -> [7, ..., 17]'''
+    split = lmwt.split(':')
+    return list(range(int(split[0]), int(split[-1]) + 1))
+
+def bestWer(wer_lines):
+    '''Best of (wer file, %WER line) pairs in the format of utils/best_wer.sh, the first one wins on ties'''
+    best = None
+    for wer_file, line in wer_lines:
+        wer = float(line.split()[1])
+        if best is None or wer < best[0]:
+            best = (wer, line + ' ' + wer_file)
+    return best[1] if best is not None else ''
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Computes the WER of all LM weight / word insertion penalty combinations of a decode dir in one process (replaces compute-wer in local/score.sh).')
+    parser.add_argument('ref', help='Filtered reference text (scoring_kaldi/test_filt.txt)', type=str)
+    parser.add_argument('dir', help='Decode dir, hypotheses are read from DIR/scoring_kaldi/penalty_WIP/LMWT.txt and written to DIR/wer_LMWT_WIP', type=str)
+    parser.add_argument('--lmwt', dest='lmwt', help='Range of LM weights, min:max', type=str, default='7:17')
+    parser.add_argument('--word-ins-penalty', dest='word_ins_penalty', help='Comma separated word insertion penalties', type=str, default='0.0,0.5,1.0')
+    parser.add_argument('--mode', dest='mode', help='compute-wer mode: strict, present or all', type=str, default='strict')
+    parser.add_argument('--best-wer', dest='best_wer', help='Also write the best WER (like utils/best_wer.sh) to this file', type=str, default='')
+
+    args = parser.parse_args()
+
+    scorer = WerScorer(args.ref, args.mode)
+    wer_lines = []
+    for wip in [wip for wip in args.word_ins_penalty.split(',') if wip != '']:
+        for lmwt in parseLmwtRange(args.lmwt):
+            stats = scorer.score(hyp_file_template.format(dir=args.dir, wip=wip, lmwt=lmwt))
+            report = scorer.report(stats)
+            wer_file = wer_file_template.format(dir=args.dir, wip=wip, lmwt=lmwt)
+            with io.open(wer_file, 'w', encoding='utf-8') as outfile:
+                outfile.write(report)
+            wer_lines.append((wer_file, report.split('\n')[1]))
+            print(wer_file + ':' + wer_lines[-1][1])
+
+    print('Computed', len(scorer.distances), 'distinct edit distances for', len(wer_lines), 'hypothesis files.', file=sys.stderr)
+    if args.best_wer != '':
+        with io.open(args.best_wer, 'w', encoding='utf-8') as outfile:
+            outfile.write(bestWer(wer_lines) + '\n')
@@ -0,0 +1,239 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2022 Language Technology, Universitaet Hamburg (author: Benjamin Milde)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import print_function
+
+import contextlib
+import german_asr_lm_tools.normalize_sentences as normalize_sentences
+import hashlib
+import os
+import persistent_cache
+
+#
+# Batched text normalization with german_asr_lm_tools. normalize_sentences.normalize(nlp, text) runs the spaCy pipeline on one text at
+# a time, which is slow for large corpora. normalize() is pre-processing of the text, one call of the spaCy pipeline and
+# post-processing of the doc, german_asr_lm_tools has no separate functions for these steps. preprocess() and postprocess() below split
+# normalize() at its spaCy call, so that the rules stay the ones of the german_asr_lm_tools version that is checked out:
+# preprocess(text) runs normalize() up to the pipeline call and returns the string it would pass to spaCy, postprocess(nlp, text,
+# spacy_input, doc) runs normalize() again and hands it the doc for this string instead of running the pipeline. BatchNormalizer
+# pre-processes all texts of a batch, runs the pipeline on all of the strings with nlp.pipe (in batches and optionally in several
+# processes) and post-processes every doc.
+#
+# Pipeline components that normalization doesn't need (e.g. ner) can be disabled. The results of the first texts are compared with
+# normalize() and the full pipeline, if they differ the disabled components are enabled again, and if they still differ the texts are
+# normalized one by one with normalize().
+#
+# Normalized texts can be kept in a persistent cache (CachedNormalizer), keyed by the text and whether its first word is a stopword.
+# The cache namespace is the version of the normalizer (a checksum of the german_asr_lm_tools sources and the spaCy model version),
+# when the normalization rules change, the texts are normalized again.
+#
+
+default_spacy_model = 'de_core_news_lg'
+default_disable = ['ner']
+
+#Default location of the persistent normalization cache
+normalize_cache_default_file = 'data/local/normalize_cache.sqlite'
+
+def loadSpacy(model=default_spacy_model):
+    import spacy
+    return spacy.load(model)
+
+def spacyModelVersion(model=default_spacy_model):
+    '''Version of the installed spaCy model package, without loading it'''
+    try:
+        from importlib.metadata import version
+        return version(model)
+    except Exception:
+        return ''
+
+def normalizerVersion(model=default_spacy_model):
+    '''Checksum of the normalization rules (the sources of german_asr_lm_tools) and the spaCy model version'''
+    sha1 = hashlib.sha1()
+    package_dir = os.path.dirname(os.path.abspath(normalize_sentences.__file__))
+    for filename in sorted(os.listdir(package_dir)):
+        if filename.endswith('.py'):
+            with open(os.path.join(package_dir, filename), 'rb') as source:
+                sha1.update(filename.encode('utf-8') + b'\x00' + source.read())
+    sha1.update((model + ' ' + spacyModelVersion(model)).encode('utf-8'))
+    return sha1.hexdigest()
+
+def openNormalizeCache(filename, max_entries=0, model=default_spacy_model):
+    '''Opens the persistent cache for normalized texts, returns None if filename is empty (no caching)'''
+    if filename == '':
+        return None
+    namespace = 'normalize:' + normalizerVersion(model)
+    cache = persistent_cache.PersistentCache(filename, namespace=namespace, max_entries=max_entries)
+    purged = cache.purge(keep_namespace=namespace, namespace_prefix='normalize:')
+    if purged > 0:
+        print('Normalizer has changed, removed', purged, 'cached texts of other normalizer versions from', filename)
+    return cache
+
+def lowercaseStopword(text, normalized_text, stopwords):
+    '''The normalization step looks at POS tags to decide if the first word should be lowercased, but gets some wrong: lowercase the
+       first word if it is a stopword and not all upper case.'''
+    if stopwords is not None and text.split()[0] in stopwords:
+        if not normalized_text[1].isupper():
+            normalized_text = normalized_text[0].lower() + normalized_text[1:]
+    return normalized_text
+
+def normalizeText(nlp, text, stopwords=None):
+    '''normalize_sentences.normalize for a single text, see lowercaseStopword for stopwords'''
+    return lowercaseStopword(text, normalize_sentences.normalize(nlp, text), stopwords)
+
+class PipelineInput(BaseException):
+    '''Stops normalize() at its spaCy call in preprocess, carries the string that would be passed to the pipeline. It is not derived
+       from Exception, so that it isn't caught by error handling in normalize().'''
+    pass
+
+def preprocess(text):
+    '''Pre-processing step of normalize_sentences.normalize: returns (True, the string normalize(nlp, text) passes to the spaCy
+       pipeline), or (False, normalized text) if normalize() doesn't run the pipeline for this text'''
+    def nlp(spacy_input):
+        raise PipelineInput(spacy_input)
+    try:
+        return False, normalize_sentences.normalize(nlp, text)
+    except PipelineInput as pipeline_input:
+        return True, pipeline_input.args[0]
+
+def postprocess(nlp, text, spacy_input, doc):
+    '''Post-processing step of normalize_sentences.normalize: the result of normalize(nlp, text) with doc as the result of the spaCy
+       pipeline for spacy_input (see preprocess). Any other pipeline call of normalize() runs nlp.'''
+    def replay(pipeline_input):
+        if pipeline_input == spacy_input:
+            return doc
+        return nlp(pipeline_input)
+    return normalize_sentences.normalize(replay, text)
+
+class BatchNormalizer:
+
+    def __init__(self, nlp, batch_size=256, n_process=1, disable=default_disable, check_texts=100):
+        self.nlp = nlp
+        self.batch_size = batch_size
+        self.n_process = n_process
+        self.disable = [name for name in disable if name in nlp.pipe_names]
+        self.check_texts = check_texts
+        self.checked = 0
+        # normalize texts in batches with preprocess, nlp.pipe and postprocess, otherwise one by one with normalize()
+        self.split = True
+
+    def disabled_pipes(self):
+        if len(self.disable) == 0:
+            return contextlib.nullcontext()
+        if hasattr(self.nlp, 'select_pipes'):
+            return self.nlp.select_pipes(disable=self.disable)
+        return self.nlp.disable_pipes(*self.disable)
+
+    def pipe(self, inputs):
+        '''Runs the spaCy pipeline (without the disabled components) on the input strings, returns the list of docs'''
+        with self.disabled_pipes():
+            return list(self.nlp.pipe(inputs, batch_size=self.batch_size, n_process=self.n_process))
+
+    def normalize_one(self, text, stopwords=None):
+        try:
+            return normalizeText(self.nlp, text, stopwords)
+        except Exception:
+            return None
+
+    def normalize_batch(self, texts, stopwords=None):
+        if not self.split:
+            with self.disabled_pipes():
+                return [self.normalize_one(text, stopwords) for text in texts]
+
+        results = [None] * len(texts)
+        inputs = []
+        for i, text in enumerate(texts):
+            try:
+                needs_pipeline, result = preprocess(text)
+            except Exception:
+                continue
+            if needs_pipeline:
+                inputs.append((i, result))
+            else:
+                results[i] = lowercaseStopword(text, result, stopwords)
+        docs = self.pipe([spacy_input for i, spacy_input in inputs])
+        with self.disabled_pipes():
+            for (i, spacy_input), doc in zip(inputs, docs):
+                try:
+                    results[i] = lowercaseStopword(texts[i], postprocess(self.nlp, texts[i], spacy_input, doc), stopwords)
+                except Exception:
+                    continue
+        return results
+
+    def check(self, texts, results, stopwords=None):
+        '''Compares the first results with normalize() and the full pipeline, returns False if they differ'''
+        for text, result in zip(texts, results):
+            if self.checked >= self.check_texts:
+                break
+            self.checked += 1
+            try:
+                expected = normalizeText(self.nlp, text, stopwords)
+            except Exception:
+                expected = None
+            if result != expected:
+                print('Warning, batched normalization without the spaCy components', ', '.join(self.disable), 'differs from normalize() for:', text)
+                return False
+        return True
+
+    def normalize_many(self, texts, stopwords=None):
+        '''Normalizes a list of texts, returns a list with the normalized texts (None for texts that could not be normalized)'''
+        results = self.normalize_batch(texts, stopwords)
+        while self.split and self.checked < self.check_texts and not self.check(texts, results, stopwords):
+            if len(self.disable) > 0:
+                print('Enabling all components again.')
+                self.disable = []
+            else:
+                print('Normalizing texts one by one.')
+                self.split = False
+            self.checked = 0
+            results = self.normalize_batch(texts, stopwords)
+        return results
+
+    def close(self):
+        # nothing to release, but clients of the normalization server have to be closed
+        pass
+
+def normalizeCacheKey(text, stopwords=None):
+    '''Cache key of a text: the text and if its first word is a stopword (see lowercaseStopword)'''
+    split = text.split()
+    first_word_stopword = stopwords is not None and len(split) > 0 and split[0] in stopwords
+    return (text, '1' if first_word_stopword else '0')
+
+class CachedNormalizer:
+    '''Looks texts up in a persistent cache (see openNormalizeCache) first, only texts that were not normalized before are passed to
+       the normalizer (a BatchNormalizer or a client of the normalization server)'''
+
+    def __init__(self, normalizer, cache):
+        self.normalizer = normalizer
+        self.cache = cache
+        self.hits = 0
+        self.misses = 0
+
+    def normalize_many(self, texts, stopwords=None):
+        keys = [normalizeCacheKey(text, stopwords) for text in texts]
+        results = self.cache.get_many(keys)
+        new = [(text, key) for text, key in zip(texts, keys) if key not in results]
+        new_results = self.normalizer.normalize_many([text for text, key in new], stopwords)
+        # texts that could not be normalized are not cached
+        self.cache.put_many([(key, result) for (text, key), result in zip(new, new_results) if result is not None])
+        results.update(zip([key for text, key in new], new_results))
+        self.hits += len(texts) - len(new)
+        self.misses += len(new)
+        return [results[key] for key in keys]
+
+    def close(self):
+        print('Found', self.hits, 'of', self.hits + self.misses, 'texts in the normalization cache.')
+        self.normalizer.close()
+        self.cache.close()
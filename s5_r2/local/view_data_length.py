@@ -18,50 +18,288 @@ from __future__ import print_function
 
 import argparse
 import io
+import json
+import sys
+from bisect import bisect_left
 from math import fsum
 
-if __name__ == '__main__':
-    parser = argparse.ArgumentParser(description='Shows the length (in hours) of a Kaldi folder. Either the segment file or the utt2dur file needs to be present.')
-    parser.add_argument('-f', '--folder', dest='folder', help='The kaldi folder for which the length (in hours) should be calculated', type=str, default='')
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
-    args = parser.parse_args()
+#
+# Statistics of one or more Kaldi data dirs: hours, utterance length percentiles and histogram, per speaker (utt2spk) and per source
+# (data dir) totals and counts of anomalous segments (over-long, end before start, end == start). Every file is read at once and split
+# into columns, the statistics are computed with numpy if it is installed and with plain Python otherwise (with the same results):
+#
+#   python3 local/view_data_length.py -f data/tuda_train -f data/swc_train -f data/m_ailabs_train -f data/commonvoice_train \
+#       --json data/train_stats.json
+#
+# Utterance lengths come from utt2dur, or from segments if a data dir has no utt2dur.
+#
+
+default_percentiles = [1, 5, 10, 25, 50, 75, 90, 95, 99]
+# histogram bin edges in seconds, the last bin is open ended
+default_histogram_bins = [0, 1, 2, 3, 5, 7.5, 10, 15, 20, 30, 60]
+# segments longer than this (in seconds) are reported as over-long
+default_max_length = 2000.0
+# anomalous segment lines that are printed per data dir
+max_examples = 10
+
+# every byte except space and newline, deleted to get the sequence of separators of a file
+non_separator_bytes = bytes([byte for byte in range(256) if byte not in b' \n'])
+
+def isWellFormed(content, fields, num_columns):
+    '''True if every line of content has num_columns fields separated by single spaces, without blank lines or other whitespace (then
+       fields, the result of content.split(), can be sliced into columns). Checked without a loop over the lines: the only whitespace
+       is spaces and newlines if the fields and these separators add up to the whole content, and the separators in file order have
+       to be num_columns-1 spaces and a newline for every line. Since the file ends with a newline (or the separators lack the last
+       one) and there are as many fields as separators, no field is empty.'''
+    if len(fields) % num_columns != 0:
+        return False
+    separators = content.encode('utf-8', 'surrogateescape').translate(None, non_separator_bytes)
+    if sum(map(len, fields)) + len(separators) != len(content):
+        return False
+    if not content.endswith('\n'):
+        separators += b'\n'
+    return separators == (b' ' * (num_columns - 1) + b'\n') * (len(fields) // num_columns)
+
+def readColumns(filename, num_columns):
+    '''Reads a Kaldi table file with num_columns fields per line, returns (list of columns, number of malformed lines). If every line is
+       well formed (see isWellFormed) the columns are sliced out of the split file contents, otherwise the contents are split line by
+       line and malformed lines are skipped.'''
+    with io.open(filename, 'r', encoding='utf-8', errors='surrogateescape') as infile:
+        content = infile.read()
+    fields = content.split()
+    if isWellFormed(content, fields, num_columns):
+        return [fields[i::num_columns] for i in range(num_columns)], 0
+
+    columns = [[] for i in range(num_columns)]
+    malformed = 0
+    for line in content.split('\n'):
+        row = line.split()
+        if len(row) == num_columns:
+            for column, value in zip(columns, row):
+                column.append(value)
+        elif len(row) > 0:
+            malformed += 1
+    return columns, malformed
+
+def toArray(column):
+    if numpy is not None:
+        return numpy.array(column, dtype=numpy.float64)
+    return [float(value) for value in column]
+
+def sortValues(values):
+    if numpy is not None:
+        return numpy.sort(values)
+    return sorted(values)
+
+def concatenate(arrays):
+    if numpy is not None:
+        return numpy.concatenate(arrays) if len(arrays) > 0 else numpy.zeros(0)
+    return [value for values in arrays for value in values]
+
+def percentiles(sorted_values, qs):
+    '''Percentiles with linear interpolation between the closest ranks (like numpy.percentile)'''
+    if len(sorted_values) == 0:
+        return [None for q in qs]
+    if numpy is not None:
+        return [float(value) for value in numpy.percentile(sorted_values, qs)]
+    results = []
+    for q in qs:
+        pos = (len(sorted_values) - 1) * q / 100.0
+        low = int(pos)
+        high = min(low + 1, len(sorted_values) - 1)
+        results.append(sorted_values[low] + (sorted_values[high] - sorted_values[low]) * (pos - low))
+    return results
+
+def histogram(sorted_values, bins):
+    '''Number of values in [bins[i], bins[i+1]), the last bin is [bins[-1], inf), values below bins[0] are not counted'''
+    if numpy is not None:
+        edges = numpy.searchsorted(sorted_values, bins, side='left').tolist()
+    else:
+        edges = [bisect_left(sorted_values, edge) for edge in bins]
+    edges.append(len(sorted_values))
+    return [edges[i+1] - edges[i] for i in range(len(bins))]
 
-    if args.folder == '':
-      print('You have to specify a Kaldi data folder with the -f flag.')
-   
-    folder = args.folder
+def lengthStats(lengths, qs=default_percentiles, bins=default_histogram_bins):
+    '''Hours, utterance length percentiles and histogram of an array of lengths (in seconds)'''
+    sorted_lengths = sortValues(lengths)
+    num = len(sorted_lengths)
+    # fsum, so that the hours are the same with and without numpy
+    total = fsum(sorted_lengths.tolist() if numpy is not None else sorted_lengths)
+    return {'utterances': num,
+            'hours': total / 60.0 / 60.0,
+            'mean': total / num if num > 0 else None,
+            'min': float(sorted_lengths[0]) if num > 0 else None,
+            'max': float(sorted_lengths[-1]) if num > 0 else None,
+            'percentiles': dict(zip([str(q) for q in qs], percentiles(sorted_lengths, qs))),
+            'histogram': {'bins': list(bins), 'counts': histogram(sorted_lengths, bins)}}
 
-    if folder[-1] != '/':
-      folder += '/'
+def speakerStats(utts, lengths, utt2spk_utts, utt2spk_spks, top=10):
+    '''Number of speakers and hours per speaker, utterances that are not in utt2spk are counted separately'''
+    spk_of_utt = dict(zip(utt2spk_utts, utt2spk_spks))
+    spks = [spk_of_utt.get(utt) for utt in utts]
+    known = [i for i, spk in enumerate(spks) if spk is not None]
+    if numpy is not None:
+        names, inverse = numpy.unique(numpy.array([spks[i] for i in known], dtype=object), return_inverse=True)
+        totals = numpy.bincount(inverse, weights=numpy.asarray(lengths)[known], minlength=len(names)) if len(known) > 0 else []
+        spk_seconds = dict(zip(names.tolist(), [float(seconds) for seconds in totals]))
+    else:
+        spk_seconds = {}
+        for i in known:
+            spk_seconds[spks[i]] = spk_seconds.get(spks[i], 0.0) + lengths[i]
+
+    spk_hours = sorted([seconds / 60.0 / 60.0 for seconds in spk_seconds.values()])
+    top_speakers = sorted(spk_seconds.items(), key=lambda item: (-item[1], item[0]))[:top]
+    return {'speakers': len(spk_seconds),
+            'utterances_without_speaker': len(utts) - len(known),
+            'speaker_hours': {'min': spk_hours[0] if len(spk_hours) > 0 else None,
+                              'median': percentiles(spk_hours, [50])[0],
+                              'max': spk_hours[-1] if len(spk_hours) > 0 else None},
+            'top_speakers': [[spk, seconds / 60.0 / 60.0] for spk, seconds in top_speakers]}
+
+def segmentAnomalies(columns, lengths, max_length=default_max_length):
+    '''Counts of over-long segments, segments with the end marker before the start marker and zero length segments, with a few
+       example lines of each'''
+    if numpy is not None:
+        over_long = numpy.flatnonzero(lengths > max_length).tolist()
+        inverted = numpy.flatnonzero(lengths < 0).tolist()
+        zero_length = numpy.flatnonzero(lengths == 0).tolist()
+    else:
+        over_long = [i for i, length in enumerate(lengths) if length > max_length]
+        inverted = [i for i, length in enumerate(lengths) if length < 0]
+        zero_length = [i for i, length in enumerate(lengths) if length == 0]
+    line = lambda i: ' '.join([column[i] for column in columns])
+    return {'over_long': len(over_long), 'inverted': len(inverted), 'zero_length': len(zero_length),
+            'examples': {'over_long': [line(i) for i in over_long[:max_examples]],
+                         'inverted': [line(i) for i in inverted[:max_examples]],
+                         'zero_length': [line(i) for i in zero_length[:max_examples]]}}
+
+def dataDirStats(folder, qs=default_percentiles, bins=default_histogram_bins, max_length=default_max_length, top_speakers=10, verbose=True):
+    '''Statistics of a data dir, files that are missing or can't be processed are skipped (with a message if verbose)'''
+    path = folder if folder.endswith('/') else folder + '/'
+    stats = {'malformed_lines': {}}
+    utts, lengths = None, None
+
+    try:
+        (utt2dur_utts, durations), malformed = readColumns(path + 'utt2dur', 2)
+        durations = toArray(durations)
+        stats['malformed_lines']['utt2dur'] = malformed
+        stats['utt2dur_hours'] = fsum(durations.tolist() if numpy is not None else durations) / 60.0 / 60.0
+        utts, lengths = utt2dur_utts, durations
+    except (IOError, OSError, ValueError):
+        if verbose:
+            print('Could not open/process utt2dur file in:', folder)
 
     try:
-      with io.open(folder + 'utt2dur') as utt2dur:
-        sum_list = []
-        for line in utt2dur:
-          if line[-1]=='\n':
-            line = line[:-1]
-          sum_list += [float(line.split()[1])]
-        hours = fsum(sum_list) / 60.0 / 60.0
-        print('Utt2dur file: ', args.folder, 'is', hours, ' hours!')
-    except:
-      print('Could not open/process utt2dur file in:', args.folder)
+        columns, malformed = readColumns(path + 'segments', 4)
+        starts, ends = toArray(columns[2]), toArray(columns[3])
+        if numpy is not None:
+            segment_lengths = ends - starts
+        else:
+            segment_lengths = [end - start for start, end in zip(starts, ends)]
+        stats['malformed_lines']['segments'] = malformed
+        stats['segments_hours'] = fsum(segment_lengths.tolist() if numpy is not None else segment_lengths) / 60.0 / 60.0
+        stats['recordings'] = len(set(columns[1]))
+        stats['anomalies'] = segmentAnomalies(columns, segment_lengths, max_length)
+        if utts is None:
+            utts, lengths = columns[0], segment_lengths
+    except (IOError, OSError, ValueError):
+        if verbose:
+            print('Could not open/process segments file in:', folder)
 
+    if utts is None:
+        return None, None
+    stats['lengths'] = lengthStats(lengths, qs, bins)
 
     try:
-      with io.open(folder + 'segments') as segments:
-        sum_list = []
-        for line in segments:
-          diff = float(line.split()[3]) - float(line.split()[2])
-          sum_list += [diff]
-          if diff > 2000:
-            print('Warning over-long segment:', diff)
-            print(line)
-          if float(line.split()[2]) > float(line.split()[3]):
-            print('Warning, end marker before start:', line)
-          elif float(line.split()[2]) == float(line.split()[3]):
-            print('Warning, end marker == start marker:', line)
-        hours = fsum(sum_list) / 60.0 / 60.0
-
-        print('Segment file: ', args.folder, 'is', hours, ' hours!')
-    except:
-      print('Could not open/process segments file in:', args.folder)
+        (utt2spk_utts, utt2spk_spks), malformed = readColumns(path + 'utt2spk', 2)
+        stats['malformed_lines']['utt2spk'] = malformed
+        stats['speakers'] = speakerStats(utts, lengths, utt2spk_utts, utt2spk_spks, top_speakers)
+    except (IOError, OSError, ValueError):
+        pass
+    return stats, lengths
+
+def formatSeconds(value):
+    return '-' if value is None else '%.2f' % value
+
+def printStats(name, stats):
+    if 'utt2dur_hours' in stats:
+        print('Utt2dur file: ', name, 'is', stats['utt2dur_hours'], ' hours!')
+    if 'segments_hours' in stats:
+        print('Segment file: ', name, 'is', stats['segments_hours'], ' hours!')
+    lengths = stats['lengths']
+    print('  utterances:', lengths['utterances'], end='')
+    if 'speakers' in stats:
+        print(', speakers:', stats['speakers']['speakers'], end='')
+    if 'recordings' in stats:
+        print(', recordings:', stats['recordings'], end='')
+    print()
+    print('  length (s): mean', formatSeconds(lengths['mean']), 'min', formatSeconds(lengths['min']), ' '.join(['p' + q + ' ' + formatSeconds(value)
+          for q, value in lengths['percentiles'].items()]), 'max', formatSeconds(lengths['max']))
+    bins = lengths['histogram']['bins']
+    print('  histogram (s):', ', '.join([str(low) + '-' + (str(high) if high is not None else '') + ': ' + str(count) for low, high, count in
+          zip(bins, bins[1:] + [None], lengths['histogram']['counts'])]))
+    if 'speakers' in stats:
+        speakers = stats['speakers']
+        print('  hours per speaker: min', formatSeconds(speakers['speaker_hours']['min']), 'median', formatSeconds(speakers['speaker_hours']['median']),
+              'max', formatSeconds(speakers['speaker_hours']['max']))
+        if speakers['utterances_without_speaker'] > 0:
+            print('  Warning,', speakers['utterances_without_speaker'], 'utterances are not in utt2spk')
+    for filename, malformed in stats['malformed_lines'].items():
+        if malformed > 0:
+            print('  Warning,', malformed, 'malformed lines in', filename)
+    if 'anomalies' in stats:
+        anomalies = stats['anomalies']
+        print('  anomalies: over-long', anomalies['over_long'], 'end before start', anomalies['inverted'], 'end == start', anomalies['zero_length'])
+        for kind, message in [('over_long', 'Warning over-long segment:'), ('inverted', 'Warning, end marker before start:'),
+                              ('zero_length', 'Warning, end marker == start marker:')]:
+            for line in anomalies['examples'][kind]:
+                print('   ', message, line)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Shows the length (in hours) and utterance length statistics of Kaldi folders. Either the segment file or the utt2dur file needs to be present.')
+    parser.add_argument('-f', '--folder', dest='folders', help='A kaldi folder for which the length (in hours) should be calculated, can be given several times', action='append', default=[])
+    parser.add_argument('--json', dest='json', help='Write the statistics as JSON to this file (- for stdout, then nothing else is printed)', type=str, default='')
+    parser.add_argument('--percentiles', dest='percentiles', help='Comma separated utterance length percentiles', type=str, default=','.join([str(q) for q in default_percentiles]))
+    parser.add_argument('--bins', dest='bins', help='Comma separated histogram bin edges in seconds', type=str, default=','.join([str(edge) for edge in default_histogram_bins]))
+    parser.add_argument('--max-length', dest='max_length', help='Segments longer than this (in seconds) are reported as over-long', type=float, default=default_max_length)
+    parser.add_argument('--top-speakers', dest='top_speakers', help='Number of speakers with the most hours in the JSON output', type=int, default=10)
+
+    args = parser.parse_args()
+
+    if len(args.folders) == 0:
+        print('You have to specify a Kaldi data folder with the -f flag.')
+        sys.exit(1)
+
+    qs = [float(q) if '.' in q else int(q) for q in args.percentiles.split(',') if q != '']
+    bins = sorted([float(edge) if '.' in edge else int(edge) for edge in args.bins.split(',') if edge != ''])
+    verbose = args.json != '-'
+
+    sources = {}
+    all_lengths = []
+    for folder in args.folders:
+        stats, lengths = dataDirStats(folder, qs, bins, args.max_length, args.top_speakers, verbose)
+        if stats is None:
+            continue
+        sources[folder] = stats
+        all_lengths.append(lengths)
+        if verbose:
+            printStats(folder, stats)
+
+    result = {'sources': sources}
+    if len(sources) > 1:
+        result['total'] = lengthStats(concatenate(all_lengths), qs, bins)
+        result['total']['source_hours'] = dict([(folder, stats['lengths']['hours']) for folder, stats in sources.items()])
+        if verbose:
+            print('Total of', len(sources), 'folders is', result['total']['hours'], ' hours!',
+                  '(' + ', '.join([folder + ': ' + '%.2f' % hours for folder, hours in result['total']['source_hours'].items()]) + ')')
+
+    if args.json == '-':
+        print(json.dumps(result, indent=2))
+    elif args.json != '':
+        with io.open(args.json, 'w', encoding='utf-8') as outfile:
+            outfile.write(json.dumps(result, indent=2) + '\n')
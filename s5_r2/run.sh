@@ -35,6 +35,24 @@ add_extra_words=true
 
 add_train_text_to_lm=true
 
+# Set this to true to decode the sox pipes in wav.scp of m_ailabs_train and commonvoice_train once into 16 kHz wav files (in
+# data/wav_16k/, see local/materialize_audio.py), instead of decoding the mp3/ogg/flac files again in every later pass. The segments
+# of swc_train are cut out of their recordings once into audio archives (data/swc_train_extracted, see local/extract_segments.py).
+materialize_audio=false
+
+# Set this to true to pack the audio of tuda_train, m_ailabs_train and commonvoice_train into sharded archives (data/wav_16k/*_archive,
+# see local/audio_archive.py), so that feature extraction doesn't open millions of small files. Commands in wav.scp are decoded once
+# while packing. pack_audio and materialize_audio are mutually exclusive for m_ailabs_train and commonvoice_train: with both set,
+# these are only packed (materialize_audio then only extracts the swc_train segments). Data dirs whose wav.scp already points into
+# their archives are not packed again.
+pack_audio=false
+
+# Set this to true to scan the audio of the training data dirs before feature extraction (see local/scan_audio.py). Unreadable,
+# truncated, silent, clipped or too short audio is removed from the data dirs and written to the exclusion list, which the prepare
+# scripts read (option --exclude), so that the broken files are skipped when the data dirs are prepared again.
+scan_audio=false
+audio_exclude=data/local/audio_exclude.txt
+
 # Language model instructions:
 # See https://github.com/bmilde/german-asr-lm-tools/ for instructions on getting recent German text data normalized
 # Place the resulting gzipped file in data/local/lm_std_big_v6/cleaned_lm_text.gz
@@ -119,6 +137,27 @@ utf8()
     mv $1.tmp $1
 }
 
+# The text normalization server holds the spaCy model for prepare_commonvoice_data.py and renormalize_datadir_text.py, so that it
+# is only loaded once per run. It is started on first use and stopped after the data dirs are renormalized in stage 6, so that the
+# model doesn't stay in memory during training. The trap stops it if this script exits earlier.
+normalize_socket=data/local/normalize.sock
+
+start_normalize_server()
+{
+    if ! python3 local/normalize_server.py -s $normalize_socket ping; then
+        mkdir -p data/local
+        python3 local/normalize_server.py -s $normalize_socket serve &
+        trap "python3 local/normalize_server.py -s $normalize_socket stop" EXIT
+        python3 local/normalize_server.py -s $normalize_socket wait --pid $!
+    fi
+}
+
+stop_normalize_server()
+{
+    python3 local/normalize_server.py -s $normalize_socket stop
+    trap - EXIT
+}
+
 if [ $stage -le 1 ]; then
   # Prepares KALDI dir structure and asks you where to store mfcc vectors and the final models (both can take up significant space)
   python3 local/prepare_dir_structure.py
@@ -191,7 +230,7 @@ if [ $stage -le 1 ]; then
     if [ ! -d data/m_ailabs_train ]
     then
       # make data directory data/m_ailabs_train 
-      python3 local/prepare_m-ailabs_data.py
+      python3 local/prepare_m-ailabs_data.py --exclude $audio_exclude
     fi
   fi
 
@@ -220,7 +259,8 @@ if [ $stage -le 1 ]; then
       cd ..
       # make data directory data/commonvoice_train
       cp --link local/german_asr_lm_tools/normalisierung.py local/normalisierung.py
-      python3 local/prepare_commonvoice_data.py
+      start_normalize_server
+      python3 local/prepare_commonvoice_data.py -s $normalize_socket --exclude $audio_exclude
     fi
   fi
 fi
@@ -240,7 +280,7 @@ if [ $stage -le 2 ]; then
   find $RAWDATA/*/$FILTERBYNAME -type f > data/waveIDs.txt
 
   # prepares directories in Kaldi format for the TUDA speech corpus
-  python3 local/data_prepare.py -f data/waveIDs.txt --separate-mic-dirs
+  python3 local/data_prepare.py -f data/waveIDs.txt --separate-mic-dirs --jobs $nJobs --exclude $audio_exclude
 
   # If want to do experiments with very noisy data, you can also create Kaldi dirs for the Realtek microphone. Disabled in train/test/dev by default.
   # python3 local/data_prepare.py -f data/waveIDs.txt -p _Realtek -k _e
@@ -300,8 +340,8 @@ fi
 if [ $stage -le 4 ]; then
   #Transform freely available dictionaries into lexiconp.txt file + extra files 
   mkdir -p ${dict_dir}/
-  python3 local/build_big_lexicon.py -f data/lexicon_ids.txt -e data/local/combined.dict --export-dir ${dict_dir}/
-  python3 local/export_lexicon.py -f data/local/combined.dict -o ${dict_dir}/_lexiconp.txt 
+  python3 local/build_big_lexicon.py -f data/lexicon_ids.txt -l data/local/combined.lex --export-dir ${dict_dir}/ --jobs $nJobs
+  python3 local/export_lexicon.py -f data/local/combined.lex -o ${dict_dir}/_lexiconp.txt 
 fi
 
 g2p_model=${g2p_dir}/de_g2p_model
@@ -336,28 +376,41 @@ if [ $stage -le 6 ]; then
   then
     echo "Now renormalize data dirs and find OOV in train"
 
-    python3 local/renormalize_datadir_text.py -t data/tuda_train/text
+    renormalize_dirs="tuda_train"
+    [ "$add_swc_data" = true ] && renormalize_dirs="$renormalize_dirs swc_train"
+    [ "$add_mailabs_data" = true ] && renormalize_dirs="$renormalize_dirs m_ailabs_train"
+    [ "$add_commonvoice_data" = true ] && renormalize_dirs="$renormalize_dirs commonvoice_train"
+    [ "$add_extra_data" = true ] && renormalize_dirs="$renormalize_dirs extra_train"
+
+    # all data dirs are normalized concurrently against the normalization server
+    start_normalize_server
+    renormalize_pids=""
+    for data_dir in $renormalize_dirs; do
+      python3 local/renormalize_datadir_text.py -s $normalize_socket -t data/${data_dir}/text &
+      renormalize_pids="$renormalize_pids $!"
+    done
+    for pid in $renormalize_pids; do
+      wait $pid
+    done
+    stop_normalize_server
+
     cp data/tuda_train/text ${g2p_dir}/complete_text
 
     if [ "$add_swc_data" = true ] ; then
-      python3 local/renormalize_datadir_text.py -t data/swc_train/text
       mv data/swc_train/text data/swc_train/text_before_000_fix
       grep -v "null null null" data/swc_train/text_before_000_fix > data/swc_train/text
       cat data/swc_train/text >> ${g2p_dir}/complete_text
     fi
 
     if [ "$add_mailabs_data" = true ] ; then
-      python3 local/renormalize_datadir_text.py -t data/m_ailabs_train/text
       cat data/m_ailabs_train/text >> ${g2p_dir}/complete_text
     fi
 
     if [ "$add_commonvoice_data" = true ] ; then
-      python3 local/renormalize_datadir_text.py -t data/commonvoice_train/text
       cat data/commonvoice_train/text >> ${g2p_dir}/complete_text
     fi
 
     if [ "$add_extra_data" = true ] ; then
-      python3 local/renormalize_datadir_text.py -t data/extra_train/text
       cat data/extra_train/text >> ${g2p_dir}/complete_text
     fi
 
@@ -367,13 +420,13 @@ if [ $stage -le 6 ]; then
       mv ${g2p_dir}/complete_text_new ${g2p_dir}/complete_text
     fi
 
-    python3 local/find_oov.py -c ${g2p_dir}/complete_text -w ${g2p_dir}/lexicon_wordlist.txt -o ${g2p_dir}/oov.txt
+    python3 local/find_oov.py -c ${g2p_dir}/complete_text -w ${g2p_dir}/lexicon_wordlist.txt -o ${g2p_dir}/oov.txt -g $final_g2p_model
 
     echo "Now using G2P to predict OOV"
-    $sequitur_g2p -e utf8 --model $final_g2p_model --apply ${g2p_dir}/oov.txt > ${dict_dir}/oov_lexicon.txt
-    cat ${dict_dir}/oov_lexicon.txt | gawk '{$1=$1" 1.0"; print }' > ${dict_dir}/_oov_lexiconp.txt
-    # remove entries that don't have atleast 3 columns - some phonemizations are broken
-    gawk 'NF>=3' ${dict_dir}/_oov_lexiconp.txt > ${dict_dir}/oov_lexiconp.txt
+    # runs G2P on shards of oov.txt in parallel, entries without phonemes (some phonemizations are broken) are listed in oov_failed.txt
+    # words that were already predicted with the same model are taken from the G2P cache (data/local/g2p_cache.sqlite)
+    python3 local/apply_g2p.py -i ${g2p_dir}/oov.txt -m $final_g2p_model -o ${dict_dir}/oov_lexicon.txt -p ${dict_dir}/oov_lexiconp.txt \
+        -f ${dict_dir}/oov_failed.txt -j $nJobs --g2p-cmd "$sequitur_g2p -e utf8 --model {model} --apply {input}"
     #${dict_dir}/oov_lexicon.txt
     echo "Done!"
   else
@@ -423,45 +476,65 @@ if [ $stage -le 7 ]; then
 fi
 
 if [ $stage -le 8 ]; then
-	if [ "$add_swc_data" = true ] ; then
-		  echo "Generating features for tuda_train, swc_train, dev and test"
-		  # Making sure all swc files are C-sorted 
-		  rm data/swc_train/spk2utt || true
-		  
-		  cat data/swc_train/segments | sort > data/swc_train/segments_sorted
-		  cat data/swc_train/text | sort | gawk 'NF>=2' > data/swc_train/text_sorted
-		  cat data/swc_train/utt2spk | sort > data/swc_train/utt2spk_sorted
-		  cat data/swc_train/wav.scp | sort > data/swc_train/wav.scp_sorted
+	# packing decodes the commands itself, a materialized copy would only be copied again into the archives
+	if [ "$materialize_audio" = true ] && [ "$pack_audio" != true ] ; then
+		for x in m_ailabs_train commonvoice_train; do
+			if [ -f data/$x/wav.scp ]; then
+				python3 local/materialize_audio.py --jobs $nJobs data/$x
+			fi
+		done
+	fi
 
-		  mv data/swc_train/wav.scp_sorted data/swc_train/wav.scp
-		  mv data/swc_train/utt2spk_sorted data/swc_train/utt2spk
-		  mv data/swc_train/text_sorted data/swc_train/text
-		  mv data/swc_train/segments_sorted data/swc_train/segments
+	if [ "$pack_audio" = true ] ; then
+		for x in tuda_train m_ailabs_train commonvoice_train; do
+			if [ -f data/$x/wav.scp ]; then
+				python3 local/audio_archive.py --jobs $nJobs data/$x data/wav_16k/${x}_archive
+			fi
+		done
+	fi
 
-		  echo "$LC_ALL"
+	if [ "$scan_audio" = true ] ; then
+		for x in tuda_train swc_train m_ailabs_train commonvoice_train; do
+			if [ -f data/$x/wav.scp ]; then
+				python3 local/scan_audio.py --jobs $nJobs --exclude-list $audio_exclude --filter data/$x
+			fi
+		done
+	fi
 
-		  utils/utt2spk_to_spk2utt.pl data/swc_train/utt2spk > data/swc_train/spk2utt      
+	if [ "$add_swc_data" = true ] ; then
+		  echo "Generating features for tuda_train, swc_train, dev and test"
+		  # Making sure all swc files are C-sorted, utterances without text are dropped and spk2utt is regenerated
+		  # (see data/swc_train/.backup/fix_data_dir_report.txt for what was dropped)
+		  python3 local/fix_data_dir.py --drop-empty-text data/swc_train
 		  #utils/validate_data_dir.sh data/swc_train
+
+		  swc_train=swc_train
+		  if [ "$materialize_audio" = true ] ; then
+			  # decode every SWC recording once and cut its segments into audio archives, the new data dir has no segments
+			  # (skipped if the archives are newer than segments and wav.scp of data/swc_train)
+			  python3 local/extract_segments.py --jobs $nJobs data/swc_train data/swc_train_extracted data/wav_16k/swc_train
+			  swc_train=swc_train_extracted
+		  fi
 		  
 		  # Now make MFCC features.
-		  for x in swc_train tuda_train dev test; do
-			  utils/fix_data_dir.sh data/$x # some files fail to get mfcc for many reasons
+		  for x in $swc_train tuda_train dev test; do
+			  python3 local/fix_data_dir.py data/$x # some files fail to get mfcc for many reasons
 			  steps/make_mfcc.sh --cmd "$train_cmd" --nj $nJobs data/$x exp/make_mfcc/$x $mfccdir
-			  utils/fix_data_dir.sh data/$x # some files fail to get mfcc for many reasons
+			  python3 local/fix_data_dir.py data/$x # some files fail to get mfcc for many reasons
 			  steps/compute_cmvn_stats.sh data/$x exp/make_mfcc/$x $mfccdir
-			  utils/fix_data_dir.sh data/$x
+			  python3 local/fix_data_dir.py data/$x
 		  done
 
 		  echo "Done, now combining data (tuda_train swc_train)."
-		  ./utils/combine_data.sh data/train data/tuda_train data/swc_train
+		  ./utils/combine_data.sh data/train data/tuda_train data/$swc_train
 	else
 		# Now make MFCC features.
 		for x in train dev test; do
-			utils/fix_data_dir.sh data/$x # some files fail to get mfcc for many reasons
+			python3 local/fix_data_dir.py data/$x # some files fail to get mfcc for many reasons
 			steps/make_mfcc.sh --cmd "$train_cmd" --nj $nJobs data/$x exp/make_mfcc/$x $mfccdir
-			utils/fix_data_dir.sh data/$x # some files fail to get mfcc for many reasons
+			python3 local/fix_data_dir.py data/$x # some files fail to get mfcc for many reasons
 			steps/compute_cmvn_stats.sh data/$x exp/make_mfcc/$x $mfccdir
-			utils/fix_data_dir.sh data/$x
+			python3 local/fix_data_dir.py data/$x
 		done
 	fi
 
@@ -470,11 +543,11 @@ if [ $stage -le 8 ]; then
 		echo "Now computing MFCC features for m_ailabs_train"
 		# Now make MFCC features.
 		x=m_ailabs_train
-		utils/fix_data_dir.sh data/$x # some files fail to get mfcc for many reasons
+		python3 local/fix_data_dir.py data/$x # some files fail to get mfcc for many reasons
 		steps/make_mfcc.sh --cmd "$train_cmd" --nj $nJobs data/$x exp/make_mfcc/$x $mfccdir
-		utils/fix_data_dir.sh data/$x # some files fail to get mfcc for many reasons
+		python3 local/fix_data_dir.py data/$x # some files fail to get mfcc for many reasons
 		steps/compute_cmvn_stats.sh data/$x exp/make_mfcc/$x $mfccdir
-		utils/fix_data_dir.sh data/$x
+		python3 local/fix_data_dir.py data/$x
 		
 		echo "Done, now combining data (train m_ailabs_train)."
 		./utils/combine_data.sh data/train data/train_without_mailabs data/m_ailabs_train
@@ -485,11 +558,11 @@ if [ $stage -le 8 ]; then
         	echo "Now computing MFCC features for m_ailabs_train"
         	# Now make MFCC features.
         	x=commonvoice_train
-        	utils/fix_data_dir.sh data/$x # some files fail to get mfcc for many reasons
+        	python3 local/fix_data_dir.py data/$x # some files fail to get mfcc for many reasons
         	steps/make_mfcc.sh --cmd "$train_cmd" --nj $nJobs data/$x exp/make_mfcc/$x $mfccdir
-        	utils/fix_data_dir.sh data/$x # some files fail to get mfcc for many reasons
+        	python3 local/fix_data_dir.py data/$x # some files fail to get mfcc for many reasons
         	steps/compute_cmvn_stats.sh data/$x exp/make_mfcc/$x $mfccdir
-        	utils/fix_data_dir.sh data/$x
+        	python3 local/fix_data_dir.py data/$x
 
 		echo "Done, now combining data (train commonvoice_train)."
 		./utils/combine_data.sh data/train data/train_without_commonvoice data/commonvoice_train
@@ -500,11 +573,11 @@ if [ $stage -le 8 ]; then
 	    echo "Now computing MFCC features for extra_train"
 	    # Now make MFCC features.
 	    x=extra_train
-	    utils/fix_data_dir.sh data/$x # some files fail to get mfcc for many reasons
+	    python3 local/fix_data_dir.py data/$x # some files fail to get mfcc for many reasons
 	    steps/make_mfcc.sh --cmd "$train_cmd" --nj $nJobs data/$x exp/make_mfcc/$x $mfccdir
-	    utils/fix_data_dir.sh data/$x # some files fail to get mfcc for many reasons
+	    python3 local/fix_data_dir.py data/$x # some files fail to get mfcc for many reasons
 	    steps/compute_cmvn_stats.sh data/$x exp/make_mfcc/$x $mfccdir
-	    utils/fix_data_dir.sh data/$x
+	    python3 local/fix_data_dir.py data/$x
 	    
 	    echo "Done, now combining data (train extra_train)."
 	    ./utils/combine_data.sh data/train data/train_without_extra data/extra_train